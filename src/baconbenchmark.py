@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Times the NumPy BACON sampler on a made-up core and, where the compiled BACON
+plugin is available, times that too and checks the two agree: the mean age at
+every section boundary should differ by less than tolerance posterior
+standard deviations. Exits with status 1 if they don't.
+
+usage: baconbenchmark.py [sections] [dates] [samples] [tolerance]
+"""
+
+import sys
+import time
+
+import numpy
+
+from cscience.components import baconplugin
+
+
+def synthetic_core(dates, depth, rng):
+    """
+    Dates (as given to BACON) for a core accumulating about 10 years/cm,
+    with 50 years of error on each date.
+    """
+    depths = numpy.sort(rng.uniform(0, depth, dates))
+    depths[0], depths[-1] = 0, depth
+    ages = 100 + 10 * depths + 20 * numpy.sin(depths / 30.0) + \
+           rng.normal(0, 50, dates)
+    return [[str(index), ages[index], 50.0, depths[index], 3, 4, [], []]
+            for index in range(dates)]
+
+def timed(name, function, *args):
+    start = time.time()
+    result = function(*args)
+    print '%-8s %8.2fs' % (name, time.time() - start)
+    return result
+
+def run_numpy(data, hiatusi, sections, samples):
+    sampler = baconplugin.AgeDepthSampler(data, hiatusi, sections, 2.8, 1.2,
+                                          -1000, 1000000, data[0][3], data[-1][3])
+    rows = sampler.run([data[0][1] - 10, data[0][1] + 10],
+                       samples + baconplugin.BACON_BURN_IN)
+    return baconplugin.boundary_ages(rows[:, :sections + 1],
+                                     sampler.thick)[baconplugin.BACON_BURN_IN:]
+
+def run_compiled(data, hiatusi, sections, samples):
+    ages, seconds, state = baconplugin.run_chain((None, None, data,
+                        hiatusi, sections, 2.8, 1.2,
+                        [data[0][1] - 10, data[0][1] + 10],
+                        data[0][3], data[-1][3], samples,
+                        baconplugin.BACON_BURN_IN))
+    return ages
+
+def run(sections, dates, samples, tolerance):
+    rng = numpy.random.RandomState(0)
+    data = synthetic_core(dates, 5.0 * sections, rng)
+    hiatusi = numpy.array(zip([-10, 1.5, 1.5 / 10, 0, 0]))
+    print '%d sections, %d dates, %d samples' % (sections, dates, samples)
+
+    numpy_ages = timed('numpy', run_numpy, data, hiatusi, sections, samples)
+    if baconplugin.baconc is None:
+        print 'compiled BACON plugin not available; nothing to compare'
+        return True
+    bacon_ages = timed('compiled', run_compiled, data, hiatusi, sections, samples)
+
+    spread = numpy.sqrt((numpy_ages.var(axis=0) + bacon_ages.var(axis=0)) / 2)
+    difference = abs(numpy_ages.mean(axis=0) - bacon_ages.mean(axis=0)) / spread
+    print 'largest difference in mean age: %.3f sd (at section %d)' % (
+                difference.max(), difference.argmax())
+    return difference.max() < tolerance
+
+
+if __name__ == '__main__':
+    sections = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    dates = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    samples = int(sys.argv[3]) if len(sys.argv) > 3 else 2000
+    tolerance = float(sys.argv[4]) if len(sys.argv) > 4 else .5
+    sys.exit(0 if run(sections, dates, samples, tolerance) else 1)
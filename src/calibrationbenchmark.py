@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+"""
+Times IntCalCalibrator calibrating a made-up set of 14C ages one at a time
+(convert_age) and as a batch (convert_ages), and checks the two give the same
+calibrated ages, errors and HDRs. Exits with status 1 if they don't.
+
+usage: calibrationbenchmark.py [curve file] [samples] [repeats]
+
+The curve file is in the CALIB format of plugins/bacon/Curves/intcal13.14c
+(calibrated age, 14C age, sigma, ... with # comments), which is the default.
+"""
+
+import os
+import sys
+import time
+
+import numpy
+
+from cscience.components import UncertainQuantity
+from cscience.components.c_calibration import CalibrationCurve, \
+            IntCalCalibrator
+
+
+def load_curve(filename):
+    rows = numpy.loadtxt(filename, delimiter=',', comments='#',
+                         usecols=(0, 1, 2))
+    return CalibrationCurve(dict([(index, {'Calibrated Age':row[0],
+                                           '14C Age':row[1], 'Sigma':row[2]})
+                                  for index, row in enumerate(rows)]))
+
+def synthetic_ages(count, curve, rng):
+    low, high = curve.c14_age.min() + 1000, curve.c14_age.max() - 1000
+    return [UncertainQuantity(rng.uniform(low, high), 'years',
+                              rng.uniform(20, 300))
+            for index in range(count)]
+
+def timed(name, repeats, function, *args):
+    start = time.time()
+    for index in range(repeats):
+        result = function(*args)
+    print '%-12s %8.4fs' % (name, (time.time() - start) / repeats)
+    return result
+
+def same(single, batch):
+    if single is None or batch is None:
+        return single is batch
+    one, other = single.uncertainty.distribution, batch.uncertainty.distribution
+    return numpy.allclose(single.magnitude, batch.magnitude) and \
+           numpy.allclose(one.error, other.error) and \
+           len(one.intervals) == len(other.intervals) and \
+           numpy.allclose(one.intervals, other.intervals) and \
+           numpy.allclose(one.x, other.x) and numpy.allclose(one.y, other.y)
+
+def run(filename, samples, repeats):
+    calibrator = IntCalCalibrator()
+    calibrator.curve = load_curve(filename)
+    ages = synthetic_ages(samples, calibrator.curve,
+                          numpy.random.RandomState(0))
+    print '%d samples, %d curve entries' % (samples, len(calibrator.curve))
+
+    single = timed('per sample', repeats,
+                   lambda: [calibrator.convert_age(age, .683) for age in ages])
+    batch = timed('batch', repeats, calibrator.convert_ages, ages, .683)
+
+    mismatched = [index for index, pair in enumerate(zip(single, batch))
+                  if not same(*pair)]
+    if mismatched:
+        print '%d result(s) differ, first at sample %d' % (len(mismatched),
+                                                           mismatched[0])
+    else:
+        print 'results match'
+    return not mismatched
+
+
+if __name__ == '__main__':
+    default = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'plugins', 'bacon', 'Curves', 'intcal13.14c')
+    filename = sys.argv[1] if len(sys.argv) > 1 else default
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    sys.exit(0 if run(filename, samples, repeats) else 1)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""
+Times reading the cores in the repository set in config.py through their
+VirtualSamples, every attribute of every sample, against building a
+ColumnStore with all of its columns and reading them again once cached.
+Also shows the estimated memory used by the loaded samples and how much a
+full set of columns adds on top of that (a ColumnStore is a snapshot kept
+beside the samples, not a replacement for them). Nothing is written back
+to the database.
+
+usage: columnbenchmark.py [repeats] [core name ...]
+"""
+
+import sys
+import time
+
+from cscience import datastore
+
+
+def time_plan(core, plan, repeats):
+    vcore = core.new_computation(plan)
+    atts = set()
+    for sample in vcore:
+        atts.update(sample.sample_keys())
+    atts = sorted(atts)
+
+    start = time.time()
+    for index in range(repeats):
+        for sample in vcore:
+            for att in atts:
+                sample[att]
+    samples = (time.time() - start) / repeats
+
+    start = time.time()
+    for index in range(repeats):
+        #throw away the cached store, so it is built from scratch
+        core._columns.pop(plan, None)
+        store = core.columns(plan)
+        [store[att] for att in atts]
+    build = (time.time() - start) / repeats
+
+    start = time.time()
+    for index in range(repeats):
+        store = core.columns(plan)
+        [store[att] for att in atts]
+    cached = (time.time() - start) / repeats
+    return len(atts), samples, build, cached, store.nbytes
+
+def run(store, names, repeats):
+    totals = [0, 0, 0, 0, 0]
+    for name in names:
+        core = store.cores[name]
+        start = time.time()
+        count = len([depth for depth in core])
+        load = time.time() - start
+        size = core.memory_estimate()
+        print '%-30s %6d samples, loaded in %.4fs, ~%d bytes of samples' % (
+                    name, count, load, size)
+        totals[0] += count
+        totals[4] += size
+        for plan in sorted(core.cplans):
+            atts, samples, build, cached, nbytes = time_plan(core, plan,
+                                                             repeats)
+            print '    %-26s %4d atts  samples %8.4fs  columns %8.4fs  ' \
+                  'cached %8.4fs  +%d bytes of columns' % (plan, atts,
+                                            samples, build, cached, nbytes)
+            totals[1] += samples
+            totals[2] += build
+            totals[3] += nbytes
+        #don't let the whole repository pile up in memory
+        core.unload()
+    print 'total: %d samples, samples %.4fs, columns %.4fs, ' \
+          '~%d bytes of samples, +%d bytes of columns' % (totals[0],
+                                totals[1], totals[2], totals[4], totals[3])
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    store = datastore.Datastore()
+    store.load_from_config()
+    names = sys.argv[2:] or sorted(store.cores.keys())
+    run(store, names, repeats)
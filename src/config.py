@@ -10,6 +10,12 @@ installer_db_type = 'mongodb'
 installer_db_location = 'localhost'
 installer_db_port = 27018
 
+#how many cores may be fully loaded in memory at once, and roughly how many
+#megabytes they may use between them; least recently used cores with no
+#unsaved changes are dropped from memory past these limits
+core_cache_count = 8
+core_cache_mb = 512
+
 
 #location of plugins; relative locations are relative to
 #CScience/src
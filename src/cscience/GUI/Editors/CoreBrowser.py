@@ -28,7 +28,10 @@ CoreBrowser.py
 """
 
 import wx
+import multiprocessing
 import sys
+import threading
+import time
 import traceback
 import pymongo
 import wx.wizard
@@ -50,7 +53,9 @@ from cscience.GUI.Editors import AttEditor, MilieuBrowser, ComputationPlanBrowse
             FilterEditor, TemplateEditor, ViewEditor
 from cscience.GUI import grid, graph
 
-from cscience.framework import samples, Core, Sample, UncertainQuantity
+from cscience.framework import samples, Core, Sample, UncertainQuantity, \
+            RunMonitor, Cancelled, format_report
+from cscience.framework.profiling import Profile
 
 import cscience.framework.samples.coremetadata as mData
 
@@ -313,6 +318,9 @@ class CoreBrowser(wx.Frame):
         tool_menu.AppendSeparator()
         bind_editor('cplan_browser', ComputationPlanBrowser, "Computation Plan Browser\tCtrl-6",
                 "Browse Existing Computation Plans and Create New Computation Plans")
+        item = tool_menu.Append(wx.ID_ANY, "Computation Timings",
+                "Show how long each part of the last profiled computations took")
+        self.Bind(wx.EVT_MENU, self.show_profiles, item)
 
         help_menu = wx.Menu()
         item = help_menu.Append(wx.ID_ABOUT, "About CScience", "View Credits")
@@ -606,6 +614,24 @@ class CoreBrowser(wx.Frame):
             self.grid.PopupMenu(menu, click_event.GetPosition())
             menu.Destroy()
 
+    def show_profiles(self, event=None):
+        reports = []
+        if self.core is not None:
+            for plan in sorted(self.core.cplans):
+                profile = self.core['all'].get(plan, {}).get('Computation Profile')
+                if profile:
+                    reports.append('Plan "%s":\n%s' % (plan,
+                                        Profile.from_dict(profile).format()))
+        if not reports:
+            wx.MessageBox('No computations on this core have been profiled. '
+                          'Check "Record timings" when running a computation '
+                          'plan to profile it.', 'Computation Timings')
+            return
+        dlg = wx.lib.dialogs.ScrolledMessageDialog(self, '\n\n'.join(reports),
+                                                   "Computation Timings")
+        dlg.ShowModal()
+        dlg.Destroy()
+
     def show_about(self, event):
         dlg = AboutBox(self)
         dlg.ShowModal()
@@ -645,7 +671,7 @@ class CoreBrowser(wx.Frame):
         else:
             #TODO: select new core on import, & stuff.
             self.refresh_samples()
-        datastore.data_modified = True
+        datastore.mark_modified(event.changed, event.value)
         self.GetMenuBar().Enable(wx.ID_SAVE, True)
         event.Skip()
 
@@ -843,10 +869,16 @@ class CoreBrowser(wx.Frame):
         #ensure the selector shows the right core
         if not event and not self.selected_core.SetStringSelection(unicode(corename)):
             self.selected_core.SetSelection(0)
+        previous = self.core
         try:
             self.core = datastore.cores[self.selected_core.GetStringSelection()]
         except KeyError:
             self.core = None
+        #the core on display stays in memory, as the grid holds its samples
+        if self.core is not None:
+            datastore.cores.pin(self.core.name)
+        if previous is not None:
+            datastore.cores.unpin(previous.name)
         self.refresh_samples()
 
     def set_filter(self, filter_name):
@@ -898,6 +930,9 @@ class CoreBrowser(wx.Frame):
         dlg = ComputationDialog(self, self.core)
         ret = dlg.ShowModal()
         plan = dlg.plan
+        profile = Profile() if dlg.profile else None
+        force = dlg.recompute
+        threads = multiprocessing.cpu_count() if dlg.parallel else None
         # depths = dlg.depths
         dlg.Destroy()
         if ret != wx.ID_OK:
@@ -905,39 +940,108 @@ class CoreBrowser(wx.Frame):
         computation_plan = datastore.computation_plans[plan]
         workflow = datastore.workflows[computation_plan['workflow']]
         vcore = self.core.new_computation(plan)
-        self.SetCursor(wx.HOURGLASS_CURSOR)
 
-        #TODO: as workflows become more interactive, it becomes less and less
-        #sensible to perform all computation (possibly any computation) in its
-        #own thread, as we'll be continuing to demand user attention throughout
-
-        #leaving in some way to abort would be useful, so we should consider
-        #how to do that; the issue is that wxpython leaks memory when you try
-        #to construct windows in a new thread, which is yuck. So all of this
-        #should be reconsidered in light of interactive-type workflows.
-
-        #see http://stackoverflow.com/questions/13654559/how-to-thread-wxpython-progress-bar
-        #for some further information
-        #wx.lib.delayedresult.startWorker(self.OnDatingDone, workflow.execute,
-        #                          cargs=(plan, dialog),
-        #                          wargs=(computation_plan, vcore, aborting))
-
-        try:
-            workflow.execute(computation_plan, vcore)
-        except:
+        #the computation runs on its own thread so the window stays live; any
+        #dialogs components need are shown back on this thread (see
+        #cscience.GUI.interaction), and the progress dialog is app-modal so
+        #nothing else can touch the core while it's being worked on.
+        monitor = ComputationProgress(self, plan)
+        def work():
+            try:
+                report = workflow.execute(computation_plan, vcore,
+                                          threads=threads, force=force,
+                                          profile=profile, monitor=monitor)
+            except Cancelled:
+                wx.CallAfter(self.OnDatingDone, plan, monitor, profile,
+                             cancelled=True)
+            except:
+                wx.CallAfter(self.OnDatingDone, plan, monitor, profile,
+                             error=traceback.format_exc())
+            else:
+                wx.CallAfter(self.OnDatingDone, plan, monitor, profile,
+                             report=report)
+        worker = threading.Thread(target=work, name='Computation "%s"' % plan)
+        worker.daemon = True
+        worker.start()
+
+    def OnDatingDone(self, plan, monitor, profile, cancelled=False, error=None,
+                     report=None):
+        monitor.close()
+        #whatever did get computed is now in the core
+        events.post_change(self, 'samples')
+        if error:
             msg = "We're sorry, something went wrong while running that computation. " +\
                   "Please tell someone appropriate!\n\n\n\n\n\n\n******DEBUG******\n\n" + \
-                  traceback.format_exc()
+                  error
             dlg = wx.lib.dialogs.ScrolledMessageDialog(self, msg, "Computation Error")
             dlg.ShowModal()
-            raise
-        else:
-            events.post_change(self, 'samples')
-            self.filter = datastore.filters['Plan "%s"' % plan]
-            self.set_view('Data For "%s"' % plan)
+            dlg.Destroy()
+            return
 
-            wx.CallAfter(wx.MessageBox, "Computation finished successfully. "
-                                        "Results are now displayed in the main window.")
+        self.filter = datastore.filters['Plan "%s"' % plan]
+        self.set_view('Data For "%s"' % plan)
+        if cancelled:
+            wx.MessageBox("Computation cancelled. Any results computed before "
+                          "it stopped are displayed in the main window.")
+        else:
+            wx.MessageBox("Computation finished successfully. "
+                          "Results are now displayed in the main window.\n\n" +
+                          "\n".join(format_report(report or {})))
+            if profile:
+                self.show_profiles()
+
+class ComputationProgress(RunMonitor):
+    """
+    Shows the progress of a workflow run in a progress dialog with a cancel
+    button. Events come from the computation thread, so all updates to the
+    dialog are passed to the GUI thread with wx.CallAfter.
+    """
+    #dialog steps, and how often (in seconds) sample progress is shown
+    steps = 1000
+    interval = .1
+
+    def __init__(self, parent, plan):
+        super(ComputationProgress, self).__init__()
+        self.plan = plan
+        self.total = 1
+        self.done = 0
+        self.last_update = 0
+        self.dialog = wx.ProgressDialog('Running "%s"' % plan,
+                        'Preparing components...', self.steps, parent,
+                        wx.PD_APP_MODAL | wx.PD_CAN_ABORT | wx.PD_ELAPSED_TIME)
+
+    def started(self, names):
+        self.total = len(names) or 1
+
+    def component_started(self, name, samples):
+        self.post(0, '%s (%d samples)' % (name, samples))
+
+    def sample_progress(self, name, index, total):
+        now = time.time()
+        if now - self.last_update > self.interval:
+            self.last_update = now
+            self.post(float(index) / total, '%s: sample %d of %d' %
+                      (name, index + 1, total))
+
+    def component_finished(self, name, result):
+        self.done += 1
+        self.post(0, '%s finished' % name)
+
+    def post(self, fraction, message):
+        value = int(self.steps * (self.done + fraction) / self.total)
+        wx.CallAfter(self.update, min(value, self.steps - 1), message)
+
+    def update(self, value, message):
+        if self.dialog and not self.cancelled:
+            if not self.dialog.Update(value, message)[0]:
+                self.cancel()
+                self.dialog.Update(value, 'Cancelling; waiting for the '
+                                   'current step to stop...')
+
+    def close(self):
+        if self.dialog:
+            self.dialog.Destroy()
+            self.dialog = None
 
 class ComputationDialog(wx.Dialog):
 
@@ -965,8 +1069,18 @@ class ComputationDialog(wx.Dialog):
         sizer.Add(wx.StaticText(self, wx.ID_ANY, 'To Core "%s"' % self.core.name),
                   (1, 0), (1, 2))
         #sizer.Add(self.depthpicker, (2, 0), (1, 2), flag=wx.EXPAND)
-        sizer.Add(bsz, (3, 1), flag=wx.ALIGN_RIGHT)
-        sizer.AddGrowableRow(2)
+        self.recomputebox = wx.CheckBox(self, wx.ID_ANY,
+                                        "Recompute everything")
+        self.recomputebox.SetToolTip(wx.ToolTip("Run every step again, even "
+                                                "if its inputs haven't changed"))
+        sizer.Add(self.recomputebox, (2, 0), (1, 2))
+        self.parallelbox = wx.CheckBox(self, wx.ID_ANY,
+                                       "Run independent steps in parallel")
+        sizer.Add(self.parallelbox, (3, 0), (1, 2))
+        self.profilebox = wx.CheckBox(self, wx.ID_ANY, "Record timings")
+        sizer.Add(self.profilebox, (4, 0), (1, 2))
+        sizer.Add(bsz, (5, 1), flag=wx.ALIGN_RIGHT)
+        sizer.AddGrowableRow(4)
         sizer.AddGrowableCol(1)
         self.SetSizer(sizer)
         self.Center()
@@ -982,6 +1096,18 @@ class ComputationDialog(wx.Dialog):
     def plan(self):
         return self.planchoice.GetStringSelection()
 
+    @property
+    def profile(self):
+        return self.profilebox.GetValue()
+
+    @property
+    def recompute(self):
+        return self.recomputebox.GetValue()
+
+    @property
+    def parallel(self):
+        return self.parallelbox.GetValue()
+
 class AboutBox(wx.Dialog):
 
     about_text = '''<html>
@@ -0,0 +1,347 @@
+"""
+interaction.py
+
+* Copyright (c) 2006-2009, University of Colorado.
+* All rights reserved.
+*
+* Redistribution and use in source and binary forms, with or without
+* modification, are permitted provided that the following conditions are met:
+*     * Redistributions of source code must retain the above copyright
+*       notice, this list of conditions and the following disclaimer.
+*     * Redistributions in binary form must reproduce the above copyright
+*       notice, this list of conditions and the following disclaimer in the
+*       documentation and/or other materials provided with the distribution.
+*     * Neither the name of the University of Colorado nor the
+*       names of its contributors may be used to endorse or promote products
+*       derived from this software without specific prior written permission.
+*
+* THIS SOFTWARE IS PROVIDED BY THE UNIVERSITY OF COLORADO ''AS IS'' AND ANY
+* EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+* WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+* DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF COLORADO BE LIABLE FOR ANY
+* DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+* (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+* LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+* ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+* (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+* SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Dialogs used by workflow components to ask the user for input while a
+computation is running, and the interaction handler that shows them. These
+live here, rather than with the components, so components can run without wx.
+"""
+
+import sys
+import threading
+
+import wx
+import quantities
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_wxagg import FigureCanvasWxAgg
+try:
+    from mpl_toolkits.basemap import Basemap
+except ImportError:
+    #without basemap (and the coastlines that come with it), maps are drawn
+    #as a plain latitude/longitude grid
+    Basemap = None
+
+from cscience.framework.samples import UncertainQuantity
+
+
+def on_gui_thread(func, *args, **kwargs):
+    """
+    Calls func on the GUI thread and returns its result; from any other
+    thread, waits until the GUI thread has gotten around to it. wx windows
+    must only be created on the GUI thread.
+    """
+    if wx.Thread_IsMain():
+        return func(*args, **kwargs)
+    done = threading.Event()
+    outcome = {}
+    def call():
+        try:
+            outcome['result'] = func(*args, **kwargs)
+        except:
+            outcome['error'] = sys.exc_info()
+        finally:
+            done.set()
+    wx.CallAfter(call)
+    #Event.wait with no timeout can't be interrupted in python 2
+    done.wait(1e9)
+    if 'error' in outcome:
+        error = outcome['error']
+        raise error[0], error[1], error[2]
+    return outcome['result']
+
+
+class WxInteraction(object):
+    """
+    Interaction handler (see cscience.components.set_interaction) that asks
+    the user for everything with modal dialogs. It can be used from a
+    computation running on another thread; the dialogs are always shown on
+    the GUI thread.
+    """
+
+    decided_by = 'user'
+
+    def ask(self, core, input_data):
+        return on_gui_thread(self._ask, core, input_data)
+
+    def approve(self, core, kind, details):
+        return on_gui_thread(self._approve, core, kind, details)
+
+    def _ask(self, core, input_data):
+        inputdlg = InputQuery(core, input_data)
+        result = {}
+        if inputdlg.ShowModal() == wx.ID_OK:
+            result = inputdlg.result
+        inputdlg.Destroy()
+        return result
+
+    def _approve(self, core, kind, details):
+        dlg = self.approval_dialogs[kind](**details)
+        try:
+            return dlg.ShowModal() == wx.ID_OK
+        finally:
+            dlg.Destroy()
+
+
+#TODO: better error checking!
+class InputQuery(wx.Dialog):
+    class BooleanInput(wx.RadioBox):
+        def __init__(self, parent):
+            super(InputQuery.BooleanInput, self).__init__(parent, wx.ID_ANY, label="",
+                                               choices=['Yes', 'No'])
+        def get_value(self):
+            #not, since we have No in the 1 position
+            return not self.GetSelection()
+
+    class StringInput(wx.TextCtrl):
+        def get_value(self):
+            return self.GetValue()
+
+    class NumericInput(wx.TextCtrl):
+        def __init__(self, parent, type_=float, unit=None, minmax=(None, None)):
+            super(InputQuery.NumericInput, self).__init__(parent, wx.ID_ANY)
+
+            self.type_ = type_
+            self.minmax = minmax
+            self.unit = unit
+            self.defval = 0
+            if minmax[0] and self.defval < minmax[0]:
+                self.defval = minmax[0]
+            if minmax[1] and self.defval > minmax[1]:
+                self.defval = minmax[1]
+            self.defval = str(self.defval)
+            self.SetValue(self.defval)
+            self.SetSelection(-1, -1)
+
+            self.Bind(wx.EVT_KILL_FOCUS, self.check_input)
+            self.Bind(wx.EVT_SET_FOCUS, self.highlight)
+
+        def show_error(self, err):
+            if err:
+                self.SetValue(self.defval)
+                self.SetBackgroundColour('red')
+                self.SetSelection(-1, -1)
+            else:
+                self.SetBackgroundColour('white')
+
+        def check_input(self, event):
+            try:
+                val = self.type_(self.GetValue())
+            except ValueError:
+                self.show_error(True)
+            else:
+                if self.minmax[0] is not None and val < self.minmax[0]:
+                    self.show_error(True)
+                elif self.minmax[1] is not None and val > self.minmax[1]:
+                    self.show_error(True)
+                else:
+                    self.show_error(False)
+
+            event.Skip()
+
+        def highlight(self, event):
+            #wait till all selections are actually finshed, then select
+            wx.CallAfter(self.SetSelection, -1, -1)
+            event.Skip()
+
+        def get_value(self):
+            val = self.type_(self.GetValue())
+            if self.unit:
+                return quantities.Quantity(val, self.unit)
+            else:
+                return val
+
+    class ErrorInput(wx.Panel):
+        def __init__(self, parent, type_=float, unit=None, minmax=(None, None)):
+            super(InputQuery.ErrorInput, self).__init__(parent, wx.ID_ANY)
+            self.main_input = InputQuery.NumericInput(self, type_, None, minmax)
+            self.err_input = InputQuery.NumericInput(self, type_)
+
+            self.unit = unit
+
+            sizer = wx.BoxSizer(wx.HORIZONTAL)
+            sizer.Add(self.main_input, flag=wx.EXPAND | wx.TOP | wx.BOTTOM | wx.RIGHT,
+                      border=2, proportion=1)
+            sizer.Add(wx.StaticText(self, label='+/-'), flag=wx.ALL, border=2)
+            sizer.Add(self.err_input, flag=wx.EXPAND | wx.TOP | wx.BOTTOM | wx.LEFT,
+                      border=2, proportion=1)
+            self.SetSizer(sizer)
+
+        def get_value(self):
+            return UncertainQuantity(self.main_input.get_value(), self.unit,
+                                     self.err_input.get_value())
+
+    class LabelledInput(wx.Panel):
+        def __init__(self, parent, label, control_type, params=[], extra={}):
+            super(InputQuery.LabelledInput, self).__init__(parent)
+
+            tooltip = extra.pop('helptip', '')
+            self.control = control_type(self, *params, **extra)
+            if tooltip:
+                self.control.SetToolTip(wx.ToolTip(tooltip))
+
+            sizer = wx.BoxSizer(wx.HORIZONTAL)
+            sizer.Add(wx.StaticText(self, label=label), flag=wx.ALL, border=2)
+            sizer.Add(self.control, flag=wx.EXPAND | wx.ALL, border=2, proportion=1)
+            if params[1]: #unit
+                sizer.Add(wx.StaticText(self, label=params[1]), flag=wx.ALL, border=2)
+            self.SetSizer(sizer)
+
+        def get_value(self):
+            return self.control.get_value()
+
+    def __init__(self, core, dataneeded):
+        #TODO: the sizing on these is really freaking annoying; I should get that
+        #fixed.
+        super(InputQuery, self).__init__(None, title='Please Provide Input', style=wx.CAPTION)
+
+        self.dataneeded = dataneeded
+        self.controls = {}
+
+        scrolledwindow = wx.ScrolledWindow(self)
+        sizer = wx.BoxSizer(wx.VERTICAL)
+
+        #TODO set control default values as appropriate from core
+        for details in self.dataneeded:
+            sizer.Add(self.create_control(details[0], details[1:], scrolledwindow),
+                      flag=wx.EXPAND | wx.ALL, border=3)
+
+        scrolledwindow.SetSizer(sizer)
+        scrolledwindow.SetScrollRate(20, 20)
+        scrolledwindow.EnableScrolling(True, True)
+
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        sizer.Add(scrolledwindow, flag=wx.EXPAND | wx.ALL, border=2, proportion=1)
+        sizer.Add(wx.Button(self, wx.ID_OK), flag=wx.CENTER|wx.TOP, border=5)
+        self.SetSizer(sizer)
+
+        scrolledwindow.Layout()
+        self.Centre()
+        self.Layout()
+
+    def create_control(self, name, details, parent):
+        attdata = details[0]
+        otherparms = details[1] if len(details) > 1 else {}
+        params = []
+        if attdata[0] == 'boolean':
+            ctrl = InputQuery.BooleanInput
+        elif attdata[0] == 'string':
+            ctrl = InputQuery.StringInput
+        else:
+            ctrl = InputQuery.ErrorInput if attdata[2] else InputQuery.NumericInput
+            type_ = int if attdata[0] == 'integer' else float
+            params = [type_, attdata[1]] #unit
+
+        ctrl = InputQuery.LabelledInput(parent, name, ctrl, params, otherparms)
+        self.controls[name] = ctrl
+        return ctrl
+
+    @property
+    def result(self):
+        return dict([(name, ctrl.get_value()) for name, ctrl in self.controls.items()])
+
+
+class ReservoirMapDialog(wx.Dialog):
+    """
+    A nice user-friendly map to show where the reservoir correction point
+    we're using from our database turns out to be. The map is drawn locally
+    (with coastlines, if basemap is installed), so it works offline and
+    doesn't wait on the network.
+    """
+
+    def __init__(self, core_loc, closest_data):
+        super(ReservoirMapDialog, self).__init__(
+                    None, title="Reservoir Location Map", style=wx.CAPTION)
+
+        sizer = wx.BoxSizer(wx.VERTICAL)
+        figure = Figure(figsize=(4.5, 3), facecolor=(0.9, 0.9, 0.9))
+        canvas = FigureCanvasWxAgg(self, wx.ID_ANY, figure)
+        self.draw_map(figure.add_axes([0.12, 0.1, 0.83, 0.85]), core_loc,
+                      (closest_data['Latitude'], closest_data['Longitude']))
+        sizer.Add(canvas, flag=wx.EXPAND | wx.ALL, border=0)
+
+        sizer.Add(wx.StaticText(self, label="Selected Reservoir Coordinates: "
+                                "{0}, {1}".format(closest_data['Latitude'],
+                                                  closest_data['Longitude'])),
+                  flag=wx.EXPAND | wx.CENTER | wx.ALL, border=5)
+        label = "Reservoir Age: {0}, Error: {1}".format(closest_data['Delta R'],
+                                                        closest_data['Error'])
+        if closest_data.get('Points', 1) > 1:
+            label += " (weighted from {0} points)".format(closest_data['Points'])
+        sizer.Add(wx.StaticText(self, label=label),
+                  flag=wx.EXPAND | wx.CENTER | wx.ALL, border=5)
+
+        button_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        button_sizer.Add(wx.Button(self, wx.ID_CANCEL,
+                          label="Reject Selection (Input Manual Correction)"),
+                         flag=wx.CENTER | wx.ALL, border=5)
+        button_sizer.Add(wx.Button(self, wx.ID_OK, label="Accept Selection"),
+                         flag=wx.CENTER | wx.ALL, border=5)
+
+        sizer.Add(button_sizer, flag=wx.CENTER | wx.TOP, border=5)
+
+        self.SetSizer(sizer)
+        self.Fit()
+        self.Centre()
+
+    def draw_map(self, axes, core_loc, reservoir_loc):
+        lats = [core_loc[0], reservoir_loc[0]]
+        lngs = [core_loc[1], reservoir_loc[1]]
+        #keep both points on the same side of the date line
+        if lngs[1] - lngs[0] > 180:
+            lngs[1] -= 360
+        elif lngs[0] - lngs[1] > 180:
+            lngs[1] += 360
+        pad = max(abs(lats[1] - lats[0]), abs(lngs[1] - lngs[0]), 10)
+        south, north = max(min(lats) - pad, -90), min(max(lats) + pad, 90)
+        west, east = min(lngs) - pad, max(lngs) + pad
+
+        if Basemap is not None:
+            world = Basemap(projection='cyl', resolution='l', ax=axes,
+                            llcrnrlat=south, urcrnrlat=north,
+                            llcrnrlon=west, urcrnrlon=east)
+            world.drawcoastlines(linewidth=0.5)
+            world.fillcontinents(color=(0.8, 0.8, 0.75),
+                                 lake_color=(0.85, 0.9, 1))
+            world.drawmapboundary(fill_color=(0.85, 0.9, 1))
+        else:
+            axes.set_xlim(west, east)
+            axes.set_ylim(south, north)
+            axes.grid(True)
+        axes.set_xlabel('Longitude')
+        axes.set_ylabel('Latitude')
+
+        axes.plot(lngs[:1], lats[:1], 'o', color='blue',
+                  label='S = Sample Location')
+        axes.plot(lngs[1:], lats[1:], 'o', color='red',
+                  label='R = Reservoir Location')
+        for label, lng, lat in zip('SR', lngs, lats):
+            axes.annotate(label, (lng, lat), xytext=(4, 4),
+                          textcoords='offset points', weight='bold')
+        axes.legend(loc='best', numpoints=1, prop={'size':'small'})
+
+
+WxInteraction.approval_dialogs = {'reservoir location':ReservoirMapDialog}
@@ -1,4 +1,5 @@
 import cPickle
+import inspect
 import json
 import time
 import sys
@@ -75,6 +76,12 @@ class Table(object):
         return data
 
 class LargeTable(Table):
+    #Each item is saved as one JSON record per line, so files can be written
+    #and read a record at a time instead of all at once. Files saved before
+    #this format existed hold a single JSON list, and are still readable.
+    _fileformat = 'records'
+    #key of the item (if any) that should always be the first record in a file
+    _leading_key = None
     
     def __init__(self, connection, name):
         self.name = name
@@ -90,11 +97,8 @@ class LargeTable(Table):
     def savemany(self, items, *args, **kwargs):
         if not items:
             return
-        entries = []
-        for key, value in items:
-            val = value.copy()
-            val = self.keytransform(key, val)
-            entries.append(val)
+        if self._leading_key is not None:
+            items = sorted(items, key=lambda item: item[0] != self._leading_key)
             
         #TODO: can use the auto-versioning inherent in gridfs's functionality
         #to save older versions of a core, if we want...
@@ -106,14 +110,20 @@ class LargeTable(Table):
             self.fs.delete(oldversion._id)
         #TODO: does oldversion need to be closed?
         
+        newfile = self.fs.new_file(format=self._fileformat,
+                                   **{self._keyfield:kwargs['name']})
         try:
-            newfile = self.fs.new_file(**{self._keyfield:kwargs['name']})
-            
             #this is a little bit hackish but it lets me trivially apply the
             #same manipulations for son-ifying whether things are being stored
             #as a file or an actual document.
-            entries = CustomTransformations().transform_incoming_item(entries, None)
-            json.dump(entries, newfile)
+            transforms = CustomTransformations()
+            for key, value in items:
+                #transform_incoming hands back a copy, so the key can be
+                #added without touching the original
+                record = self.keytransform(key,
+                            transforms.transform_incoming(value, None))
+                newfile.write(json.dumps(record, separators=(',', ':')))
+                newfile.write('\n')
         except:
             print sys.exc_info()
             print traceback.format_exc()
@@ -121,19 +131,34 @@ class LargeTable(Table):
             newfile.close()
             
     def _load_many(self, value):
+        """
+        Generator over the saved records for value, decoding each one only as
+        it is read from the file.
+        """
         try:
             myfile = self.fs.get_last_version(**{self._keyfield:value.name})
         except gridfs.NoFile:
-            return []
+            return
         
+        #same as encoding hack above
+        transforms = CustomTransformations()
         try:
-            data = json.load(myfile)
-            #same as encoding hack above
-            data = CustomTransformations().transform_outgoing_item(data, None)
-            return data
+            if getattr(myfile, 'format', None) != self._fileformat:
+                for item in self._legacy_order(json.load(myfile)):
+                    yield transforms.transform_outgoing(item, None)
+                return
+            while True:
+                line = myfile.readline()
+                if not line:
+                    break
+                if line.strip():
+                    yield transforms.transform_outgoing(json.loads(line), None)
         finally:
             myfile.close()
 
+    def _legacy_order(self, entries):
+        return entries
+
 
 class MilieuTable(LargeTable):
     _filetype = 'milieu_files'
@@ -146,15 +171,14 @@ class MilieuTable(LargeTable):
         return value
 
     def iter_milieu_data(self, milieu):
-        entries = self._load_many(milieu)
-
-        for item in entries:
+        for item in self._load_many(milieu):
             key = tuple(item['_saved_milieu_key'])
             del item['_saved_milieu_key']
             yield key, item
 
 class CoreTable(LargeTable):
     _filetype = 'core_files'
+    _leading_key = 'all'
 
     def delete_item(self, key):
         try:
@@ -168,13 +192,14 @@ class CoreTable(LargeTable):
         value['_precise_sample_depth'] = unicode(key)
         return value
 
-    def iter_core_samples(self, core):
-        entries = self._load_many(core)
-        
-        #need to make sure all is first! (this does so hackily)
+    def _legacy_order(self, entries):
+        #older files weren't saved with 'all' first, so make sure it is.
+        #(this does so hackily)
         entries.sort(key=lambda item: item['_precise_sample_depth'], reverse=True)
-        
-        for item in entries:
+        return entries
+
+    def iter_core_samples(self, core):
+        for item in self._load_many(core):
             if item['_precise_sample_depth'] == 'all':
                 key = 'all'
             else:
@@ -198,132 +223,188 @@ class MapTable(Table):
     def delete_item(self, key):
         self.native_tbl.remove({self._keyfield:key})
 
-class InterpolatedFuncs(object):
-    def transform_item_in(self, value):
-        #TODO: this is gross and should be generalized, but I'm not totally
-        #sure how yet, so I'm handling the one case I have for now.
-        if value.__class__.__name__ == 'interp1d':
-            return {'_datatype':'interp1d',
-                   'kind':unicode(value._kind),
-                   'x':list(value.x),
-                   'y':list(value.y)}
-        elif value.__class__.__name__ == 'InterpolatedUnivariateSpline':
-            #grosssssssssssssssss; but this seems to be the best available way
-            #to save-and-restore our friend the spline :P
-            #(as I'm trying to avoid the whole pickle shizzle)
-            return {'_datatype':'InterpolatedUnivariateSpline',
-                    'x':list(value._data[0]),
-                    'y':list(value._data[1]),
-                    'k':int(value._eval_args[2])}
-        return value
-
-    def transform_dict_out(self, value):
-        if value.get('_datatype', None) == 'interp1d':
-            kind = value['kind']
-            if kind == 'spline':
-                kind = 'slinear'
-            return scipy.interpolate.interp1d(value['x'], value['y'], kind=kind,
-                                              bounds_error=False, fill_value=None)
-        elif value.get('_datatype', None) == 'InterpolatedUnivariateSpline':
-            try:
-                return scipy.interpolate.InterpolatedUnivariateSpline(
-                                    value['x'], value['y'], k=value['k'])
-            except:
-                print 'bypassed broken saved-spline...'
-                return 'ERROR'
-        return None
-
-class HandleQtys(object):
-    def handle_uncert_save(self, uncert):
-        if uncert.distribution:
-            return {'dist':unicode(cPickle.dumps(uncert.distribution))}
-        else:
-            if not uncert.magnitude:
-                return {}
-            return {'mag':[unicode(mag.magnitude) for mag in uncert.magnitude]}
-    def handle_uncert_load(self, value):
-        if 'dist' in value:
-            return cPickle.loads(str(value['dist']))
-        elif value:
-            if len(value['mag']) == 1:
-                return float(value['mag'][0])
-            else:
-                return [float(val) for val in value['mag']]
-        else:
-            return 0
-
-    def transform_item_in(self, value):
-        if hasattr(value, 'units'):
-            val = {'_datatype':'quantity',
-                   'magnitude':unicode(value.magnitude),
-                   'units':unicode(value.units.dimensionality)}
-            if hasattr(value, 'uncertainty'):
-                val['uncertainty'] = self.handle_uncert_save(value.uncertainty)
-            return val
-        return value
-
-    def transform_dict_out(self, value):
-        if value.get('_datatype', None) == 'quantity':
-            if 'uncertainty' in value:
-                return UncertainQuantity(value['magnitude'], value['units'],
-                                             self.handle_uncert_load(value['uncertainty']))
-            else:
-                return Quantity(value['magnitude'], value['units'])
-        return None
-    
-class TimeEncoder(object):
-    def transform_item_in(self, value):
-        if isinstance(value, time.struct_time):
-            return {'timeval':list(value)}
-        return value
-    def transform_dict_out(self, value):
-        if 'timeval' in value:
-            return time.struct_time(value['timeval'])
-        return None
-
 class CustomTransformations(pymongo.son_manipulator.SONManipulator):
+    """
+    Converts the stored types that JSON/BSON don't know about to and from
+    dicts tagged with a '_datatype' key.
+
+    Encoders are looked up by the type of each value (a subclass uses its
+    nearest registered base's encoder), and decoders by the '_datatype' tag,
+    so each value costs one dict lookup instead of a probe per transformer.
+    Both directions walk nested dicts and lists with an explicit stack
+    rather than recursion. Saving builds exactly one new copy of each
+    container (the originals are left alone); loading works in place, as the
+    data has just been read from the database.
+
+    New types are added with register_type.
+    """
+
+    encoders = {}
+    decoders = {}
+    #type -> encoder (or None), filled in as types are seen
+    _type_cache = {}
+
+    @classmethod
+    def register_type(cls, datatype, pytype, encode, decode):
+        """
+        Registers a new stored type. encode(value) is called for any instance
+        of pytype (or its subclasses) and should return a dict of JSON-friendly
+        values; '_datatype' is set on it automatically. decode(dict) should
+        return the original value from such a dict.
+        """
+        def tagged(value):
+            encoded = encode(value)
+            encoded['_datatype'] = datatype
+            return encoded
+        cls.encoders[pytype] = tagged
+        cls.decoders[datatype] = decode
+        cls._type_cache.clear()
+
+    @classmethod
+    def encoder_for(cls, pytype):
+        try:
+            return cls._type_cache[pytype]
+        except KeyError:
+            encoder = None
+            for base in inspect.getmro(pytype):
+                if base in cls.encoders:
+                    encoder = cls.encoders[base]
+                    break
+            cls._type_cache[pytype] = encoder
+            return encoder
 
-    def __init__(self):
-        self.transformers = [HandleQtys(), InterpolatedFuncs(), TimeEncoder()]
-        
     def will_copy(self):
         return True
 
-    def do_item_incoming(self, value):
-        for trans in self.transformers:
-            value = trans.transform_item_in(value)
+    def transform_incoming(self, son, collection):
+        result = {}
+        stack = [(son.iteritems(), result)]
+        while stack:
+            items, target = stack.pop()
+            for key, value in items:
+                #registered types come first, as some (struct_time) are
+                #also tuples
+                encoder = self.encoder_for(type(value))
+                if encoder:
+                    target[key] = encoder(value)
+                elif isinstance(value, dict):
+                    target[key] = {}
+                    stack.append((value.iteritems(), target[key]))
+                elif isinstance(value, (list, tuple)):
+                    target[key] = [None] * len(value)
+                    stack.append((enumerate(value), target[key]))
+                else:
+                    target[key] = value
+        return result
+
+    def decode_dict(self, value):
+        datatype = value.get('_datatype')
+        if datatype is not None:
+            decoder = self.decoders.get(datatype)
+            if decoder:
+                return decoder(value)
+        elif 'timeval' in value:
+            #times were saved untagged by older versions
+            return decode_time(value)
         return value
 
-    def transform_incoming_item(self, value, collection):
-        if isinstance(value, dict):
-            return self.transform_incoming(value, collection)
-        elif isinstance(value, list) or isinstance(value, tuple):
-            return [self.transform_incoming_item(item, collection) for item in value]
-        else:
-            return self.do_item_incoming(value)
-
-    def transform_incoming(self, son, collection):
-        son = son.copy()
-        for key, value in son.iteritems():
-            son[key] = self.transform_incoming_item(value, collection)
+    def transform_outgoing(self, son, collection):
+        stack = [son]
+        while stack:
+            container = stack.pop()
+            if isinstance(container, dict):
+                items = container.iteritems()
+            else:
+                items = enumerate(container)
+            #decoded values replace entries as we go, so look at a snapshot
+            for key, value in list(items):
+                if isinstance(value, dict):
+                    decoded = self.decode_dict(value)
+                    if decoded is value:
+                        stack.append(value)
+                    else:
+                        container[key] = decoded
+                elif isinstance(value, list):
+                    stack.append(value)
         return son
 
-    def do_item_outgoing(self, value, collection):
-        for trans in self.transformers:
-            val = trans.transform_dict_out(value)
-            if val:
-                return val
-        return self.transform_outgoing(value, collection)
-
-    def transform_outgoing_item(self, value, collection):
-        if isinstance(value, dict):
-            return self.do_item_outgoing(value, collection)
-        elif isinstance(value, list):
-            return [self.transform_outgoing_item(item, collection) for item in value]
-        else:
-            return value
 
-    def transform_outgoing(self, son, collection):
-        for key, value in son.iteritems():
-            son[key] = self.transform_outgoing_item(value, collection)
-        return son
+def encode_interp1d(value):
+    return {'kind':unicode(value._kind),
+            'x':list(value.x),
+            'y':list(value.y)}
+
+def decode_interp1d(value):
+    kind = value['kind']
+    if kind == 'spline':
+        kind = 'slinear'
+    return scipy.interpolate.interp1d(value['x'], value['y'], kind=kind,
+                                      bounds_error=False, fill_value=None)
+
+def encode_spline(value):
+    #grosssssssssssssssss; but this seems to be the best available way
+    #to save-and-restore our friend the spline :P
+    #(as I'm trying to avoid the whole pickle shizzle)
+    return {'x':list(value._data[0]),
+            'y':list(value._data[1]),
+            'k':int(value._eval_args[2])}
+
+def decode_spline(value):
+    try:
+        return scipy.interpolate.InterpolatedUnivariateSpline(
+                            value['x'], value['y'], k=value['k'])
+    except:
+        print 'bypassed broken saved-spline...'
+        return 'ERROR'
+
+def encode_uncertainty(uncert):
+    if uncert.distribution:
+        return {'dist':uncert.distribution.pack()}
+    else:
+        if not uncert.magnitude:
+            return {}
+        return {'mag':[unicode(mag.magnitude) for mag in uncert.magnitude]}
+
+def decode_uncertainty(value):
+    if 'dist' in value:
+        if isinstance(value['dist'], dict):
+            return c_calibration.Distribution.unpack(value['dist'])
+        #older repositories have pickled distributions
+        return cPickle.loads(str(value['dist']))
+    elif value:
+        if len(value['mag']) == 1:
+            return float(value['mag'][0])
+        else:
+            return [float(val) for val in value['mag']]
+    else:
+        return 0
+
+def encode_quantity(value):
+    val = {'magnitude':unicode(value.magnitude),
+           'units':unicode(value.units.dimensionality)}
+    if hasattr(value, 'uncertainty'):
+        val['uncertainty'] = encode_uncertainty(value.uncertainty)
+    return val
+
+def decode_quantity(value):
+    if 'uncertainty' in value:
+        return UncertainQuantity(value['magnitude'], value['units'],
+                                 decode_uncertainty(value['uncertainty']))
+    else:
+        return Quantity(value['magnitude'], value['units'])
+
+def encode_time(value):
+    return {'timeval':list(value)}
+
+def decode_time(value):
+    return time.struct_time(value['timeval'])
+
+CustomTransformations.register_type('quantity', Quantity,
+                                    encode_quantity, decode_quantity)
+CustomTransformations.register_type('interp1d', scipy.interpolate.interp1d,
+                                    encode_interp1d, decode_interp1d)
+CustomTransformations.register_type('InterpolatedUnivariateSpline',
+                                    scipy.interpolate.InterpolatedUnivariateSpline,
+                                    encode_spline, decode_spline)
+CustomTransformations.register_type('timeval', time.struct_time,
+                                    encode_time, decode_time)
@@ -0,0 +1,232 @@
+"""
+batch.py
+
+* Copyright (c) 2012-2015, University of Colorado.
+* All rights reserved.
+*
+* Redistribution and use in source and binary forms, with or without
+* modification, are permitted provided that the following conditions are met:
+*     * Redistributions of source code must retain the above copyright
+*       notice, this list of conditions and the following disclaimer.
+*     * Redistributions in binary form must reproduce the above copyright
+*       notice, this list of conditions and the following disclaimer in the
+*       documentation and/or other materials provided with the distribution.
+*     * Neither the name of the University of Colorado nor the
+*       names of its contributors may be used to endorse or promote products
+*       derived from this software without specific prior written permission.
+*
+* THIS SOFTWARE IS PROVIDED BY THE UNIVERSITY OF COLORADO ''AS IS'' AND ANY
+* EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+* WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+* DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF COLORADO BE LIABLE FOR ANY
+* DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+* (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+* LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+* ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+* (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+* SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+This module runs a computation plan over many cores at once, without the GUI.
+Each core is loaded, computed and saved in its own worker process, so one
+failing core doesn't stop (or corrupt) the rest of the batch. Workers only
+save the cores they work on; anything shared by the whole repository (such
+as the attributes the plan creates) is saved once, by run_batch, before
+they start.
+"""
+
+import multiprocessing
+import time
+import traceback
+
+import cscience.components
+from cscience import datastore
+from cscience.framework import format_report, summarize_report
+from cscience.framework.profiling import Profile, unmeasured
+
+
+class CoreResult(object):
+    """
+    What happened when running a computation plan on one core.
+    """
+
+    def __init__(self, core, plan):
+        self.core = core
+        self.plan = plan
+        self.ok = False
+        self.samples = 0
+        self.seconds = 0
+        self.error = None
+        #Profile.as_dict() of the run, if it was profiled
+        self.profile = None
+        #what Workflow.execute reported running and reusing
+        self.report = None
+
+    def __str__(self):
+        if self.ok:
+            return '%s: %d samples in %.2fs (%s)' % (self.core, self.samples,
+                                self.seconds, summarize_report(self.report))
+        return '%s: FAILED after %.2fs\n%s' % (self.core, self.seconds,
+                                               self.error)
+
+
+def _init_worker(interaction=None):
+    #each worker needs its own connection to the database; a database
+    #client can't be shared across a fork, so forget anything the parent
+    #had loaded (and connected) before making a new one
+    if interaction is not None:
+        cscience.components.set_interaction(interaction)
+    for model in datastore.Datastore.models.itervalues():
+        model._is_loaded = False
+    datastore.Datastore().load_from_config()
+
+def run_core(plan, corename, profile=False, force=False, threads=None):
+    """
+    Runs a computation plan on one core and saves the results. Any error is
+    caught and reported in the returned CoreResult; nothing is saved for a
+    core that fails. With profile set, the run is profiled (including
+    loading and saving the core, which aren't stored with the core's own
+    copy of the profile). With force set, results from earlier runs are not
+    reused; with threads, independent branches of the plan run at once on
+    that many threads (see Workflow.execute).
+    """
+    result = CoreResult(corename, plan)
+    start = time.time()
+    store = datastore.Datastore()
+    profile = Profile() if profile else None
+    measure = profile.measure if profile else unmeasured
+    core = plans = None
+    try:
+        computation_plan = store.computation_plans[plan]
+        workflow = store.workflows[computation_plan['workflow']]
+        core = store.cores[corename]
+        store.cores.pin(corename)
+        plans = set(core.cplans)
+        #make sure the whole core is in memory before we start working on it
+        with measure(corename, 'load') as event:
+            result.samples = event['samples'] = len([depth for depth in core])
+        result.report = workflow.execute(computation_plan,
+                                         core.new_computation(plan),
+                                         threads=threads, force=force,
+                                         profile=profile)
+        with measure(corename, 'save'):
+            store.cores.save_core(corename)
+    except Exception:
+        result.error = traceback.format_exc()
+        if core is not None:
+            #throw away whatever the failed run did to the core, or the
+            #next save (of the next core in this process) would write it
+            core.unload()
+            core.cplans = plans
+    else:
+        result.ok = True
+    finally:
+        if profile:
+            result.profile = profile.as_dict()
+        if core is not None:
+            store.cores.unpin(corename)
+        #free the core so a long-lived worker doesn't accumulate them
+        core = store.cores._data.get(corename)
+        if core is not None and core.loaded and not core.dirty:
+            core.unload()
+    result.seconds = time.time() - start
+    return result
+
+def _run_core_args(args):
+    return run_core(*args)
+
+def run_batch(plan, corenames, processes=None, progress=None,
+              interaction=None, profile=False, force=False, threads=None):
+    """
+    Runs the computation plan named plan on each of the named cores, using a
+    pool of processes worker processes (by default, one per CPU). If
+    processes is 0, everything runs in this process instead, which is mostly
+    useful for debugging and for comparing throughput.
+
+    progress, if given, is called as progress(done, total, result) as each
+    core finishes. interaction, if given, is the interaction handler
+    components use to ask for input (see cscience.components.set_interaction);
+    it must be picklable. With profile set, each CoreResult carries a
+    profile of its run; with force set, every component is run again on
+    every core. threads is passed on to run_core. Returns a BatchSummary.
+
+    The datastore must already be loaded in this process; worker processes
+    connect to the database afresh.
+    """
+    corenames = list(corenames)
+    summary = BatchSummary(plan, processes)
+    #workers only save their own cores, so the attributes the plan adds are
+    #created and saved here, once
+    store = datastore.Datastore()
+    computation_plan = store.computation_plans[plan]
+    store.workflows[computation_plan['workflow']].create_attributes()
+    store.save_datastore()
+    jobs = [(plan, name, profile, force, threads) for name in corenames]
+    if processes == 0:
+        pool = None
+        if interaction is not None:
+            cscience.components.set_interaction(interaction)
+        results = (run_core(*job) for job in jobs)
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (interaction,))
+        results = pool.imap_unordered(_run_core_args, jobs)
+    try:
+        for result in results:
+            summary.add(result)
+            if progress:
+                progress(len(summary.results), len(jobs), result)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    summary.finish()
+    return summary
+
+
+class BatchSummary(object):
+    """
+    Results and throughput of a run_batch call.
+    """
+
+    def __init__(self, plan, processes):
+        self.plan = plan
+        self.processes = processes
+        self.results = []
+        self.start = time.time()
+        self.seconds = 0
+
+    def add(self, result):
+        self.results.append(result)
+
+    def finish(self):
+        self.seconds = time.time() - self.start
+
+    @property
+    def failures(self):
+        return [result for result in self.results if not result.ok]
+
+    def report(self):
+        done = [result for result in self.results if result.ok]
+        samples = sum([result.samples for result in done])
+        workers = self.processes
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        lines = ['Plan "%s": %d of %d cores computed in %.2fs with %s' %
+                    (self.plan, len(done), len(self.results), self.seconds,
+                     '%d worker processes' % workers if workers
+                     else 'no worker processes')]
+        if self.seconds and done:
+            lines.append('throughput: %.2f cores/min, %.1f samples/s; '
+                         '%.2fs of work per core' % (
+                            60 * len(done) / self.seconds,
+                            samples / self.seconds,
+                            sum([result.seconds for result in done]) / len(done)))
+            reports = [result.report for result in done if result.report]
+            lines.append('samples run: %d, reused from earlier runs: %d' % (
+                sum([sum([part['ran'] for part in report.itervalues()])
+                     for report in reports]),
+                sum([sum([part['reused'] for part in report.itervalues()])
+                     for report in reports])))
+        for result in self.failures:
+            lines.append(str(result))
+        return '\n'.join(lines)
+
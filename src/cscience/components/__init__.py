@@ -2,11 +2,34 @@ import os
 import sys
 import config
 
-import wx
 import quantities
 
 library = {}
 
+#the current interaction handler; see set_interaction
+_interaction = None
+
+def set_interaction(handler):
+    """
+    Sets the object components use to ask for input while running. A handler
+    needs two methods:
+        ask(core, input_data) -> dict of answers, by input name
+        approve(core, kind, details) -> True or False
+    (see BaseComponent.user_inputs and user_approves), and may say who it
+    stands for as decided_by (recorded with approvals). By default, the user
+    is asked with wx dialogs.
+    """
+    global _interaction
+    _interaction = handler
+
+def get_interaction():
+    global _interaction
+    if _interaction is None:
+        #imported here so nothing loads wx unless it's actually going to be used
+        from cscience.GUI.interaction import WxInteraction
+        _interaction = WxInteraction()
+    return _interaction
+
 class _ComponentType(type):
     """
     Auto-registers any class extending BaseComponent (or another component type)
@@ -24,6 +47,14 @@ class BaseComponent(object):
 
     __metaclass__ = _ComponentType
 
+    #bump this whenever a change to a component would change its results, so
+    #results cached by Workflow.execute from older versions aren't reused
+    version = 0
+    #set on components whose result for each sample depends only on that
+    #sample (and core-wide values), so a re-run only has to compute samples
+    #whose inputs have changed
+    per_sample = False
+
     def __init__(self):
         self.connections = dict.fromkeys(self.output_ports())
         self.workflow = None
@@ -60,15 +91,36 @@ class BaseComponent(object):
                                   "or override __call__ method")
 
     def user_inputs(self, core, input_data):
+        """
+        Asks for values that aren't part of the data, such as model parameters.
+        input_data is a list of (name, (type, unit, has error)[, extra]), as
+        for attributes; extra is an optional dict of 'minmax' and 'helptip'.
+        The answers are stored in core['all'] and returned as a dict.
+        """
         #TODO: attributes?
-        inputdlg = InputQuery(core, input_data)
-        if inputdlg.ShowModal() == wx.ID_OK:
-            result = inputdlg.result
-            for name, input in result.iteritems():
-                core['all'][name] = input
-        inputdlg.Destroy()
+        #a component that asks anything is run again every time (see
+        #Workflow.execute), so the user gets to change their answers
+        core.interactive = True
+        result = get_interaction().ask(core, input_data)
+        for name, input in result.iteritems():
+            core['all'][name] = input
         return result
 
+    def user_approves(self, core, kind, **details):
+        """
+        Asks whether a choice the component made itself (of the given kind,
+        e.g. 'reservoir location') is acceptable; returns True if so. The
+        decision, and who made it, is kept in core['all']['Approvals'].
+        """
+        interaction = get_interaction()
+        core.interactive = True
+        approved = bool(interaction.approve(core, kind, details))
+        approvals = dict(core['all']['Approvals'] or {})
+        approvals[kind] = {'approved':approved,
+                           'by':getattr(interaction, 'decided_by', 'user')}
+        core['all']['Approvals'] = approvals
+        return approved
+
     def connect(self, component, name='output'):
         self.connections[name] = component.input_port()
 
@@ -101,161 +153,67 @@ class BaseComponent(object):
             return os.path.join(plugin_loc, plugin_name)
 
 
-#TODO: better error checking!
-class InputQuery(wx.Dialog):
-    class BooleanInput(wx.RadioBox):
-        def __init__(self, parent):
-            super(InputQuery.BooleanInput, self).__init__(parent, wx.ID_ANY, label="",
-                                               choices=['Yes', 'No'])
-        def get_value(self):
-            #not, since we have No in the 1 position
-            return not self.GetSelection()
-
-    class StringInput(wx.TextCtrl):
-        def get_value(self):
-            return self.GetValue()
-
-    class NumericInput(wx.TextCtrl):
-        def __init__(self, parent, type_=float, unit=None, minmax=(None, None)):
-            super(InputQuery.NumericInput, self).__init__(parent, wx.ID_ANY)
-
-            self.type_ = type_
-            self.minmax = minmax
-            self.unit = unit
-            self.defval = 0
-            if minmax[0] and self.defval < minmax[0]:
-                self.defval = minmax[0]
-            if minmax[1] and self.defval > minmax[1]:
-                self.defval = minmax[1]
-            self.defval = str(self.defval)
-            self.SetValue(self.defval)
-            self.SetSelection(-1, -1)
-
-            self.Bind(wx.EVT_KILL_FOCUS, self.check_input)
-            self.Bind(wx.EVT_SET_FOCUS, self.highlight)
-
-        def show_error(self, err):
-            if err:
-                self.SetValue(self.defval)
-                self.SetBackgroundColour('red')
-                self.SetSelection(-1, -1)
-            else:
-                self.SetBackgroundColour('white')
+class MissingInput(Exception):
+    pass
 
-        def check_input(self, event):
-            try:
-                val = self.type_(self.GetValue())
-            except ValueError:
-                self.show_error(True)
-            else:
-                if self.minmax[0] is not None and val < self.minmax[0]:
-                    self.show_error(True)
-                elif self.minmax[1] is not None and val > self.minmax[1]:
-                    self.show_error(True)
-                else:
-                    self.show_error(False)
-
-            event.Skip()
-
-        def highlight(self, event):
-            #wait till all selections are actually finshed, then select
-            wx.CallAfter(self.SetSelection, -1, -1)
-            event.Skip()
-
-        def get_value(self):
-            val = self.type_(self.GetValue())
-            if self.unit:
-                return quantities.Quantity(val, self.unit)
-            else:
-                return val
-
-    class ErrorInput(wx.Panel):
-        def __init__(self, parent, type_=float, unit=None, minmax=(None, None)):
-            super(InputQuery.ErrorInput, self).__init__(parent, wx.ID_ANY)
-            self.main_input = InputQuery.NumericInput(self, type_, None, minmax)
-            self.err_input = InputQuery.NumericInput(self, type_)
-
-            self.unit = unit
-
-            sizer = wx.BoxSizer(wx.HORIZONTAL)
-            sizer.Add(self.main_input, flag=wx.EXPAND | wx.TOP | wx.BOTTOM | wx.RIGHT,
-                      border=2, proportion=1)
-            sizer.Add(wx.StaticText(self, label='+/-'), flag=wx.ALL, border=2)
-            sizer.Add(self.err_input, flag=wx.EXPAND | wx.TOP | wx.BOTTOM | wx.LEFT,
-                      border=2, proportion=1)
-            self.SetSizer(sizer)
-
-        def get_value(self):
-            return UncertainQuantity(self.main_input.get_value(), self.unit,
-                                     self.err_input.get_value())
-
-    class LabelledInput(wx.Panel):
-        def __init__(self, parent, label, control_type, params=[], extra={}):
-            super(InputQuery.LabelledInput, self).__init__(parent)
-
-            tooltip = extra.pop('helptip', '')
-            self.control = control_type(self, *params, **extra)
-            if tooltip:
-                self.control.SetToolTip(wx.ToolTip(tooltip))
-
-            sizer = wx.BoxSizer(wx.HORIZONTAL)
-            sizer.Add(wx.StaticText(self, label=label), flag=wx.ALL, border=2)
-            sizer.Add(self.control, flag=wx.EXPAND | wx.ALL, border=2, proportion=1)
-            if params[1]: #unit
-                sizer.Add(wx.StaticText(self, label=params[1]), flag=wx.ALL, border=2)
-            self.SetSizer(sizer)
-
-        def get_value(self):
-            return self.control.get_value()
-
-    def __init__(self, core, dataneeded):
-        #TODO: the sizing on these is really freaking annoying; I should get that
-        #fixed.
-        super(InputQuery, self).__init__(None, title='Please Provide Input', style=wx.CAPTION)
-
-        self.dataneeded = dataneeded
-        self.controls = {}
-
-        scrolledwindow = wx.ScrolledWindow(self)
-        sizer = wx.BoxSizer(wx.VERTICAL)
-
-        #TODO set control default values as appropriate from core
-        for details in self.dataneeded:
-            sizer.Add(self.create_control(details[0], details[1:], scrolledwindow),
-                      flag=wx.EXPAND | wx.ALL, border=3)
-
-        scrolledwindow.SetSizer(sizer)
-        scrolledwindow.SetScrollRate(20, 20)
-        scrolledwindow.EnableScrolling(True, True)
-
-        sizer = wx.BoxSizer(wx.VERTICAL)
-        sizer.Add(scrolledwindow, flag=wx.EXPAND | wx.ALL, border=2, proportion=1)
-        sizer.Add(wx.Button(self, wx.ID_OK), flag=wx.CENTER|wx.TOP, border=5)
-        self.SetSizer(sizer)
-
-        scrolledwindow.Layout()
-        self.Centre()
-        self.Layout()
-
-    def create_control(self, name, details, parent):
-        attdata = details[0]
-        otherparms = details[1] if len(details) > 1 else {}
-        params = []
+class HeadlessInteraction(object):
+    """
+    Interaction handler for running without a user. Answers come from, in
+    order: the section for the core in question under 'cores' in params, the
+    rest of params, and values already stored in the core's 'all' sample.
+    Values are given as plain numbers (or strings, or booleans), or as
+    [value, error] for inputs that have an error. Choices a component asks
+    to have approved are accepted unless params['approvals'][kind] is false;
+    no dialogs are ever shown.
+
+    params is the dict loaded from a JSON parameter file, for example:
+        {"Ice Thickness": 3000,
+         "cores": {"ODP 1234": {"Reservoir Correction": [400, 50]}},
+         "approvals": {"reservoir location": false}}
+    """
+
+    decided_by = 'automatic'
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def lookup(self, core, name):
+        corename = core['all']['core']
+        for source in (self.params.get('cores', {}).get(corename, {}),
+                       self.params):
+            if name in source:
+                return source[name]
+        return core['all'][name]
+
+    def convert(self, value, attdata):
+        if isinstance(value, quantities.Quantity):
+            return value
         if attdata[0] == 'boolean':
-            ctrl = InputQuery.BooleanInput
+            return bool(value)
         elif attdata[0] == 'string':
-            ctrl = InputQuery.StringInput
-        else:
-            ctrl = InputQuery.ErrorInput if attdata[2] else InputQuery.NumericInput
-            type_ = int if attdata[0] == 'integer' else float
-            params = [type_, attdata[1]] #unit
-
-        ctrl = InputQuery.LabelledInput(parent, name, ctrl, params, otherparms)
-        self.controls[name] = ctrl
-        return ctrl
+            return unicode(value)
+        error = 0
+        if isinstance(value, (list, tuple)):
+            value, error = value
+        type_ = int if attdata[0] == 'integer' else float
+        if attdata[2]:
+            return UncertainQuantity(type_(value), attdata[1], error)
+        elif attdata[1]:
+            return quantities.Quantity(type_(value), attdata[1])
+        return type_(value)
+
+    def ask(self, core, input_data):
+        result = {}
+        for details in input_data:
+            name = details[0]
+            value = self.lookup(core, name)
+            if value is None:
+                raise MissingInput('No value given for "%s" for core %s' %
+                                   (name, core['all']['core']))
+            result[name] = self.convert(value, details[1])
+        return result
 
-    @property
-    def result(self):
-        return dict([(name, ctrl.get_value()) for name, ctrl in self.controls.items()])
+    def approve(self, core, kind, details):
+        return self.params.get('approvals', {}).get(kind, True)
 
 from cscience.framework.samples import UncertainQuantity
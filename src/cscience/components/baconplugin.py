@@ -6,13 +6,16 @@ import cscience
 import cscience.components
 from cscience.components import UncertainQuantity
 
-import csv
+import multiprocessing
+import os
+import sys
+import threading
+import time
 import warnings
 import numpy
 import scipy
 import scipy.interpolate
 import tempfile
-import operator
 import quantities
 
 warnings.filterwarnings("always",category=ImportWarning) # remove filter on ImportWarning
@@ -25,227 +28,771 @@ warnings.formatwarning = warning_on_one_line
 
 try:
     import cfiles.baconc
-except ImportError as ie:
-    print 'No BACON plugin available'
-    class BaconInterpolationHack(cscience.components.BaseComponent):
-        visible_name = 'Interpolate Using BACON'
-
-        def run_component(self, *args, **kwargs):
-            raise ie
+except ImportError:
+    warnings.warn('No BACON plugin available; BACON models will be made '
+                  'with the (slower) NumPy sampler', ImportWarning)
+    baconc = None
 else:
-    class BaconInterpolation(cscience.components.BaseComponent):
-        visible_name = 'Interpolate Using BACON'
-        inputs = {'required':('Calibrated 14C Age',)}
-        outputs = {'Model Age': ('float', 'years', True)}
-        citations = ['Bacon (Blaauw and Christen, 2011)']
-
-        def run_component(self, core):
-            #TODO: make sure to actually use the right units...
-            data = self.build_data_array(core)
-            memorya, memoryb = self.find_mem_params(core)
-            hiatusi = self.build_hiatus_array(core, data)
-
-            mindepth = data[0][3]
-            maxdepth = data[-1][3]
-            #minage = data[0][1] - (10 * data[0][2])
-            #maxage = data[-1][1] + (10 * data[-1][2])
-
-            guesses = numpy.round(numpy.random.normal(data[0][1], data[0][2], 2))
-            guesses.sort()
-            core['all']['BACON guess 1'] = guesses[0]
-            core['all']['BACON guess 2'] = guesses[1]
-
-            #section thickness is the expected granularity of change within the
-            #core. currently, we are using the default BACON parameter of 5 (cm);
-            #note that we can use a v large thickness to do a ballpark fast,
-            #and that BACON suggests limiting # of sections/core to between 10
-            #and 200.
-
-            #manual suggests for "larger" (>~2-3 m) cores, a good approach is
-            #to start thick very high (say, 50) and lower it until a "smooth
-            #enough" model is found.
-            thick = 5
-            sections = (maxdepth - mindepth) / thick
-            if sections < 10:
-                thick = min(self.prettynum((sections / 10.0) * thick))
-            elif sections > 200:
-                thick = max(self.prettynum((sections / 200.0) * thick))
-            core['all'].setdefault('BACON segment thickness', thick)
-            sections = int(numpy.ceil((maxdepth - mindepth) / thick))
-
-            #create a temporary file for BACON to write its output to, so as
-            #to read it back in later.
-            #for the curious, this is not in prepare() because we want a new
-            #file for every run of BACON, not every instance of this component.
-            self.tempfile = tempfile.NamedTemporaryFile()
-
-            #the size given is the # of (I think) accepted iterations that we
-            #want in our final output file. BACON defaults this to 2000, so that's
-            #what I'm using for now. Note the ability to tweak this value to
-            #do quick-and-dirty vs. "good" models
-
-            #minage & maxage are meant to indicate limits of calibration curves;
-            #just giving really big #s there is okay.
-            cfiles.baconc.run_simulation(len(data),
-                        [cfiles.baconc.PreCalDet(*sample) for sample in data],
-                        hiatusi, sections, memorya, memoryb,
-                        -1000, 1000000, guesses[0], guesses[1],
-                        mindepth, maxdepth, self.tempfile.name, 2000)
-            #I should do something here to clip the undesired burn-in off the
-            #front of the file (default ~200)
-
-            #for now, doing a lazy haxx where I'm just taking the trivial mean
-            #of each depth=point age and calling that the "model age" at that
-            #depth. Lots of interesting stuff here; plz consult a real statistician
-
-            #read in data output by bacon...
-            #print dir(self.tempfile)
-            #self.tempfile.open()
-            reader = csv.reader(self.tempfile, dialect='excel-tab', skipinitialspace=True)
-            truethick = float(maxdepth - mindepth) / sections
-            sums = [0] * (sections + 1)
-            total = 0
-
-            for it in reader:
-                if not it:
-                    continue
-                total += 1
-                #as read by csv, the bacon output file has an empty entry as its
-                #first column, so we ignore that. 1st real column is a special case,
-                #a set value instead of accumulation
-                cumage = float(it[1])
-                sums[0] += cumage
-                #last 2 cols are not acc rates; they are "w" and "U"; currently
-                #ignored, but related to it probability
-                for ind, acc in enumerate(it[2:-2]):
-                    cumage += truethick * float(acc)
-                    sums[ind+1] += cumage
-
-            sums = [sum / total for sum in sums]
-            self.tempfile.close()
-
-            #TODO: are these depths fiddled with at all in the alg? should I make
-            #sure to pass "pretty" ones?
-            core['all']['age/depth model'] = \
-                scipy.interpolate.InterpolatedUnivariateSpline(
-                        [mindepth + truethick*ind for ind in range(len(sums))],
-                        sums)
-
-            #output file as I understand it:
-            #something with hiatuses I need to work out.
-            #some number of rows of n columns. the last column is (?)
-
-            #the 1st column appears to be the "correct" age of the youngest
-            #point in the core
-            #following columns up to the last 2 cols, which I am ignoring, are the
-            #accepted *accumulation rate (years per cm)* for that segment of the core.
-
-        def build_data_array(self, core):
-            """
-            Extracts BACON-friendly data from our core samples.
-            """
-            data = []
-            #values for t dist; user can add for core or by sample,
-            # or we default to 3 & 4
-            #TODO: add error checking and/or AI setting on these
-            core['all'].setdefault('t.a', 3)
-            core['all'].setdefault('t.b', 4)
-            for sample in core:
-                id = str(sample['id'])
-                depth = float(sample['depth'].magnitude)
-                ta = sample['t.a']
-                tb = sample['t.b']
-
-                unitage = sample['Calibrated 14C Age']
-                age = float(unitage.rescale('years').magnitude)
-                #rescaling is currently not set up to work with uncerts. No idea
-                #what subtle bugs that might be causing. sigh.
-                uncert = float(unitage.uncertainty.as_single_mag())
-                ucurvex = getattr(unitage.uncertainty.distribution, 'x', [])
-                ucurvey = getattr(unitage.uncertainty.distribution, 'y', [])
-
-                data.append([id, age, uncert, depth, ta, tb, ucurvex, ucurvey])
-
-            data.sort(key=operator.itemgetter(3)) #sort by depth
-            return data
-
-        def build_hiatus_array(self, core, data):
-            """
-            Builds an array describing the hiatusi and associated expected
-            accumulation rates we'd like BACON to consider.
-            Currently a specifying no hiatus; more might want to
-            be added via AI *or* user input...
-            """
-            # accumulation rate is passed per-hiatus, with a dummy hiatus at
-            # the end of the array to pass the youngest such rate.
-            # We include one dummy hiatus at this time to pass the single
-            # accumulation rate for a core with no hiatus.
-
-            # accumulation shape is the degree to which accumulation rates cluster
-            # at the left (smaller) end of possible values; accumulation mean
-            # is the expected mean accumulation rate. Higher shape parameters
-            # will more strongly peak the distribution; means are suggested as
-            # round values.
-
-            # hiatus info is given as:
-            # expected depth
-            # accum. rate alpha (= accum shape)
-            # accum. rate beta (= accum shape/ accum mean)
-            # ha (= hiatus shape parameter)
-            # hb (= hiatus shape / hiatus mean)
-
-            # hiatuses are expected to be passed in *descending* order by depth,
-            # with a dummy hiatus last to give the last acc rate (think fencepost)
-
-            # hiatus shape default = 1; <1 is not advised as it will force
-            # hiatuses to never have 0 yr gaps (per manual)
-            # (changing shape parameter is usually not advised)
-            # hiatus mean is the mean expected # of years for the given hiatus
-
-            # find an expected acc. rate -- years/cm
-            avgrate = (data[-1][1] - data[0][1]) / (data[-1][3] - data[0][3])
-            core['all'].setdefault('accumulation rate mean', self.prettynum(avgrate)[0])
-            core['all'].setdefault('accumulation rate shape', 1.5)
-
-            accmean = core['all']['accumulation rate mean']
-            accshape = core['all']['accumulation rate shape']
-
-            #depth and hiatus shape are ignored for the top segment
-            top_hiatus = [-10, accshape, accshape/accmean, 0, 0]
-
-            #make sure the array is the right dimensions.
-            return numpy.array(zip(top_hiatus))
-
-        def find_mem_params(self, core):
-            #memorya and memoryb are calculated from "mean" and "strength" params as:
-            #a = strength*mean
-            #b = strength*(1-mean)
-            #BACON uses defaults of 4 for strength and .7 for mean; it does not
-            #appear to suggest other values for these variables.
-            #Per the BACON manual, we increase either value to assume
-            #more-constant accumulation rates. Increasing the mean will move the
-            #acceptable rate change distribution to the right (correlation between
-            #accumulation rates is higher); increasing the strength will give
-            #the distribution a higher peak (the correlation rate is more
-            #consistent with itself).
-            #for now, we use the defaults; in future, we should AI-ify things!
-            core['all'].setdefault('accumulation memory mean', .7)
-            core['all'].setdefault('accumulation memory strength', 4)
-
-            str = core['all']['accumulation memory strength']
-            mean = core['all']['accumulation memory mean']
-
-            memorya = str * mean
-            memoryb = str * (1-mean)
-
-            return (memorya, memoryb)
-
-        def prettynum(self, value):
-            guessmag = .1
-            while value / guessmag > 10:
-                guessmag *= 10
-            vals = numpy.array([1, 2, 5, 10]) * guessmag
-            #apparently numpy arrays don't have a key in their sort :P
-            vals = list(vals)
-            vals.sort(key=lambda x: abs(x-value))
-            return vals
+    baconc = cfiles.baconc
+
+#BACON writes this many rows of burn-in ahead of the samples asked for
+BACON_BURN_IN = 200
+
+def gelman_rubin(chains):
+    """
+    Potential scale reduction factor (R-hat) and effective sample size of each
+    column of a (chains, iterations, columns) array of draws. Chains are split
+    in half first, so a single chain still gets a meaningful R-hat; see
+    Gelman et al., Bayesian Data Analysis (3rd ed.), section 11.4-11.5.
+    """
+    half = chains.shape[1] // 2
+    split = numpy.concatenate([chains[:, :half], chains[:, half:2 * half]])
+    count = split.shape[0]
+    means = split.mean(axis=1)
+    within = split.var(axis=1, ddof=1).mean(axis=0)
+    between = half * means.var(axis=0, ddof=1)
+    pooled = (half - 1.0) / half * within + between / half
+
+    #autocorrelations via fft, averaged across chains
+    size = 2 ** int(numpy.ceil(numpy.log2(2 * half)))
+    spectrum = numpy.fft.rfft(split - means[:, numpy.newaxis], size, axis=1)
+    acov = numpy.fft.irfft(spectrum * spectrum.conjugate(), size,
+                           axis=1)[:, :half] / half
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        rhat = numpy.sqrt(pooled / within)
+        rho = 1 - (within - acov.mean(axis=0)) / pooled
+    #Geyer's initial positive sequence: sum autocorrelations in pairs, up to
+    #the first pair that sums to less than 0
+    pairs = rho[:half // 2 * 2].reshape(half // 2, 2, -1).sum(axis=1)
+    pairs *= numpy.cumprod(pairs > 0, axis=0)
+    tau = numpy.maximum(2 * pairs.sum(axis=0) - 1, 1)
+    ess = count * half / tau
+
+    #columns that never change are as converged as they are going to get
+    constant = ~(pooled > 0)
+    rhat[constant] = 1
+    ess[constant] = count * half
+    return rhat, ess
+
+def unit_scale(units, target):
+    """
+    Factor to multiply values in units (a dimensionality string, or None for
+    plain numbers) by to get them in target units.
+    """
+    if not units:
+        return 1.0
+    return float(quantities.Quantity(1.0, units).rescale(target).magnitude)
+
+def parse_depths(value):
+    """
+    Depths given as a number, a list of numbers, or a string of numbers
+    separated by commas and/or spaces, as a list of floats.
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return [float(depth) for depth in value.replace(',', ' ').split()]
+    if not hasattr(value, '__iter__'):
+        value = [value]
+    return [float(getattr(depth, 'magnitude', depth)) for depth in value]
+
+def can_fork():
+    """
+    Whether a process pool can be started from here. Pool workers can't
+    start processes of their own, and forking from a thread other than the
+    main one, or from a process running the wx GUI, isn't safe.
+    """
+    if multiprocessing.current_process().daemon:
+        return False
+    if not isinstance(threading.current_thread(), threading._MainThread):
+        return False
+    wx = sys.modules.get('wx')
+    return wx is None or wx.GetApp() is None
+
+def scratch_file():
+    """
+    A temporary file for BACON to write its output to. BACON can only write
+    to a named file, so where there's a RAM-backed file system (/dev/shm) it
+    goes there, and results never touch the disk; otherwise it's an ordinary
+    temporary file, and a warning says so.
+    """
+    shm = '/dev/shm'
+    if os.path.isdir(shm) and os.access(shm, os.W_OK):
+        return tempfile.NamedTemporaryFile(prefix='bacon', dir=shm)
+    warnings.warn('No writable %s; BACON output will go through a temporary '
+                  'file on disk in %s' % (shm, tempfile.gettempdir()))
+    return tempfile.NamedTemporaryFile(prefix='bacon')
+
+def read_output(outfile, sections, thick):
+    """
+    Reads a BACON output file into an (iterations, sections + 1) array of the
+    age at each section boundary.
+    """
+    #each row of the file is the age at the top of the core, then the
+    #accumulation rate (years per cm) of each section, then "w" and "U",
+    #which are related to iteration probability and not used here.
+    #the file is all numbers and whitespace, so it's parsed as text in one
+    #go rather than line by line.
+    with open(outfile, 'rb') as data:
+        values = numpy.fromstring(data.read(), sep=' ')
+    columns = sections + 3
+    rows = values[:len(values) // columns * columns].reshape(-1, columns)
+    return boundary_ages(rows[:, :sections + 1], thick)
+
+def boundary_ages(rows, thick):
+    """
+    Section boundary ages from rows of a top age followed by each section's
+    accumulation rate.
+    """
+    ages = rows * 1.0
+    ages[:, 1:] *= thick
+    return ages.cumsum(axis=1)
+
+def ages_at(ages, boundaries, depths):
+    """
+    Ages of each iteration at the given depths, from the section boundary
+    ages of each iteration (as from read_output, at depths boundaries);
+    ages are linear between boundaries. Returns an (iterations, depths)
+    array.
+    """
+    thick = boundaries[1] - boundaries[0]
+    sections = len(boundaries) - 1
+    position = numpy.clip((depths - boundaries[0]) / thick, 0, sections)
+    index = numpy.minimum(position.astype(int), sections - 1)
+    frac = position - index
+    return ages[:, index] * (1 - frac) + ages[:, index + 1] * frac
+
+class AgeDepthSampler(object):
+    """
+    Pure NumPy version of the BACON age/depth model, for when the compiled
+    plugin isn't available. The model is the same as BACON's (with the
+    normal, rather than t, likelihood, as cfiles.baconc uses): the age at the
+    top of the core, then an accumulation rate (years per cm) for each
+    section, with each rate remembering a fraction w of the one below it,
+    except across a hiatus.
+
+    Rather than BACON's t-walk, it runs a differential evolution ensemble
+    (ter Braak & Vrugt, 2008, with randomized subspaces) on the log of the
+    rates and logit of w, so a whole set of walkers is moved with a few
+    array operations at a time.
+    """
+
+    def __init__(self, data, hiatusi, sections, memorya, memoryb,
+                 minyr, maxyr, mindepth, maxdepth, rng=None):
+        self.rng = rng or numpy.random.RandomState()
+        self.sections = K = sections
+        self.top = mindepth
+        self.thick = float(maxdepth - mindepth) / sections
+        self.memorya = memorya
+        self.memoryb = memoryb
+        self.minyr = minyr
+        self.dim = K + 2
+
+        depths = numpy.array([row[3] for row in data], dtype=float)
+        self.ages = numpy.array([row[1] for row in data], dtype=float)
+        self.variance = numpy.array([row[2] for row in data], dtype=float) ** 2
+        #which section each date is in, and how far into it
+        self.index = numpy.clip(((depths - mindepth) / self.thick).astype(int),
+                                0, K - 1)
+        self.offset = depths - (mindepth + self.index * self.thick)
+        self.curves = [(row, numpy.asarray(data[row][6], dtype=float),
+                        numpy.asarray(data[row][7], dtype=float))
+                       for row in range(len(data)) if len(data[row][6])]
+        self.normal = numpy.array([not len(row[6]) for row in data])
+
+        #hiatusi as given to BACON: depths (deepest first), then accumulation
+        #shape and rate, then hiatus shape and rate, with a dummy last.
+        hiatusi = numpy.asarray(hiatusi, dtype=float)
+        hdepths = hiatusi[0][:-1]
+        self.alpha, self.beta = hiatusi[1], hiatusi[2]
+        self.ha, self.hb = hiatusi[3], hiatusi[4]
+        #work out which sections have a hiatus (and forget the rate below),
+        #and which set of priors the others use, as BACON does
+        self.jump = numpy.zeros(K + 1, dtype=bool)
+        self.prior = numpy.zeros(K + 1, dtype=int)
+        hiatus = 0
+        for k in range(K - 1, 0, -1):
+            if hiatus < len(hdepths) and \
+               self.top + (k - 1) * self.thick < hdepths[hiatus] <= \
+               self.top + k * self.thick:
+                self.jump[k] = True
+                self.prior[k] = hiatus
+                hiatus += 1
+            else:
+                self.prior[k] = hiatus
+        inner = numpy.arange(1, K)
+        self.memorial = inner[~self.jump[1:K]]
+        self.jumps = inner[self.jump[1:K]]
+
+    def energy(self, x):
+        """
+        BACON's energy (-log of the posterior, up to a constant) of each row
+        of x, where a row is the top age, the K accumulation rates and w.
+        Rows outside the model's support get infinity.
+        """
+        K = self.sections
+        w = x[:, K + 1]
+        rates = x[:, 1:K + 1]
+        with numpy.errstate(all='ignore'):
+            innovations = (x[:, self.memorial] -
+                           w[:, numpy.newaxis] * x[:, self.memorial + 1]) / \
+                          (1 - w[:, numpy.newaxis])
+            valid = (w > 0) & (w < 1) & (x[:, K] > 0) & \
+                    (x[:, 0] >= self.minyr) & (innovations > 0).all(axis=1) & \
+                    (x[:, self.jumps] > 0).all(axis=1)
+
+            theta = numpy.empty((len(x), K + 1))
+            theta[:, 0] = x[:, 0]
+            theta[:, 1:] = x[:, :1] + self.thick * numpy.cumsum(rates, axis=1)
+            modelled = theta[:, self.index] + x[:, self.index + 1] * self.offset
+
+            energy = (0.5 * (self.ages - modelled) ** 2 /
+                      self.variance)[:, self.normal].sum(axis=1)
+            for row, years, probs in self.curves:
+                ages = modelled[:, row]
+                inside = (ages >= years[0]) & (ages <= years[-1])
+                energy += numpy.where(inside,
+                                -numpy.log(numpy.interp(ages, years, probs)), 500)
+
+            power = 1.0 / self.thick
+            energy += power * (1 - self.memorya) * numpy.log(w) + \
+                      (1 - self.memoryb) * numpy.log(1 - w ** power)
+            energy += (1 - self.alpha[0]) * numpy.log(x[:, K]) + \
+                      self.beta[0] * x[:, K]
+            prior = self.prior[self.memorial]
+            energy += ((1 - self.alpha[prior]) * numpy.log(innovations) +
+                       self.beta[prior] * innovations).sum(axis=1)
+            prior = self.prior[self.jumps]
+            energy += ((1 - self.ha[prior]) * numpy.log(x[:, self.jumps]) +
+                       self.hb[prior] * self.thick * x[:, self.jumps]).sum(axis=1)
+        energy[~valid | numpy.isnan(energy)] = numpy.inf
+        return energy
+
+    def to_model(self, z):
+        """
+        Model parameters from the sampler's unconstrained ones.
+        """
+        x = numpy.empty_like(z)
+        x[:, 0] = z[:, 0]
+        with numpy.errstate(over='ignore'):
+            x[:, 1:-1] = numpy.exp(z[:, 1:-1])
+            x[:, -1] = 1 / (1 + numpy.exp(-z[:, -1]))
+        return x
+
+    def log_density(self, z):
+        """
+        Log posterior density of unconstrained parameters z, and the
+        energy of the model parameters they stand for.
+        """
+        energy = self.energy(self.to_model(z))
+        jacobian = z[:, 1:-1].sum(axis=1) - \
+                   numpy.logaddexp(0, z[:, -1]) - numpy.logaddexp(0, -z[:, -1])
+        return jacobian - energy, energy
+
+    def initial(self, count, guesses):
+        """
+        Draws count starting points from the prior, as BACON does, with top
+        ages between the two guesses.
+        """
+        K = self.sections
+        rng = self.rng
+        x = numpy.empty((count, self.dim))
+        low, high = min(guesses), max(guesses)
+        x[:, 0] = rng.uniform(low, high + 1, count)
+        w = x[:, K + 1] = rng.beta(self.memorya, self.memoryb, count)
+        x[:, K] = rng.gamma(self.alpha[-1], 1.0 / self.beta[-1], count)
+        for k in range(K - 1, 0, -1):
+            prior = self.prior[k]
+            if self.jump[k]:
+                x[:, k] = rng.gamma(self.ha[prior],
+                                    1.0 / (self.hb[prior] * self.thick), count)
+            else:
+                x[:, k] = w * x[:, k + 1] + (1 - w) * \
+                    rng.gamma(self.alpha[prior], 1.0 / self.beta[prior], count)
+        z = numpy.empty_like(x)
+        z[:, 0] = x[:, 0]
+        z[:, 1:-1] = numpy.log(x[:, 1:-1])
+        z[:, -1] = numpy.log(w / (1 - w))
+        return z
+
+    def step(self, z, density, energy):
+        """
+        Moves each half of the ensemble in turn, by differences between
+        members of the other half, over a random subset of the parameters.
+        z, density and energy are updated in place.
+        """
+        count = len(z)
+        rng = self.rng
+        halves = numpy.arange(count).reshape(2, -1)
+        for moving, other in (halves, halves[::-1]):
+            size = len(moving)
+            first = rng.randint(size, size=size)
+            second = other[(first + rng.randint(1, size, size=size)) % size]
+            first = other[first]
+            #change about 3 parameters on average, and always at least 1
+            mask = rng.uniform(size=(size, self.dim)) < 3.0 / self.dim
+            mask[numpy.arange(size), rng.randint(self.dim, size=size)] = True
+            scale = 2.38 / numpy.sqrt(2 * mask.sum(axis=1))
+            #every so often, try a jump of the full difference, to help
+            #walkers move between modes
+            scale[rng.uniform(size=size) < .1] = 1
+            move = scale[:, numpy.newaxis] * (z[first] - z[second]) + \
+                   1e-6 * rng.normal(size=(size, self.dim))
+            proposal = z[moving] + mask * move
+            newdensity, newenergy = self.log_density(proposal)
+            accept = numpy.log(rng.uniform(size=size)) < \
+                     newdensity - density[moving]
+            chosen = moving[accept]
+            z[chosen] = proposal[accept]
+            density[chosen] = newdensity[accept]
+            energy[chosen] = newenergy[accept]
+
+    def drop_outliers(self, z, density, energy):
+        """
+        Moves walkers stuck far below the rest of the ensemble onto other
+        walkers (as DREAM does while warming up), so they don't hold up
+        convergence.
+        """
+        low, high = numpy.percentile(density, [25, 75])
+        outliers = numpy.flatnonzero(density < low - 2 * (high - low))
+        if len(outliers):
+            good = numpy.flatnonzero(density >= low)
+            chosen = good[self.rng.randint(len(good), size=len(outliers))]
+            z[outliers] = z[chosen]
+            density[outliers] = density[chosen]
+            energy[outliers] = energy[chosen]
+
+    def run(self, guesses, rows, walkers=None, warmup=None, thin=None,
+            start=None):
+        """
+        Returns at least rows iterations, laid out as BACON's output is: the
+        top age, each section's accumulation rate, w, and the energy.
+        Iterations are taken from every walker every thin steps, after
+        warmup steps. There are at least twice as many walkers as
+        parameters, as differential evolution needs, and always an even
+        number, as the ensemble is moved in two halves.
+
+        The ensemble is left in self.state; passing that back as start
+        carries on from where this run finished, with no warmup.
+        """
+        thin = thin or max(10, self.dim // 2)
+        if start is None:
+            walkers = walkers or max(32, 2 * self.dim)
+            walkers += walkers % 2
+            warmup = thin * 50 if warmup is None else warmup
+            z = self.initial(walkers, guesses)
+        else:
+            z = numpy.array(start)
+            walkers = len(z)
+            warmup = 0
+        self.state = z
+        density, energy = self.log_density(z)
+        for it in range(warmup):
+            self.step(z, density, energy)
+            if it % thin == thin - 1:
+                self.drop_outliers(z, density, energy)
+        output = []
+        while len(output) * walkers < rows:
+            for it in range(thin):
+                self.step(z, density, energy)
+            output.append(numpy.column_stack([self.to_model(z), energy]))
+        return numpy.concatenate(output)[:rows]
+
+def run_chain(args):
+    """
+    Runs (a segment of) one BACON chain and returns samples section boundary
+    ages (see read_output) after burn-in, the seconds it took, and a state
+    to pass back in to extend the chain with another segment (None for the
+    first). This runs in pool worker processes, so it takes a tuple of
+    picklable arguments and builds the PreCalDets itself.
+
+    Without the compiled plugin, the chain is run by AgeDepthSampler, seeded
+    with seed, and a later segment carries straight on from the last. The
+    compiled plugin can't be given a seed or a starting state: it seeds
+    itself from the clock, in seconds, and a later segment is a fresh run
+    started from the chain's last top age, with its own burn-in. Chains
+    that use it are run one after another (see run_chains), so that each
+    starts in its own second.
+    """
+    (seed, state, data, hiatusi, sections, memorya, memoryb,
+     guesses, mindepth, maxdepth, samples, burnin) = args
+    thick = float(maxdepth - mindepth) / sections
+    if baconc is None:
+        start = time.time()
+        sampler = AgeDepthSampler(data, hiatusi, sections, memorya, memoryb,
+                                  -1000, 1000000, mindepth, maxdepth,
+                                  numpy.random.RandomState(seed))
+        if state is None:
+            rows = sampler.run(guesses, samples + burnin)[burnin:]
+        else:
+            rows = sampler.run(guesses, samples, start=state)
+        return (boundary_ages(rows[:, :sections + 1], thick),
+                time.time() - start, sampler.state)
+
+    if state is not None:
+        guesses = [state - 1, state + 1]
+    start = time.time()
+
+    #the size given is the # of (I think) accepted iterations that we
+    #want in our final output file.
+    #minage & maxage are meant to indicate limits of calibration curves;
+    #just giving really big #s there is okay.
+    outfile = scratch_file()
+    try:
+        baconc.run_simulation(len(data),
+                    [baconc.PreCalDet(*sample) for sample in data],
+                    hiatusi, sections, memorya, memoryb,
+                    -1000, 1000000, guesses[0], guesses[1],
+                    mindepth, maxdepth, outfile.name, samples + burnin)
+        ages = read_output(outfile.name, sections, thick)[burnin:]
+        return ages, time.time() - start, ages[-1][0]
+    finally:
+        outfile.close()
+
+class BaconInterpolation(cscience.components.BaseComponent):
+    visible_name = 'Interpolate Using BACON'
+    inputs = {'required':('Calibrated 14C Age',)}
+    outputs = {'Model Age': ('float', 'years', True)}
+    citations = ['Bacon (Blaauw and Christen, 2011)']
+    version = 4
+    #estimated seconds per unit of work (see estimate_seconds); updated
+    #from the timing of each run
+    step_seconds = 3e-7 if baconc is None else 2e-6
+
+    def run_component(self, core):
+        data = self.build_data_array(core)
+        memorya, memoryb = self.find_mem_params(core)
+
+        mindepth = data[0][3]
+        maxdepth = data[-1][3]
+        #minage = data[0][1] - (10 * data[0][2])
+        #maxage = data[-1][1] + (10 * data[-1][2])
+
+        #several chains can be run at once, from different starting
+        #guesses, to check the model has converged; when they're used,
+        #they start out short and are extended until they agree with each
+        #other (or reach the full number of samples).
+        #burn-in is the number of rows to drop from the front of each run,
+        #while BACON is still finding its way.
+        core['all'].setdefault('BACON chains', 1)
+        core['all'].setdefault('BACON samples', 2000)
+        core['all'].setdefault('BACON burn-in', 200)
+        core['all'].setdefault('BACON R-hat target', 1.05)
+        chains = max(int(core['all']['BACON chains']), 1)
+        samples = int(core['all']['BACON samples'])
+        burnin = int(core['all']['BACON burn-in'])
+        target = float(core['all']['BACON R-hat target'])
+
+        guesses = numpy.round(numpy.random.normal(data[0][1], data[0][2],
+                                                  (chains, 2)))
+        guesses.sort(axis=1)
+        core['all']['BACON guess 1'] = guesses[0][0]
+        core['all']['BACON guess 2'] = guesses[0][1]
+
+        core['all'].setdefault('BACON segment thickness',
+                    self.find_thickness(core, data, chains, samples))
+        thick = core['all']['BACON segment thickness']
+        sections = int(numpy.ceil((maxdepth - mindepth) / thick))
+        hiatusi = self.build_hiatus_array(core, data,
+                                          float(maxdepth - mindepth) / sections)
+
+        #each round extends every chain, doubling its length, so a run
+        #that converges early doesn't redo the work it has already done
+        length = samples if chains == 1 else max(samples // 4, 2)
+        chainages = [numpy.empty((0, sections + 1))] * chains
+        states = [None] * chains
+        while True:
+            seeds = numpy.random.randint(2 ** 31 - 1, size=chains)
+            results, seconds = self.run_chains([(seeds[index],
+                                     states[index], data, hiatusi,
+                                     sections, memorya, memoryb,
+                                     guesses[index], mindepth, maxdepth,
+                                     length, burnin)
+                                    for index in range(chains)])
+            #keep the timing model up to date with how fast this
+            #machine actually is
+            type(self).step_seconds = seconds / \
+                        self.work(sections, len(data), length + burnin)
+            chainages = [numpy.concatenate([old, new]) for old, (new, state)
+                         in zip(chainages, results)]
+            states = [state for new, state in results]
+            #chains should be the same length, but don't count on it
+            done = min([len(chain) for chain in chainages])
+            ages = numpy.array([chain[:done] for chain in chainages])
+            rhat, ess = gelman_rubin(ages)
+            if done >= samples or rhat.max() < target:
+                break
+            length = min(done, samples - done)
+
+        core['all']['BACON R-hat'] = float(rhat.max())
+        core['all']['BACON effective sample size'] = float(ess.min())
+        if rhat.max() >= target:
+            warnings.warn('BACON chains for %s did not converge '
+                          '(R-hat %.3f); consider more samples' %
+                          (core['all']['core'], rhat.max()))
+
+        #the model is the mean age at each section boundary; each sample
+        #also gets its mean age, with the spread of the middle
+        #'BACON interval' percent of iterations at its depth as the
+        #uncertainty.
+        ages = ages.reshape(-1, sections + 1)
+        truethick = float(maxdepth - mindepth) / sections
+        boundaries = mindepth + truethick * numpy.arange(sections + 1)
+        core['all'].setdefault('BACON interval', 95)
+        interval = float(core['all']['BACON interval'])
+
+        #TODO: are these depths fiddled with at all in the alg? should I make
+        #sure to pass "pretty" ones?
+        core['all']['age/depth model'] = \
+            scipy.interpolate.InterpolatedUnivariateSpline(
+                    boundaries, ages.mean(axis=0))
+
+        coresamples = list(core)
+        depths = numpy.array([row[3] for row in data])
+        atdepth = ages_at(ages, boundaries, depths)
+        means = atdepth.mean(axis=0)
+        lower, upper = numpy.percentile(atdepth, [50 - interval / 2.0,
+                                                  50 + interval / 2.0],
+                                        axis=0)
+        for sample, mean, low, high in zip(coresamples, means, lower, upper):
+            sample['Model Age'] = UncertainQuantity(mean, 'years',
+                                    [max(high - mean, 0), max(mean - low, 0)])
+
+        #output file as I understand it:
+        #something with hiatuses I need to work out.
+        #some number of rows of n columns. the last column is (?)
+
+        #the 1st column appears to be the "correct" age of the youngest
+        #point in the core
+        #following columns up to the last 2 cols, which I am ignoring, are the
+        #accepted *accumulation rate (years per cm)* for that segment of the core.
+
+    def run_chains(self, jobs):
+        """
+        Runs a set of BACON chains (see run_chain), in a process pool if
+        there's more than one, they're run by AgeDepthSampler, and a pool
+        can be started from here (see can_fork). Returns a list of
+        (ages, state) for each chain, and the average seconds each chain
+        took.
+
+        Chains run by the compiled plugin are always run here, one after
+        another, and none starts in the same second as the one before, as
+        it would get the same (clock) seed.
+        """
+        if len(jobs) > 1 and baconc is None and can_fork():
+            pool = multiprocessing.Pool(min(len(jobs),
+                                            multiprocessing.cpu_count()))
+            try:
+                results = pool.map(run_chain, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = []
+            for job in jobs:
+                if results and baconc is not None:
+                    time.sleep(max(started + 1 - time.time(), 0))
+                started = int(time.time())
+                results.append(run_chain(job))
+        return ([(result[0], result[2]) for result in results],
+                sum(result[1] for result in results) / len(results))
+
+    @staticmethod
+    def work(sections, dets, samples):
+        """
+        Relative amount of work in one BACON chain. BACON runs a number
+        of iterations proportional to the number of parameters (sections
+        + 2) times the rows it writes (samples + its fixed burn-in), and
+        each iteration looks at every section and every date.
+        """
+        return float(sections + 2) * (sections + dets) * \
+               (samples + BACON_BURN_IN)
+
+    def estimate_seconds(self, sections, dets, chains, samples):
+        """
+        Expected wall-clock time of a run, with chains run as in
+        run_chains. A run of several chains goes in up to three segments
+        (see run_component), each with its own burn-in.
+        """
+        if chains > 1:
+            samples += 2 * BACON_BURN_IN
+        if chains > 1 and baconc is None and can_fork():
+            waves = numpy.ceil(chains / float(multiprocessing.cpu_count()))
+        else:
+            waves = chains
+        return waves * self.step_seconds * \
+               self.work(sections, dets, samples)
+
+    def find_thickness(self, core, data, chains, samples):
+        """
+        Picks a section thickness (in cm). Section thickness is the
+        expected granularity of change within the core, and BACON
+        suggests limiting # of sections/core to between 10 and 200.
+
+        With no 'BACON time budget' (in seconds) this is BACON's default
+        of 5 cm, moved to keep within those limits. Given a budget, it's
+        the thinnest round thickness within the limits that the timing
+        model (see estimate_seconds) expects to finish in time, or the
+        thickest if none are.
+        """
+        #note that we can use a v large thickness to do a ballpark fast;
+        #manual suggests for "larger" (>~2-3 m) cores, a good approach is
+        #to start thick very high (say, 50) and lower it until a "smooth
+        #enough" model is found.
+        depthrange = data[-1][3] - data[0][3]
+        thick = 5
+        sections = depthrange / thick
+        if sections < 10:
+            thick = min(self.prettynum((sections / 10.0) * thick))
+        elif sections > 200:
+            thick = max(self.prettynum((sections / 200.0) * thick))
+
+        core['all'].setdefault('BACON time budget', 0)
+        budget = core['all']['BACON time budget']
+        if not budget:
+            return thick
+        candidates = [mult * 10 ** power for power in range(-2, 5)
+                      for mult in (1, 2, 5)
+                      if 10 <= depthrange / (mult * 10 ** power) <= 200]
+        for candidate in candidates:
+            sections = int(numpy.ceil(depthrange / candidate))
+            if self.estimate_seconds(sections, len(data),
+                                     chains, samples) <= budget:
+                return candidate
+        return candidates[-1] if candidates else thick
+
+    def build_data_array(self, core):
+        """
+        Extracts BACON-friendly data from our core samples: a list, in
+        depth order, of each sample's id, age and error (years), depth
+        (cm), t.a and t.b, and calibrated age distribution x and y.
+        The arrays are all built at once from the core's columns.
+        """
+        #values for t dist; user can add for core or by sample,
+        # or we default to 3 & 4
+        #TODO: add error checking and/or AI setting on these
+        core['all'].setdefault('t.a', 3)
+        core['all'].setdefault('t.b', 4)
+        store = core.columns()
+        rows = core.rows
+
+        ages = store['Calibrated 14C Age']
+        scale = unit_scale(ages.units, 'years')
+        age = ages.values[rows] * scale
+        uncert = ages.error[rows].mean(axis=1) * scale
+        depth = store['depth'].values[rows] * \
+                unit_scale(store['depth'].units, 'cm')
+        ids = [str(id) for id in store['id'].values[rows]]
+        ta = store['t.a'].values[rows]
+        tb = store['t.b'].values[rows]
+        if ages.distributions is None:
+            dists = [None] * len(rows)
+        else:
+            dists = ages.distributions[rows]
+        ucurvex = [getattr(dist, 'x', []) for dist in dists]
+        ucurvey = [getattr(dist, 'y', []) for dist in dists]
+
+        return [list(row) for row in zip(ids, age.tolist(), uncert.tolist(),
+                                         depth.tolist(), ta.tolist(),
+                                         tb.tolist(), ucurvex, ucurvey)]
+
+    def build_hiatus_array(self, core, data, thick):
+        """
+        Builds an array describing the hiatusi and associated expected
+        accumulation rates we'd like BACON to consider. Hiatuses are put
+        at the depths (cm) in 'hiatus depths', which may be set by the
+        user or come with the core's data; thick is the section thickness
+        the run will use, as BACON allows one hiatus per section.
+        """
+        # accumulation rate is passed per-hiatus, with a dummy hiatus at
+        # the end of the array to pass the youngest such rate; a core
+        # with no hiatus just gets the dummy. The same rate is used above
+        # and below every hiatus.
+
+        # accumulation shape is the degree to which accumulation rates cluster
+        # at the left (smaller) end of possible values; accumulation mean
+        # is the expected mean accumulation rate. Higher shape parameters
+        # will more strongly peak the distribution; means are suggested as
+        # round values.
+
+        # hiatus info is given as:
+        # expected depth
+        # accum. rate alpha (= accum shape)
+        # accum. rate beta (= accum shape/ accum mean)
+        # ha (= hiatus shape parameter)
+        # hb (= hiatus shape / hiatus mean)
+
+        # hiatuses are expected to be passed in *descending* order by depth,
+        # with a dummy hiatus last to give the last acc rate (think fencepost)
+
+        # hiatus shape default = 1; <1 is not advised as it will force
+        # hiatuses to never have 0 yr gaps (per manual)
+        # (changing shape parameter is usually not advised)
+        # hiatus mean is the mean expected # of years for the given hiatus
+
+        # find an expected acc. rate -- years/cm
+        avgrate = (data[-1][1] - data[0][1]) / (data[-1][3] - data[0][3])
+        core['all'].setdefault('accumulation rate mean', self.prettynum(avgrate)[0])
+        core['all'].setdefault('accumulation rate shape', 1.5)
+        core['all'].setdefault('hiatus length mean', 1000)
+        core['all'].setdefault('hiatus length shape', 1)
+
+        accmean = core['all']['accumulation rate mean']
+        accshape = core['all']['accumulation rate shape']
+        hmean = core['all']['hiatus length mean']
+        hshape = core['all']['hiatus length shape']
+
+        #BACON stops the whole process on hiatuses it doesn't like, so
+        #make sure they're inside the core and a section apart first
+        mindepth = data[0][3]
+        hiatusi = []
+        for depth in sorted(set(parse_depths(core['all']['hiatus depths'])),
+                            reverse=True):
+            limit = hiatusi[-1][0] if hiatusi else data[-1][3]
+            if mindepth < depth < limit - thick:
+                hiatusi.append([depth, accshape, accshape/accmean,
+                                hshape, hshape/hmean])
+            else:
+                warnings.warn('Ignoring hiatus at %s cm; hiatuses must be '
+                              'inside the core and at least one section '
+                              '(%s cm) apart' % (depth, thick))
+
+        #depth and hiatus shape are ignored for the top segment
+        hiatusi.append([-10, accshape, accshape/accmean, 0, 0])
+
+        #make sure the array is the right dimensions.
+        return numpy.array(zip(*hiatusi))
+
+    def find_mem_params(self, core):
+        #memorya and memoryb are calculated from "mean" and "strength" params as:
+        #a = strength*mean
+        #b = strength*(1-mean)
+        #BACON uses defaults of 4 for strength and .7 for mean; it does not
+        #appear to suggest other values for these variables.
+        #Per the BACON manual, we increase either value to assume
+        #more-constant accumulation rates. Increasing the mean will move the
+        #acceptable rate change distribution to the right (correlation between
+        #accumulation rates is higher); increasing the strength will give
+        #the distribution a higher peak (the correlation rate is more
+        #consistent with itself).
+        #for now, we use the defaults; in future, we should AI-ify things!
+        core['all'].setdefault('accumulation memory mean', .7)
+        core['all'].setdefault('accumulation memory strength', 4)
+
+        str = core['all']['accumulation memory strength']
+        mean = core['all']['accumulation memory mean']
+
+        memorya = str * mean
+        memoryb = str * (1-mean)
+
+        return (memorya, memoryb)
+
+    def prettynum(self, value):
+        guessmag = .1
+        while value / guessmag > 10:
+            guessmag *= 10
+        vals = numpy.array([1, 2, 5, 10]) * guessmag
+        #apparently numpy arrays don't have a key in their sort :P
+        vals = list(vals)
+        vals.sort(key=lambda x: abs(x-value))
+        return vals
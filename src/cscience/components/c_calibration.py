@@ -2,17 +2,67 @@ import cscience
 import cscience.components
 from cscience.components import UncertainQuantity
 
-import math
+import base64
 import numpy as np
-from scipy import interpolate, integrate
-import wx, wx.html
-import urllib2, httplib
+from scipy import interpolate, integrate, spatial
 
 THRESHOLD = .0000001
 
-class Distribution(object):
+def hdr_intervals(years, densities, mass):
+    """
+    Finds the highest density region(s) of a batch of distributions.
+
+    years and densities are sequences of 1-D arrays, one pair per
+    distribution; each distribution should be on a regular (e.g. annual) grid
+    and normalized so that summing it approximates integrating it. Returns,
+    for each distribution, the sorted list of disjoint (start, end) ranges of
+    years that together hold (just under) the requested probability mass.
+    Multimodal distributions will generally get more than one range.
+    """
+    count = len(densities)
+    width = max(len(dens) for dens in densities)
+    #pad everything out to one 2-D array so the whole batch is handled at once
+    padded = np.zeros((count, width))
+    valid = np.zeros((count, width), dtype=bool)
+    padded_years = np.zeros((count, width))
+    for row, (yrs, dens) in enumerate(zip(years, densities)):
+        padded[row, :len(dens)] = dens
+        valid[row, :len(dens)] = True
+        padded_years[row, :len(yrs)] = yrs
+
+    #the density threshold for each distribution is the smallest density we
+    #can include before the total mass reaches the requested amount
+    by_density = -np.sort(-padded, axis=1)
+    in_region = (np.cumsum(by_density, axis=1) < mass).sum(axis=1)
+    in_region = np.clip(in_region, 1, width)
+    threshold = by_density[np.arange(count), in_region - 1]
+    region = valid & (padded >= threshold[:, np.newaxis])
+
+    #contiguous runs of the region are the individual intervals
+    edges = np.diff(np.pad(region.astype(np.int8), ((0, 0), (1, 1)),
+                           'constant'), axis=1)
+    start_rows, start_cols = np.nonzero(edges == 1)
+    end_rows, end_cols = np.nonzero(edges == -1)
+
+    intervals = [[] for row in range(count)]
+    for row, start, end in zip(start_rows, start_cols, end_cols - 1):
+        intervals[row].append((padded_years[row, start],
+                               padded_years[row, end]))
+    return intervals
 
-    def __init__(self, years, density, avg, range):
+class Distribution(object):
+    """
+    Probability distribution of a calibrated age. The density is kept as
+    float32 on a regular grid described by start/step (the years themselves
+    are computed on demand as x); irregularly spaced distributions keep their
+    x values explicitly.
+    """
+
+    #list of (start, end) highest density regions; see hdr_intervals
+    intervals = None
+    _x = None
+
+    def __init__(self, years, density, avg, range, intervals=None):
         #trim out values w/ probability density small enough it might as well be 0.
         #note that these might want to be re-normalized, though the effect *should*
         #be essentially negligible
@@ -21,14 +71,10 @@ class Distribution(object):
         minvalid = 0
         maxvalid = len(years)
         #first, find the sets of indices where the values are ~0
-        for index, prob in enumerate(density):
-            if prob >= THRESHOLD:
-                minvalid = index
-                break
-        for index, prob in enumerate(reversed(density)):
-            if prob >= THRESHOLD:
-                maxvalid = len(years) - index
-                break
+        significant = np.flatnonzero(np.asarray(density) >= THRESHOLD)
+        if len(significant):
+            minvalid = significant[0]
+            maxvalid = significant[-1] + 1
 
         #make sure we have 0s at the ends of our "real" distribution for my
         #own personal sanity.
@@ -41,14 +87,89 @@ class Distribution(object):
 
         #TODO: do this as part of a component, and allow long tails (a smaller
         #threshold) on samples we are less confident in the goodness of
-        self.x = years[minvalid:maxvalid]
-        self.y = density[minvalid:maxvalid]
+        self.y = np.asarray(density[minvalid:maxvalid], dtype=np.float32)
+        self._set_grid(years[minvalid:maxvalid])
         self.average = avg
         self.error = (range[1]-avg, avg-range[0])
+        self.intervals = intervals
+
+    def _set_grid(self, x):
+        x = np.asarray(x, dtype=float)
+        self.start = float(x[0]) if len(x) else 0.
+        self.step = float(x[1] - x[0]) if len(x) > 1 else 1.
+        if len(x) > 2 and not np.allclose(np.diff(x), self.step):
+            self._x = x
+        else:
+            self._x = None
+
+    @property
+    def x(self):
+        if self._x is not None:
+            return self._x
+        return self.start + self.step * np.arange(len(self.y))
+
+    def downsample(self, step):
+        """
+        Returns a copy of this distribution re-gridded to the given (coarser)
+        step, renormalized so it still integrates to 1.
+        """
+        x = self.x
+        if step <= self.step or len(x) < 2:
+            return self
+        newx = np.arange(x[0], x[-1] + step, step)
+        newy = np.interp(newx, x, self.y)
+        newy /= np.trapz(newy, newx)
+
+        resampled = Distribution.__new__(Distribution)
+        resampled.__dict__.update(self.__dict__)
+        resampled.y = newy.astype(np.float32)
+        resampled._set_grid(newx)
+        return resampled
+
+    def pack(self):
+        """
+        Compact, JSON-friendly form of this distribution, used for storage.
+        Arrays are stored as base64-encoded little-endian binary.
+        """
+        packed = {'start':self.start, 'step':self.step, 'length':len(self.y),
+                  'density':base64.b64encode(self.y.astype('<f4').tostring()),
+                  'average':float(self.average),
+                  'error':[float(err) for err in self.error]}
+        if self._x is not None:
+            packed['x'] = base64.b64encode(self._x.astype('<f8').tostring())
+        if self.intervals is not None:
+            packed['intervals'] = [[float(start), float(end)] for start, end
+                                   in self.intervals]
+        return packed
+
+    @classmethod
+    def unpack(cls, packed):
+        """
+        Rebuilds a Distribution from the output of pack()
+        """
+        instance = cls.__new__(cls)
+        instance.y = np.frombuffer(base64.b64decode(packed['density']),
+                                   dtype='<f4')[:packed['length']]
+        instance.start = packed['start']
+        instance.step = packed['step']
+        if 'x' in packed:
+            instance._x = np.frombuffer(base64.b64decode(packed['x']),
+                                        dtype='<f8')
+        instance.average = packed['average']
+        instance.error = tuple(packed['error'])
+        if 'intervals' in packed:
+            instance.intervals = [tuple(interval) for interval
+                                  in packed['intervals']]
+        return instance
 
     def __setstate__(self, state):
         if 'x' in state:
-            self.__dict__ = state
+            #older format, with full x and y arrays
+            state = dict(state)
+            x = state.pop('x')
+            self.__dict__.update(state)
+            self.y = np.asarray(self.y, dtype=np.float32)
+            self._set_grid(x)
         else:
             try:
                 self.average = state[0]
@@ -56,19 +177,163 @@ class Distribution(object):
             except KeyError:
                 self.__dict__ = state
             except:
-                self.x = []
-                self.y = []
+                self.y = np.zeros(0, dtype=np.float32)
+                self._set_grid([])
                 self.average = 0
                 self.error = 0
 
+class CalibrationCurve(object):
+    """
+    Read-only, array-backed form of a calibration curve milieu. Built once per
+    milieu version (see Milieu.derived) and shared by every calibration
+    component and core in a session.
+
+    calib_age, c14_age, sigma and sigma_sq are correlated by index and sorted
+    by calibrated age; c14_order is the index order that sorts the curve by
+    14C age, and c14_sorted is the 14C age axis in that order, for windowed
+    lookup.
+    """
+
+    def __init__(self, milieu):
+        curve = [(r['Calibrated Age'], r['14C Age'], r['Sigma']) for r in
+                 milieu.itervalues()]
+        curve.sort()
+        self.calib_age, self.c14_age, self.sigma = map(np.array, zip(*curve))
+        self.sigma_sq = self.sigma ** 2.
+        self.sigma_max = self.sigma.max()
+        self.c14_order = np.argsort(self.c14_age, kind='mergesort')
+        self.c14_sorted = self.c14_age[self.c14_order]
+
+        for arr in (self.calib_age, self.c14_age, self.sigma, self.sigma_sq,
+                    self.c14_order, self.c14_sorted):
+            arr.flags.writeable = False
+
+    def __len__(self):
+        return len(self.calib_age)
+
+    def window(self, avgs, errors, k):
+        """
+        For each (avg, error) pair, finds the curve entries whose 14C age is
+        within k combined sigmas of avg, using a binary search on the 14C axis.
+        The combined sigma uses the largest curve sigma, so no entry within k
+        sigmas by its own sigma is left out.
+
+        Returns a flat array of curve indices (sorted by calibrated age within
+        each window), the position in avgs each index belongs to, and the
+        offsets that split the flat array into one window per pair.
+        """
+        halfwidth = k * np.sqrt(errors ** 2. + self.sigma_max ** 2.)
+        lo = np.searchsorted(self.c14_sorted, avgs - halfwidth, 'left')
+        hi = np.searchsorted(self.c14_sorted, avgs + halfwidth, 'right')
+        lengths = hi - lo
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        owner = np.repeat(np.arange(len(lengths)), lengths)
+        positions = np.arange(offsets[-1]) - offsets[owner] + lo[owner]
+        indices = self.c14_order[positions]
+        #put each window back in calibrated age order
+        indices = indices[np.lexsort((indices, owner))]
+        return indices, owner, offsets
+
+class ReservoirDatabase(object):
+    """
+    Read-only, indexed form of a reservoir database milieu, for finding the
+    points nearest a core. Built once per milieu version (see Milieu.derived),
+    so cores after the first don't pay for it.
+
+    Only points with both a Delta R and an Error are used. points holds their
+    milieu rows, correlated by index with delta_r and error; their positions
+    are kept as 3-D unit vectors in a k-d tree, where straight-line distance
+    maps directly to great circle distance.
+    """
+
+    #approx radius of earth in km
+    RADIUS = 6367
+
+    def __init__(self, milieu):
+        self.points = [val for val in milieu.itervalues() if
+                       val['Delta R'] is not None and val['Error'] is not None]
+        self.delta_r = np.array([float(val['Delta R']) for val in self.points])
+        self.error = np.array([float(np.mean(val['Error']))
+                               for val in self.points])
+        vectors = self.unit_vectors([val['Latitude'] for val in self.points],
+                                    [val['Longitude'] for val in self.points])
+        self.tree = spatial.cKDTree(vectors) if self.points else None
+
+    def __len__(self):
+        return len(self.points)
+
+    @staticmethod
+    def unit_vectors(lat, lng):
+        lat = np.radians(np.asarray(lat, dtype=float))
+        lng = np.radians(np.asarray(lng, dtype=float))
+        return np.column_stack([np.cos(lat) * np.cos(lng),
+                                np.cos(lat) * np.sin(lng), np.sin(lat)])
+
+    def to_km(self, chord):
+        return 2 * self.RADIUS * np.arcsin(np.minimum(chord / 2., 1))
+
+    def to_chord(self, km):
+        return 2 * np.sin(min(km / (2. * self.RADIUS), np.pi / 2))
+
+    def nearest(self, lat, lng, k=1, km=None):
+        """
+        The (up to) k points closest to (lat, lng), optionally only those
+        within km kilometers, as a list of (distance in km, index) pairs,
+        closest first.
+        """
+        if not self.points:
+            return []
+        bound = np.inf if km is None else self.to_chord(km) * (1 + 1e-9)
+        chords, indices = self.tree.query(self.unit_vectors([lat], [lng])[0],
+                                          min(k, len(self)),
+                                          distance_upper_bound=bound)
+        return [(float(self.to_km(chord)), int(index)) for chord, index in
+                zip(np.atleast_1d(chords), np.atleast_1d(indices))
+                if np.isfinite(chord)]
+
+    def within(self, lat, lng, km):
+        """
+        All points within km kilometers of (lat, lng), as a list of
+        (distance in km, index) pairs, closest first.
+        """
+        if not self.points:
+            return []
+        vector = self.unit_vectors([lat], [lng])[0]
+        indices = self.tree.query_ball_point(vector, self.to_chord(km))
+        chords = np.sqrt(((self.tree.data[indices] - vector) ** 2).sum(axis=1))
+        return sorted(zip(self.to_km(chords).tolist(), indices))
+
+    def weighted(self, neighbours, power=2):
+        """
+        Inverse distance weighted Delta R of a set of (distance, index)
+        pairs, as from nearest or within, and its error: the weighted spread
+        of the points' Delta R values and their own errors. A point at zero
+        distance is just used as-is.
+        """
+        distances, indices = map(np.array, zip(*neighbours))
+        if distances.min() == 0:
+            index = indices[distances.argmin()]
+            return self.delta_r[index], self.error[index]
+        weights = distances ** -float(power)
+        weights /= weights.sum()
+        delta_r = (weights * self.delta_r[indices]).sum()
+        spread = self.error[indices] ** 2 + (self.delta_r[indices] - delta_r) ** 2
+        return delta_r, np.sqrt((weights * spread).sum())
+
 class ReservoirCorrection(cscience.components.BaseComponent):
     visible_name = 'Reservoir Correction'
     inputs = {'required':('14C Age',)}
     outputs = {'Corrected 14C Age': ('float', 'years', True),
                'Reservoir Correction':('float', 'years', True)}
+    per_sample = True
 
     params = {'reservoir database':('Latitude', 'Longitude', 'Delta R', 'Error')}
 
+    def prepare(self, *args, **kwargs):
+        super(ReservoirCorrection, self).prepare(*args, **kwargs)
+        self.database = self.paleobase['reservoir database'].derived(
+                                                    ReservoirDatabase)
+
     def run_component(self, core):
         latlng = (core['all']['Latitude'], core['all']['Longitude'])
         if latlng[0] is None or latlng[1] is None:
@@ -78,133 +343,103 @@ class ReservoirCorrection(cscience.components.BaseComponent):
                                      {'minmax':(-180, 180), 'helptip':'+ for East, - for West'})])
             latlng = (core['all']['Latitude'], core['all']['Longitude'])
 
-        adj_point = self.get_closest_adjustment(*latlng)
-        dlg = ReservoirCorrection.MapDialog(latlng, adj_point)
-        if dlg.ShowModal() == wx.ID_OK:
+        #by default only the closest point is used; with more neighbours
+        #(optionally limited to those within a search radius, in km), Delta R
+        #is weighted by inverse distance
+        core['all'].setdefault('Reservoir Neighbours', 1)
+        neighbours = int(core['all']['Reservoir Neighbours'])
+        radius = core['all']['Reservoir Search Radius']
+        if neighbours > 1 or radius:
+            adj_point = self.get_weighted_adjustment(latlng[0], latlng[1],
+                                                     neighbours, radius)
+        else:
+            adj_point = self.get_closest_adjustment(*latlng)
+        if adj_point is not None and \
+           self.user_approves(core, 'reservoir location',
+                              core_loc=latlng, closest_data=adj_point):
             core['all']['Reservoir Correction'] = UncertainQuantity(adj_point.get('Delta R', 0), 'years',
                                                                     adj_point.get('Error', [0]))
         else:
             self.user_inputs(core, [('Reservoir Correction', ('float', 'years', True))])
-        dlg.Destroy()
 
         for sample in core:
             sample['Corrected 14C Age'] = sample['14C Age'] + (-sample['Reservoir Correction'])
 
     def get_closest_adjustment(self, core_lat, core_lng):
-        def haversine(lat1, lng1, lat2, lng2):
-            """
-            Calculate the great circle distance between two points
-            on the earth (inputs in decimal degrees)
-            """
-            lat1, lng1, lat2, lng2 = map(math.radians, [lat1, lng1, lat2, lng2])
-            a = math.sin((lat2-lat1)/2)**2 + math.cos(lat1) * \
-                math.cos(lat2) * math.sin((lng2-lng1)/2)**2
-            haver = 2 * math.asin(math.sqrt(a))
-
-            #6367 --> approx radius of earth in km
-            return 6367 * haver
-
-        distance = 50000 #max distance between 2 points on earth is ~20k km
-        closest_point = None
-
-        for val in self.paleobase['reservoir database'].itervalues():
-            if val['Delta R'] is not None and val['Error'] is not None:
-                new_distance = haversine(core_lat, core_lng,
-                                         val['Latitude'], val['Longitude'])
-                if new_distance < distance:
-                    distance = new_distance
-                    closest_point = val
-
-        return closest_point
-
-    class MapDialog(wx.Dialog):
+        closest = self.database.nearest(core_lat, core_lng)
+        if not closest:
+            return None
+        return self.database.points[closest[0][1]]
+
+    def get_weighted_adjustment(self, core_lat, core_lng, count, radius=None):
         """
-        A nice user-friendly map to show where the reservoir correction point
-        we're using from our database turns out to be
+        Delta R for a core from the count points nearest it (all of the
+        points within radius km of it, if count is 0 or less), weighted by
+        inverse distance. Returned like a database point, at the location of
+        the closest point used, with the number of points used.
         """
-        MAP_FORMAT = """<html xmlns="http://www.w3.org/1999/xhtml">
-            <img src="http://maps.googleapis.com/maps/api/staticmap?size=400x300&markers=color:blue|label:S|{0},{1}&markers=color:red|label:R|{2},{3}"
-            </img></html>"""
-
-        def __init__(self, core_loc, closest_data):
-            super(ReservoirCorrection.MapDialog, self).__init__(
-                        None, title="Reservoir Location Map", style=wx.CAPTION)
-
-            sizer = wx.BoxSizer(wx.VERTICAL)
-            try:
-                urllib2.urlopen('http://www.google.com', timeout=1)
-            except (urllib2.URLError, httplib.BadStatusLine) as err:
-                # No network connection, fallback to textual display (no map)
-                sizer.Add(wx.StaticText(self, label="Selected Reservoir Coordinates:"),
-                          flag=wx.EXPAND | wx.CENTER | wx.ALL, border=5)
-                sizer.Add(wx.StaticText(self, label="{0}, {1}".\
-                            format(closest_data['Latitude'], closest_data['Longitude'])),
-                          flag=wx.EXPAND | wx.CENTER | wx.ALL, border=5)
-                sizer.Add(wx.StaticText(self, label="Reservoir Age: {0}, Error: {1}".\
-                            format(self.closest_data['Delta R'], self.closest_data['Error'])),
-                          flag=wx.EXPAND | wx.CENTER | wx.ALL, border=5)
-            else:
-                #google works, anyway...
-                self.browser = wx.html.HtmlWindow(self, wx.ID_ANY, size=(400, 300))
-                sizer.Add(self.browser, flag=wx.EXPAND | wx.ALL, border=0)
-
-                h_sizer = wx.BoxSizer(wx.HORIZONTAL)
-                h_sizer.Add(wx.StaticText(self, label="R = Reservoir Location"),
-                            flag=wx.EXPAND | wx.CENTER | wx.ALL, border=5)
-                h_sizer.Add(wx.StaticText(self, label="S = Sample Location"),
-                            flag=wx.EXPAND | wx.CENTER | wx.ALL, border=5)
-                sizer.Add(h_sizer)
-
-                html_string = self.MAP_FORMAT.format(core_loc[0], core_loc[1],
-                                closest_data['Latitude'], closest_data['Longitude'])
-                self.browser.SetPage(html_string)
-
-            button_sizer = wx.BoxSizer(wx.HORIZONTAL)
-            button_sizer.Add(wx.Button(self, wx.ID_CANCEL,
-                              label="Reject Selection (Input Manual Correction)"),
-                             flag=wx.CENTER | wx.ALL, border=5)
-            button_sizer.Add(wx.Button(self, wx.ID_OK, label="Accept Selection"),
-                             flag=wx.CENTER | wx.ALL, border=5)
-
-            sizer.Add(button_sizer, flag=wx.CENTER | wx.TOP, border=5)
-
-            self.SetSizer(sizer)
-            self.Centre()
-            self.SetSize((420, 400))
+        if count > 0:
+            used = self.database.nearest(core_lat, core_lng, count, radius)
+        else:
+            used = self.database.within(core_lat, core_lng, radius)
+        if not used:
+            return None
+        delta_r, error = self.database.weighted(used)
+        closest = self.database.points[used[0][1]]
+        return {'Latitude':closest['Latitude'], 'Longitude':closest['Longitude'],
+                'Delta R':float(delta_r), 'Error':float(error),
+                'Points':len(used)}
 
 class IntCalCalibrator(cscience.components.BaseComponent):
     visible_name = 'Carbon 14 Calibration (CALIB Style)'
     inputs = {'required':('14C Age',), 'optional':('Corrected 14C Age',)}
     outputs = {'Calibrated 14C Age':('float', 'years', True)}
+    per_sample = True
 
     params = {'calibration curve':('14C Age', 'Calibrated Age', 'Sigma')}
 
+    #number of samples whose densities are evaluated together by convert_ages;
+    #bounds the size of the (samples x curve) array built at once.
+    BATCH_SIZE = 256
+    #densities are only evaluated for curve entries whose 14C age is within
+    #this many (combined) sigmas of the sample's 14C age; everything further
+    #out is negligible (exp(-50) at 10 sigma). Set to None to evaluate the
+    #entire curve for every sample.
+    window_sigmas = 10
+    #grid step (in years) of the stored calibrated distributions; 1 keeps
+    #them at full annual resolution, larger values make cores smaller.
+    distribution_resolution = 1
+
     def prepare(self, *args, **kwargs):
         super(IntCalCalibrator, self).prepare(*args, **kwargs)
 
-        #set up 3 lists, correlated by index, sorted by calibrated age, containing:
-        #calibrated age, carbon 14 age, sigma value
-        #from the configured calibration curve.
-        curve = [(r['Calibrated Age'], r['14C Age'], r['Sigma']) for r in
-                 self.paleobase['calibration curve'].itervalues()]
-        curve.sort()
-        self.calib_age_ref, self.c14_age, self.sigmas = map(np.array, zip(*curve))
+        #the parsed curve is cached on the milieu, so this is only slow the
+        #first time a given curve is used.
+        self.curve = self.paleobase['calibration curve'].derived(CalibrationCurve)
 
     def run_component(self, core):
         interval = 0.683
-        for sample in core:
-            try:
-                age = sample['Corrected 14C Age'] or sample['14C Age']
-                sample['Calibrated 14C Age'] = self.convert_age(age, interval)
-            except ValueError:
-                # sample out of bounds for interpolation range? we can just
-                # ignore that.
-                pass
+        samples = list(core)
+        ages = [sample['Corrected 14C Age'] or sample['14C Age']
+                for sample in samples]
+        for sample, cal_age in zip(samples, self.convert_ages(ages, interval)):
+            # samples out of bounds for the interpolation range come back as
+            # None; we can just ignore those.
+            if cal_age is not None:
+                sample['Calibrated 14C Age'] = cal_age
 
     # inputs: CAL BP and Sigma, output: un-normed probability density
-    def density(self, avg, error):
-        sigmasq = error ** 2. + self.sigmas ** 2.
-        exponent = -((self.c14_age - avg) ** 2.) / (2.*sigmasq)
+    # avg and error may also be column vectors, in which case the result is
+    # one row of density per entry. If indices is given, density is only
+    # evaluated at those curve entries.
+    def density(self, avg, error, indices=None):
+        c14_age = self.curve.c14_age
+        sigma_sq = self.curve.sigma_sq
+        if indices is not None:
+            c14_age = c14_age[indices]
+            sigma_sq = sigma_sq[indices]
+        sigmasq = error ** 2. + sigma_sq
+        exponent = -((c14_age - avg) ** 2.) / (2.*sigmasq)
         alpha = 1. / np.sqrt(2.*np.pi * sigmasq);
         return alpha * np.exp(exponent)
 
@@ -217,59 +452,114 @@ class IntCalCalibrator(cscience.components.BaseComponent):
         #Carbon 14 age provided by lab and standard deviation from intCal CSV.
         #This probability density is mapped to calibrated (true) ages and is
         #no longer normally (Gaussian) distributed or normalized.
-        unnormed_density = self.density(*age.unitless_normal())
+        avg, error = age.unitless_normal()
+        indices = None
+        if self.window_sigmas is not None:
+            indices = self.curve.window(np.array([avg]), np.array([error]),
+                                        self.window_sigmas)[0]
+        unnormed_density = self.density(avg, error, indices)
+        return self.make_ages([self.normalize_density(unnormed_density,
+                                                      indices)], interval)[0]
+
+    def convert_ages(self, ages, interval):
+        """
+        Batch version of convert_age; calibrates a whole list of 14C ages at
+        once. The densities for a block of samples are evaluated in a single
+        pass (over each sample's curve window, or as a 2-D array over the
+        whole curve if windowing is off), and the HDRs for the block are found
+        together, so the per-sample cost is only the (vectorized)
+        normalization and mean. Results are identical to calling convert_age
+        on each age; ages that cannot be calibrated come back as None.
+        """
+        results = []
+        for start in xrange(0, len(ages), self.BATCH_SIZE):
+            block = ages[start:start + self.BATCH_SIZE]
+            avgs, errors = map(np.array, zip(*[age.unitless_normal()
+                                               for age in block]))
+            normalized = []
+            for unnormed_density, indices in self.block_densities(avgs, errors):
+                try:
+                    normalized.append(self.normalize_density(unnormed_density,
+                                                             indices))
+                except ValueError:
+                    normalized.append(None)
+            cal_ages = iter(self.make_ages([norm for norm in normalized if norm],
+                                           interval))
+            results.extend([norm and next(cal_ages) for norm in normalized])
+        return results
+
+    def block_densities(self, avgs, errors):
+        """
+        Evaluates the densities for arrays of 14C ages and errors at once;
+        returns a list of (density, curve indices) pairs, one per age.
+        """
+        if self.window_sigmas is None:
+            densities = self.density(avgs[:, np.newaxis], errors[:, np.newaxis])
+            return [(row, None) for row in densities]
 
-        #unnormed_density is mostly zeros so need to remove but need to know years removed.
-        nz_ages = []
-        nz_density = []
+        indices, owner, offsets = self.curve.window(avgs, errors,
+                                                    self.window_sigmas)
+        densities = self.density(avgs[owner], errors[owner], indices)
+        return [(densities[lo:hi], indices[lo:hi]) for lo, hi in
+                zip(offsets[:-1], offsets[1:])]
 
-        for calage, dens in zip(self.calib_age_ref, unnormed_density):
-            if dens:
-                #TODO: should this be done in some more efficient way? probably
-                nz_ages.append(calage)
-                nz_density.append(dens)
+    def normalize_density(self, unnormed_density, indices=None):
+        """
+        Turns an un-normed density over the calibration curve (or over the
+        curve entries at indices) into a normalized density at annual
+        resolution. Returns (years, density, mean).
+        """
+        calib_age_ref = self.curve.calib_age
+        if indices is not None:
+            calib_age_ref = calib_age_ref[indices]
+        #unnormed_density is mostly zeros so need to remove but need to know years removed.
+        nonzero = unnormed_density != 0
+        calib_age_ref = calib_age_ref[nonzero]
+        unnormed_density = unnormed_density[nonzero]
+        if not len(calib_age_ref):
+            raise ValueError('14C age does not overlap the calibration curve')
 
-        calib_age_ref = np.array(nz_ages)
-        unnormed_density = np.array(nz_density)
         # interpolate unnormed density to annual resolution
-        annual_calib_ages = np.array(
-                    range(int(calib_age_ref[0]), int(calib_age_ref[-1]+1)))
+        annual_calib_ages = np.arange(int(calib_age_ref[0]),
+                                      int(calib_age_ref[-1]+1))
         unnormed_density = np.interp(annual_calib_ages,
                                      calib_age_ref, unnormed_density)
-        calib_age_ref = np.array(
-                    range(int(calib_age_ref[0]), int(calib_age_ref[-1]+1)))
+        calib_age_ref = annual_calib_ages
 
         #Calculate norm of density and then divide unnormed density to normalize.
         norm = integrate.simps(unnormed_density, calib_age_ref)
         normed_density = unnormed_density / norm
         #Calculate mean which is the "best" true age of the sample.
-
-        #this could be done vectorized instead of with a loop.
-        weighted_density = np.zeros(len(calib_age_ref))
-        for index, year in enumerate(calib_age_ref):
-            weighted_density[index] = year * normed_density[index]
+        weighted_density = calib_age_ref * normed_density
         mean = integrate.simps(weighted_density, calib_age_ref)
+        return (calib_age_ref, normed_density, mean)
 
+    def make_ages(self, normalized, interval):
+        """
+        Takes a list of (years, density, mean) as returned by normalize_density
+        and returns the matching list of calibrated ages, with Distributions
+        as their uncertainties.
+        """
+        if not normalized:
+            return []
+        years, densities, means = zip(*normalized)
         #The HDR is used to determine the error for the mean calculated above.
-        calib_age_error = self.hdr(normed_density, calib_age_ref, interval)
-        #TODO: these are at annual resolution; we could get by with 5-year
-        #no problem...
-        distr = Distribution(calib_age_ref, normed_density,
-                             mean, calib_age_error)
-
-        cal_age = cscience.components.UncertainQuantity(data=mean, units='years',
-                                                        uncertainty=distr)
-        return cal_age
+        all_intervals = hdr_intervals(years, densities, interval)
+
+        cal_ages = []
+        for calib_age_ref, normed_density, mean, intervals in \
+                zip(years, densities, means, all_intervals):
+            calib_age_error = (intervals[0][0], intervals[-1][1])
+            distr = Distribution(calib_age_ref, normed_density,
+                                 mean, calib_age_error, intervals)
+            distr = distr.downsample(self.distribution_resolution)
+            cal_ages.append(cscience.components.UncertainQuantity(
+                            data=mean, units='years', uncertainty=distr))
+        return cal_ages
 
     #calcuate highest density region
     def hdr(self, density, years, interval):
-        #Need to approximate integration by summation so need all years in range
-
-        yearly_pdensity = np.array([years, density])
-        yearly_pdensity = np.fliplr(yearly_pdensity[:,yearly_pdensity[1,:].argsort()])
-
-        summation_array = np.cumsum(yearly_pdensity[1,:])
-
-        index_of_win = np.searchsorted(summation_array, interval)
-        good_years = yearly_pdensity[0,:index_of_win]
-        return (min(good_years), max(good_years))
+        #overall range of the HDR; see hdr_intervals for the actual
+        #(possibly disjoint) regions
+        intervals = hdr_intervals([years], [density], interval)[0]
+        return (intervals[0][0], intervals[-1][1])
@@ -7,6 +7,7 @@ class DansgaardJohnsen(cscience.components.BaseComponent):
     visible_name = 'Dansgaard-Johnsen ice core flow model'
     inputs = {'required':('depth',)}
     outputs = {'Flow Model Age': ('float', 'kyears', True)}
+    per_sample = True
 
     def run_component(self, core):
         parameters = self.user_inputs(core,
@@ -78,6 +78,17 @@ class Datastore(object):
 
     component_library = cscience.components.library
 
+    #which model each kind of repository-changed event refers to
+    change_models = {'attributes':'sample_attributes',
+                     'cplans':'computation_plans',
+                     'filters':'filters',
+                     'milieus':'milieus',
+                     'templates':'templates',
+                     'template_fields':'templates',
+                     'views':'views',
+                     'view_atts':'views',
+                     'workflows':'workflows'}
+
     def __init__(self):
         self.__name__ = 'Datastore'
         #load up the component library, which doesn't depend on the data source.
@@ -106,6 +117,10 @@ class Datastore(object):
             backend_name = config.installer_db_type
             backend_loc = config.installer_db_location
 
+        framework.Cores.cache_count = getattr(config, 'core_cache_count',
+                                              framework.Cores.cache_count)
+        framework.Cores.cache_bytes = getattr(config, 'core_cache_mb',
+                            framework.Cores.cache_bytes / 2 ** 20) * 2 ** 20
 
         self.set_data_source(backend_name, backend_loc, backend_port)
 
@@ -122,10 +137,30 @@ class Datastore(object):
             setattr(self, model_name, model_class.load(self.database))
         self.data_modified = False
 
+    def mark_modified(self, changed, value=None):
+        """
+        Records that part of the repository was changed (with the same
+        arguments as a repository-changed event), so it will be saved.
+        """
+        self.data_modified = True
+        model_name = self.change_models.get(changed)
+        if model_name:
+            getattr(self, model_name).mark_updated(value)
+
     def save_datastore(self):
+        """
+        Saves everything that has changed since the last save. Returns a list
+        of (table name, keys written, seconds taken), one per write.
+        """
+        report = []
         for model_name in self.models:
-            getattr(self, model_name).save()
+            report.extend(getattr(self, model_name).save())
+        for table, keys, seconds in report:
+            logging.getLogger(__name__).info('saved %d record(s) to %s in '
+                '%.3fs: %s', len(keys), table, seconds,
+                ', '.join([unicode(key) for key in keys]))
         self.data_modified = False
+        return report
 
     class RepositoryException(Exception): pass
 
@@ -26,6 +26,8 @@ __init__.py
 * (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 * SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
+import time
+
 #TODO: this is really a metaclass!
 class Collection(object):
     """
@@ -44,11 +46,11 @@ class Collection(object):
         return instance
 
     def __init__(self, keyset):
-        #cached/memoized data that's already been loaded once.
-        #TODO: keep this cache a reasonable size when applicable!
+        #cached/memoized data that's already been loaded once. (Cores keeps
+        #its loaded cores to a bounded size; see Cores.cache_count)
         self._data = dict.fromkeys(tuple(keyset))
-        #keep a list of what keys have been updated to make saving operations
-        #more sane -- currently not used.
+        #keep a list of what keys have been updated, so saving only writes
+        #records that have actually changed.
         self._updated = set()
 
     def __contains__(self, name):
@@ -84,6 +86,17 @@ class Collection(object):
     def add(self, member):
         self[member.name] = member
 
+    def mark_updated(self, name=None):
+        """
+        Flags a record that was modified in place (rather than re-set) as
+        needing to be saved; with no name, flags every record in memory.
+        """
+        if name is None:
+            self._updated.update([key for key, value in self._data.iteritems()
+                                  if value is not None])
+        elif name in self._data:
+            self._updated.add(name)
+
     def get(self, name, default=None):
         try:
             return self[name]
@@ -119,11 +132,22 @@ class Collection(object):
         return cls([])
 
     def save(self, *args, **kwargs):
-        #TODO: only save actually changed records; for now, we're just resaving
-        #everything that's been in memory ever.
-        self._table.savemany([self.saveitem(key, value) for key, value in
-                              self._data.iteritems() if value is not None],
+        """
+        Writes all changed records to the database. Returns a list of
+        (table name, keys written, seconds taken) for each write done.
+        """
+        return self._save_records(self._updated, *args, **kwargs)
+
+    def _save_records(self, keys, *args, **kwargs):
+        keys = sorted([key for key in keys if self._data.get(key) is not None])
+        if not keys:
+            self._updated.clear()
+            return []
+        start = time.time()
+        self._table.savemany([self.saveitem(key, self._data[key]) for key in keys],
                              *args, **kwargs)
+        self._updated.difference_update(keys)
+        return [(self.tablename(), keys, time.time() - start)]
 
     @classmethod
     def load(cls, connection):
@@ -138,7 +162,8 @@ class Collection(object):
         return cls.instance
 
 from calculations import ComputationPlan, ComputationPlans, Workflow, \
-    Workflows, Selector, Selectors
+    Workflows, Selector, Selectors, RunMonitor, Cancelled, format_report, \
+    summarize_report
 from paleobase import Milieu, Milieus, Template, Templates
 from samples import Attribute, Attributes, Core, VirtualCore, Cores, Sample
 from samples import VirtualSample, UncertainQuantity, Uncertainty
@@ -28,19 +28,134 @@ workflows.py
 """
 
 import collections
+import cPickle
+import hashlib
 import itertools
+import Queue
 import re
+import sys
 import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
 
 import cscience.components
 import cscience.datastore
 from cscience.framework import Collection
+from cscience.framework.profiling import unmeasured
+from cscience.framework.samples import FilteredCore
 
 
 factor_exp = re.compile('<(.*?)>')
 def extract_factor(name):
     return factor_exp.search(name)[0]
 
+def stable_repr(value):
+    """
+    A string standing for value in fingerprints. Unlike repr, it includes the
+    uncertainty of quantities, covers all of an array rather than a
+    shortened version, and doesn't depend on where objects are in memory.
+    """
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join(['%s: %s' % (stable_repr(key), stable_repr(val))
+                                   for key, val in sorted(value.iteritems())])
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join([stable_repr(item) for item in value])
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            data = stable_repr(value.tolist())
+        else:
+            data = hashlib.sha1(np.ascontiguousarray(value).tostring()).hexdigest()
+        text = 'array(%s, %s, %s' % (value.dtype.str, value.shape, data)
+        if hasattr(value, 'dimensionality'):
+            text += ', ' + value.dimensionality.string
+        uncertainty = getattr(value, 'uncertainty', None)
+        if uncertainty is not None:
+            if uncertainty.distribution is not None:
+                text += ', ' + stable_repr(uncertainty.distribution)
+            else:
+                text += ', ' + stable_repr(uncertainty.magnitude)
+        return text + ')'
+    if value is None or isinstance(value, (basestring, bool, int, long, float)):
+        return repr(value)
+    try:
+        return 'pickle(%s)' % hashlib.sha1(cPickle.dumps(value, 2)).hexdigest()
+    except Exception:
+        return type(value).__name__
+
+def format_report(report):
+    """
+    Lines describing a report returned by Workflow.execute: for each
+    component, how many samples it ran on and how many results it reused.
+    """
+    lines = []
+    for name, result in sorted(report.iteritems()):
+        if result['seconds'] is None:
+            lines.append('%s: unchanged, reused all %d results' %
+                         (name, result['reused']))
+        else:
+            lines.append('%s: ran on %d samples in %.2fs, reused %d' %
+                         (name, result['ran'], result['seconds'],
+                          result['reused']))
+    return lines
+
+def summarize_report(report):
+    """
+    One line summing up a report returned by Workflow.execute.
+    """
+    skipped = len([result for result in report.itervalues()
+                   if result['seconds'] is None])
+    return '%d of %d components reused, %d samples run, %d reused' % (
+                skipped, len(report),
+                sum([result['ran'] for result in report.itervalues()]),
+                sum([result['reused'] for result in report.itervalues()]))
+
+class Cancelled(Exception):
+    """
+    Raised inside a workflow run once its RunMonitor has been cancelled.
+    """
+    pass
+
+class RunMonitor(object):
+    """
+    Receives progress events from Workflow.execute; the default does nothing
+    with them, so override whichever are wanted. Events are sent from
+    whichever thread is running the component in question.
+
+    Calling cancel (from any thread) stops the run, by raising Cancelled,
+    before the next component or the next sample a component asks for.
+    Results already computed are left in place.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def started(self, names):
+        """The run is starting, with these components, in order"""
+        pass
+
+    def component_started(self, name, samples):
+        pass
+
+    def sample_progress(self, name, index, total):
+        """Component name has been handed sample index (of total)"""
+        pass
+
+    def component_finished(self, name, result):
+        """
+        Component name is done; result is as returned by execute for the
+        component, or None if it was never reached.
+        """
+        pass
+
+
 class Workflow(object):
     """
     Defines a linkage between components, used to perform a series of
@@ -98,11 +213,7 @@ class Workflow(object):
         else:
             component = cscience.components.library[name]()
 
-        #add attributes not already created for great justice
-        for key, val in getattr(component, 'outputs', {}).iteritems():
-            if key not in cscience.datastore.Datastore().sample_attributes:
-                cscience.datastore.Datastore().sample_attributes.add_attribute(key,
-                                            val[0], val[1], True, val[2])
+        self.add_output_attributes(component)
         try:
             component.prepare(cscience.datastore.Datastore().milieus, self, experiment)
         except:
@@ -111,17 +222,37 @@ class Workflow(object):
             raise
         return component
 
+    def add_output_attributes(self, component):
+        #add attributes not already created for great justice
+        for key, val in getattr(component, 'outputs', {}).iteritems():
+            if key not in cscience.datastore.Datastore().sample_attributes:
+                cscience.datastore.Datastore().sample_attributes.add_attribute(key,
+                                            val[0], val[1], True, val[2])
+
+    def create_attributes(self):
+        """
+        Adds the attributes for the outputs of this workflow's components
+        (other than Factors, whose outputs depend on the experiment) to the
+        repository, as running the workflow would.
+        """
+        for name in self.connections:
+            if not name.startswith('Factor'):
+                self.add_output_attributes(cscience.components.library[name])
+
     def get_factors(self):
         factors = set([extract_factor(name) for name in self.connections
                        if name.startswith("Factor")])
         return list(factors)
 
-    def instantiate(self, experiment):
+    def instantiate(self, experiment, profile=None):
         # Load & prepare an instance of every component to be used in this
         # workflow instance. Note that Factors handle their own instantiation
         # of their instance components.
-        components = dict([(name, self.load_component(name, experiment))
-                           for name in self.connections])
+        measure = profile.measure if profile else unmeasured
+        components = {}
+        for name in self.connections:
+            with measure(name, 'prepare'):
+                components[name] = self.load_component(name, experiment)
         # Loop through all components and connect them up according to
         # the information stored in self.connections.
         for component_name in self.connections:
@@ -131,60 +262,297 @@ class Workflow(object):
         return components
 
     def create_apply(self, core):
-        def apply_component(component):
+        def apply_component(component, depths=None, on_sample=None,
+                            settings=None, views=None):
+            #each component only sees the samples that have all its
+            #required inputs
             req = getattr(component, 'inputs', {}).get('required', [])
-            core_iter = core.__class__.__iter__
-            def restricted_iter(self):
-                for sample in core_iter(core):
-                    if all(sample[key] is not None for key in req):
-                        yield sample
-            try:
-                #this is how we can override __iter__ on a class at runtime,
-                #apparently. See 
-                #http://stackoverflow.com/questions/11687653/method-overriding-by-monkey-patching
-                core.__class__.__iter__ = restricted_iter
-                return component(core)
-            finally:
-                #make sure __iter__ gets properly put back no matter what,
-                #silly girl.
-                core.__class__.__iter__ = core_iter
+            view = FilteredCore(core, req, depths, on_sample, settings)
+            if views is not None:
+                views.append(view)
+            return component(view)
         return apply_component
 
-    def execute(self, cplan, core):
+    def graph(self):
+        """
+        Returns (order, successors): the names of this workflow's components
+        in a topological order (every component after all the components
+        that feed it), and a dict of name -> set of the components it feeds.
+        """
+        successors = dict([(name, set(ports.values()) - set([None]))
+                           for name, ports in self.connections.iteritems()])
+        indegree = dict.fromkeys(successors, 0)
+        for targets in successors.itervalues():
+            for target in targets:
+                indegree[target] += 1
+        ready = collections.deque(sorted([name for name, count in
+                                          indegree.iteritems() if not count]))
+        order = []
+        while ready:
+            name = ready.popleft()
+            order.append(name)
+            for target in sorted(successors[name]):
+                indegree[target] -= 1
+                if not indegree[target]:
+                    ready.append(target)
+        if len(order) != len(successors):
+            raise ValueError('Workflow "%s" has a cycle' % self.name)
+        return order, successors
+
+    def shared_fingerprint(self, component, core, settings=()):
+        """
+        Digest of everything a component's results depend on besides its
+        per-sample inputs: which component it is (and its version), which
+        milieus it uses (and their versions), and the core-wide values in
+        core['all'] named in settings (with their uncertainties). For a
+        Selector, that's the mode chosen and each of the components it runs.
+        """
+        digest = hashlib.sha1()
+        parts = [component]
+        if isinstance(component, Selector):
+            digest.update('%s=%r;' % (component.name, component.mode))
+            parts = component.parts
+        for part in parts:
+            digest.update('%s:%s;' % (part.__class__.__name__,
+                                      getattr(part, 'version', 0)))
+            paleobase = getattr(part, 'paleobase', {})
+            for parm in sorted(getattr(part, 'params', {})):
+                milieu = paleobase[parm]
+                digest.update(repr((parm, milieu.name, milieu.version)))
+        values = core['all'].resolved()
+        for key in sorted(settings):
+            digest.update('%r=%s;' % (key, stable_repr(values.get(key))))
+        return digest.hexdigest()
+
+    def sample_fingerprints(self, component, core, shared):
+        """
+        Digests of the inputs a component declares, for each sample in core
+        (a FilteredCore), combined with the shared fingerprint. Returned as a
+        dict keyed by repr of each sample's depth (in mm).
+        """
+        inputs = getattr(component, 'inputs', {})
+        store = core.columns()
+        header = hashlib.sha1(shared)
+        numeric = []
+        other = []
+        for att in sorted(set(itertools.chain(*inputs.values()))):
+            column = store[att]
+            header.update(repr((att, column.units)))
+            if column.numeric:
+                #missing values are NaN, so presence is covered too
+                numeric.extend([column.values, column.error[:, 0],
+                                column.error[:, 1]])
+            else:
+                other.append(column.values)
+        header = header.digest()
+        matrix = np.column_stack(numeric)[core.rows] if numeric else None
+
+        fingerprints = {}
+        for index, row in enumerate(core.rows):
+            digest = hashlib.sha1(header)
+            if matrix is not None:
+                digest.update(matrix[index].tostring())
+            for values in other:
+                digest.update(repr(values[row]))
+            fingerprints[repr(float(store.depths[row]))] = digest.hexdigest()
+        return fingerprints
+
+    @staticmethod
+    def combine_fingerprints(fingerprints):
+        digest = hashlib.sha1()
+        for item in sorted(fingerprints.iteritems()):
+            digest.update('%s=%s;' % item)
+        return digest.hexdigest()
+
+    def execute(self, cplan, core, threads=None, force=False, profile=None,
+                monitor=None):
+        """
+        Runs this workflow with the given computation plan on core.
+
+        Components are run in dependency order; a component runs once every
+        component feeding it has finished, and only if at least one of them
+        passed it samples. With threads, independent branches of the workflow
+        run at the same time on that many threads; they share the core, so
+        changes to its data are made under cscience.framework.samples'
+        data_lock.
+
+        Unless force is set, work done by earlier runs is reused. Each
+        component's inputs, milieus and the core-wide settings it read from
+        core['all'] last time it ran are fingerprinted (see
+        shared_fingerprint and sample_fingerprints) and kept in
+        core['all']['Computation Cache']. A component whose fingerprint
+        hasn't changed is skipped, as its outputs are already there; a
+        per_sample component only runs on the samples whose fingerprints
+        have changed. Components that asked the user for anything (see
+        BaseComponent.user_inputs and user_approves) the last time they ran
+        are always run again, so the user can give different answers.
+
+        If profile (a cscience.framework.profiling.Profile) is given, the
+        time each component spends being prepared and run is recorded in it,
+        and the profile is stored in core['all']['Computation Profile'].
+
+        If monitor (a RunMonitor) is given, it is sent progress events as the
+        run goes, and can be used to cancel it.
+
+        Returns a dict of component name -> a dict of the seconds taken,
+        and the number of samples run and reused, for each component that
+        was reached.
+        """
         core['all'].setdefault('Required Citations', [])
         citation_set = set(core['all']['Required Citations'])
-        components = self.instantiate(cplan)
-        first_component = components[self.find_first_component()]
-
-        # bad ass pythonic execution algorithm written by Evan Sheehan
-        # gist:
-        #       1. create a queue that contains a tuple of the first
-        #          component of the workflow and the set of samples
-        #          to process
-        #       2. pull the first tuple off the queue, get its component
-        #          and pass the set of samples to it.
-        #       3. When a component is invoked, it processes the set of
-        #          samples handed to it and returns a tuple of the next
-        #          component to execute and the samples it needs to process
-        #       4. This tuple gets added to the queue and we continue
-        #          to invoke components and add tuples to the queue until
-        #          the queue is empty.
-        #       Note: we only add a tuple to the queue if it a) has greater
-        #             than zero samples to process and 2) is not already in
-        #             the queue. This ensures that the queue eventually
-        #             empties out.
-        q = collections.deque([([first_component], core)])
-        while q:
-            components, c = q.popleft()
-            for component in components:
-                citation_set.update(getattr(component, 'citations', []))
-            for pending in map(self.create_apply(c), components):
-                for pair in pending:
-                    if pair[0] and pair[1] and pending not in q:
-                        q.append(([pair[0]], pair[1]))
+        cache = dict(core['all']['Computation Cache'] or {})
+        measure = profile.measure if profile else unmeasured
+        monitor = monitor or RunMonitor()
+        components = self.instantiate(cplan, profile)
+        order, successors = self.graph()
+        first = self.find_first_component()
+        #components hand back the port each of their outputs connects to
+        ports = dict([(id(component.input_port()), name)
+                      for name, component in components.iteritems()])
+        apply_component = self.create_apply(core)
+        #values in core['all'] that are results, rather than settings, don't
+        #count towards fingerprints, even when a component reads them
+        ignore = set(['Calculated On', 'Required Citations', 'Approvals',
+                      'Computation Cache', 'Computation Profile', 'core',
+                      'depth'])
+        for component in components.itervalues():
+            ignore.update(getattr(component, 'outputs', {}).keys())
+
+        def run(name):
+            monitor.check()
+            component = components[name]
+            required = getattr(component, 'inputs', {}).get('required', [])
+            per_sample = getattr(component, 'per_sample', False)
+            view = FilteredCore(core, required)
+            monitor.component_started(name, len(view))
+
+            def on_sample(index, total):
+                monitor.check()
+                monitor.sample_progress(name, index, total)
+
+            last = cache.get(name)
+            if force or not isinstance(last, dict) or last.get('interactive'):
+                last = {}
+            fingerprints = self.sample_fingerprints(component, view,
+                    self.shared_fingerprint(component, view,
+                                            last.get('settings') or ()))
+
+            depths = None
+            if per_sample:
+                previous = last.get('samples') or {}
+                changed = [key for key, value in fingerprints.iteritems()
+                           if previous.get(key) != value]
+                if len(changed) < len(fingerprints):
+                    depths = [float(key) for key in changed]
+            elif last.get('digest') == self.combine_fingerprints(fingerprints):
+                changed = []
+            else:
+                changed = fingerprints.keys()
+            if not changed and 'routes' in last:
+                #pass samples on to the same components as last time
+                return name, {'seconds':None, 'ran':0,
+                              'reused':len(view)}, set(last['routes'])
+
+            start = time.time()
+            activated = set()
+            #the core-wide values the component reads as it runs, and the
+            #views it was given
+            settings = set()
+            views = []
+            ran = len(changed) if depths is not None else len(view)
+            with measure(name, 'run', ran):
+                pending = apply_component(component, depths, on_sample,
+                                          settings, views)
+                while pending:
+                    target, samples = pending.pop(0)
+                    if target is None or samples is None:
+                        continue
+                    if id(target) in ports:
+                        activated.add(ports[id(target)])
+                    else:
+                        #part of a component we don't schedule separately
+                        #(the inside of a Selector), so it runs as part of
+                        #this one
+                        pending.extend(apply_component(target,
+                                            settings=settings, views=views))
+            seconds = time.time() - start
+
+            #fingerprint again, with the settings the component actually
+            #used, as they were once it was done (including anything it
+            #asked the user for)
+            settings = sorted(settings - ignore)
+            view = FilteredCore(core, required)
+            fingerprints = self.sample_fingerprints(component, view,
+                    self.shared_fingerprint(component, view, settings))
+            cache[name] = {'digest':self.combine_fingerprints(fingerprints),
+                           'samples':fingerprints if per_sample else None,
+                           'routes':sorted(activated),
+                           'settings':settings,
+                           'interactive':any([view.interactive
+                                              for view in views])}
+            return name, {'seconds':seconds, 'ran':ran,
+                          'reused':len(view) - ran}, activated
+
+        def attempt(name):
+            #errors are handed back to the scheduling loop, rather than lost
+            #in a pool thread
+            try:
+                return run(name)
+            except Exception:
+                return name, sys.exc_info(), None
+
+        report = {}
+        waiting = dict([(name, 0) for name in order])
+        for targets in successors.itervalues():
+            for target in targets:
+                waiting[target] += 1
+        active = set([first])
+        ready = collections.deque([first])
+        #components not fed by anything other than the first component never
+        #get samples, but still have to be counted as finished
+        ready.extend([name for name in order if not waiting[name] and
+                      name != first])
+
+        pool = ThreadPool(threads) if threads else None
+        finished = Queue.Queue()
+        running = 0
+        monitor.started(order)
+        try:
+            while ready or running:
+                while ready:
+                    name = ready.popleft()
+                    if name not in active:
+                        finished.put((name, None, set()))
+                    elif pool:
+                        citation_set.update(getattr(components[name], 'citations', []))
+                        pool.apply_async(attempt, (name,), callback=finished.put)
+                    else:
+                        citation_set.update(getattr(components[name], 'citations', []))
+                        finished.put(attempt(name))
+                    running += 1
+                #Queue.get with no timeout can't be interrupted in python 2
+                name, result, activated = finished.get(True, 1e9)
+                running -= 1
+                if activated is None:
+                    raise result[0], result[1], result[2]
+                if result is not None:
+                    report[name] = result
+                monitor.component_finished(name, result)
+                active.update(activated)
+                for target in successors[name]:
+                    waiting[target] -= 1
+                    if not waiting[target]:
+                        ready.append(target)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        core['all']['Computation Cache'] = cache
+        if profile:
+            core['all']['Computation Profile'] = profile.as_dict()
         core['all']['Calculated On'] = time.localtime()
         core['all']['Required Citations'] = list(citation_set)
-        return True
+        return report
 
     def find_first_component(self):
         first_set = set(self.connections.keys())
@@ -245,7 +613,8 @@ class Selector(dict):
     def prepare(self, collections, workflow, experiment):
         #NOTE: this assumes that all 'Selector' entries will be iterable, even
         #if there is only one item in said entry!
-        names = self[experiment[self.name]]
+        self.mode = experiment[self.name]
+        names = self[self.mode]
         components = dict.fromkeys(names)
         for name in components:
             component = cscience.components.library[name]()
@@ -253,6 +622,8 @@ class Selector(dict):
             components[name] = component
             #grab list of all outputs as overall outputty goodness
             self.outputs.update(component.outputs)
+        #the components for the chosen mode, in the order they run
+        self.parts = [components[name] for name in names]
         #Now that we have all the components, let's go ahead and hook them up
         #in order as part of preparation
         #See python doc itertools pairwise recipe if needed.
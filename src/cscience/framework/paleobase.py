@@ -153,6 +153,29 @@ class Milieu(Collection):
         keyset = [tuple(item) for item in keyset]
         super(Milieu, self).__init__(keyset)
         self.sortedkeys = keyset
+        #bumped on every modification; anything derived from this milieu's
+        #contents is only good for the version it was built from.
+        self.version = 0
+        self._derived = {}
+
+    def __setitem__(self, key, value):
+        super(Milieu, self).__setitem__(key, value)
+        self.version += 1
+        self._derived.clear()
+
+    def derived(self, builder):
+        """
+        Returns builder(self), computing it only once per version of this
+        milieu. This lets components share expensive lookup structures (sorted
+        arrays, indexes, etc) built from a milieu across workflows and cores;
+        builder should be a class or module-level function so it works as a
+        stable cache key.
+        """
+        try:
+            return self._derived[builder]
+        except KeyError:
+            value = self._derived[builder] = builder(self)
+            return value
 
     def preload(self):
         if not self.loaded:
@@ -167,6 +190,17 @@ class Milieu(Collection):
     def saveitem(self, key, value):
         return (key, self._table.formatsavedict(value))
 
+    @property
+    def dirty(self):
+        return bool(self._updated)
+
+    def save(self, *args, **kwargs):
+        #milieus are stored as a single file, so if anything has changed, the
+        #whole thing is written.
+        if not self.dirty:
+            return []
+        return self._save_records(self._data.keys(), *args, **kwargs)
+
     def iteritems(self):
         self.preload()
         for key in self.sortedkeys:
@@ -199,16 +233,37 @@ class Milieus(Collection):
             instance = cls([])
             Milieu.connect(backend)
             for key, value in data.iteritems():
-                instance[key] = Milieu(value['template'], key, value.get('keys', []))
-
+                milieu = instance[key] = Milieu(value['template'], key,
+                                                value.get('keys', []))
+                milieu.version = value.get('version', 0)
+            #everything here came straight from the database
+            instance._updated.clear()
             cls.instance = instance
 
+    def __setitem__(self, name, milieu):
+        #a milieu replacing another of the same name carries on its version
+        #count, so the version never goes back to one that's been seen.
+        #Entries stored under another name (as components do, to point a
+        #parameter name like 'calibration curve' at the milieu a plan uses)
+        #are only aliases, so re-pointing them changes no versions.
+        old = self._data.get(name)
+        if old is not None and old is not milieu and \
+           getattr(milieu, 'name', name) == name:
+            milieu.version += old.version + 1
+        super(Milieus, self).__setitem__(name, milieu)
+
     def saveitem(self, key, value):
         return (key, self._table.formatsavedict({'template':value._template,
-                                                 'keys':sorted(value.keys())}))
+                                                 'keys':sorted(value.keys()),
+                                                 'version':value.version}))
     def save(self, *args, **kwargs):
-        super(Milieus, self).save(*args, **kwargs)
-        for milieu in self._data.itervalues():
+        changed = [key for key, milieu in self._data.iteritems()
+                   if milieu is not None and milieu.dirty]
+        #the map entry holds the milieu's keys, which change with its contents
+        report = self._save_records(self._updated.union(changed),
+                                    *args, **kwargs)
+        for milieu in set([self._data[key] for key in changed]):
             kwargs['name'] = milieu.name
-            milieu.save(*args, **kwargs)
+            report.extend(milieu.save(*args, **kwargs))
+        return report
 
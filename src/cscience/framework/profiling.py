@@ -0,0 +1,174 @@
+"""
+profiling.py
+
+* Copyright (c) 2012-2015, University of Colorado.
+* All rights reserved.
+*
+* Redistribution and use in source and binary forms, with or without
+* modification, are permitted provided that the following conditions are met:
+*     * Redistributions of source code must retain the above copyright
+*       notice, this list of conditions and the following disclaimer.
+*     * Redistributions in binary form must reproduce the above copyright
+*       notice, this list of conditions and the following disclaimer in the
+*       documentation and/or other materials provided with the distribution.
+*     * Neither the name of the University of Colorado nor the
+*       names of its contributors may be used to endorse or promote products
+*       derived from this software without specific prior written permission.
+*
+* THIS SOFTWARE IS PROVIDED BY THE UNIVERSITY OF COLORADO ''AS IS'' AND ANY
+* EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+* WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+* DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF COLORADO BE LIABLE FOR ANY
+* DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+* (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+* LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+* ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+* (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+* SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Opt-in timing of workflow runs: how long each component spends being
+prepared and run, with CPU time, sample counts, peak memory and any error.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    #not available on Windows; CPU time falls back to time.clock and peak
+    #memory isn't recorded
+    resource = None
+
+
+def cpu_time():
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    return time.clock()
+
+def peak_memory():
+    """
+    Peak resident memory of this process so far, in kilobytes (or None)
+    """
+    if not resource:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #reported in bytes on OS X, kilobytes everywhere else
+    if sys.platform == 'darwin':
+        peak /= 1024
+    return peak
+
+
+@contextlib.contextmanager
+def unmeasured(*args, **kwargs):
+    """
+    Stand-in for Profile.measure when nothing is being profiled
+    """
+    yield {}
+
+
+class Profile(object):
+    """
+    The timing events for one workflow run on one core. Each event is a dict
+    of the component name, the phase ('prepare', 'run', 'save', ...), its
+    start (in seconds from the start of the profile), wall and cpu time in
+    seconds, the number of samples involved, peak memory in KB at the end,
+    the thread it ran on, and the error message if it failed.
+
+    CPU time and peak memory are for the whole process, so they're only
+    really per-component when components aren't run on several threads.
+    """
+
+    def __init__(self, events=None, started=None):
+        self.events = events or []
+        self.started = started or time.time()
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(list(data.get('events', [])), data.get('started'))
+
+    def as_dict(self):
+        return {'started':self.started, 'events':self.events}
+
+    @contextlib.contextmanager
+    def measure(self, component, phase, samples=None):
+        """
+        Context manager that adds an event for whatever runs inside it;
+        samples can be set on the yielded event (a dict) as it's found out.
+        """
+        event = {'component':component, 'phase':phase, 'samples':samples,
+                 'start':time.time() - self.started, 'error':None,
+                 'thread':threading.current_thread().name}
+        wall = time.time()
+        cpu = cpu_time()
+        try:
+            yield event
+        except Exception as exc:
+            event['error'] = '%s: %s' % (exc.__class__.__name__, exc)
+            raise
+        finally:
+            event['wall'] = time.time() - wall
+            event['cpu'] = cpu_time() - cpu
+            event['peak_kb'] = peak_memory()
+            self.events.append(event)
+
+    def totals(self):
+        """
+        Returns a list of (component, phase, wall, cpu, samples) summed over
+        events, slowest first.
+        """
+        sums = {}
+        for event in self.events:
+            key = (event['component'], event['phase'])
+            wall, cpu, samples = sums.get(key, (0, 0, None))
+            if event['samples'] is not None:
+                samples = (samples or 0) + event['samples']
+            sums[key] = (wall + event['wall'], cpu + event['cpu'], samples)
+        return sorted([key + value for key, value in sums.iteritems()],
+                      key=lambda row: row[2], reverse=True)
+
+    def format(self):
+        lines = ['%-40s %-8s %9s %9s %8s' % ('Component', 'Phase', 'Wall (s)',
+                                             'CPU (s)', 'Samples')]
+        for component, phase, wall, cpu, samples in self.totals():
+            lines.append('%-40s %-8s %9.3f %9.3f %8s' % (component[:40], phase,
+                            wall, cpu, '' if samples is None else samples))
+        peaks = [event['peak_kb'] for event in self.events if event['peak_kb']]
+        if peaks:
+            lines.append('peak memory: %.1f MB' % (max(peaks) / 1024.))
+        for event in self.events:
+            if event['error']:
+                lines.append('%s failed during %s: %s' % (event['component'],
+                                                         event['phase'],
+                                                         event['error']))
+        return '\n'.join(lines)
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2)
+
+    def to_trace(self, name='CScience'):
+        """
+        The events in Chrome's trace event format, which chrome://tracing,
+        Perfetto and speedscope can show as a flame chart.
+        """
+        threads = {}
+        events = []
+        for event in self.events:
+            tid = threads.setdefault(event['thread'], len(threads) + 1)
+            args = dict([(key, event[key]) for key in
+                         ('cpu', 'samples', 'peak_kb', 'error')
+                         if event[key] is not None])
+            events.append({'name':event['component'], 'cat':event['phase'],
+                           'ph':'X', 'pid':1, 'tid':tid,
+                           'ts':int(event['start'] * 1e6),
+                           'dur':int(event['wall'] * 1e6), 'args':args})
+        for thread, tid in threads.iteritems():
+            events.append({'name':'thread_name', 'ph':'M', 'pid':1, 'tid':tid,
+                           'args':{'name':thread}})
+        events.append({'name':'process_name', 'ph':'M', 'pid':1,
+                       'args':{'name':name}})
+        return json.dumps({'traceEvents':events, 'displayTimeUnit':'ms'})
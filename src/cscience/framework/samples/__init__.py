@@ -29,11 +29,15 @@ samples.py
 """
 
 import bisect
+import collections
+import threading
+import time
 import cscience.datastore
 import quantities as pq
 import numpy as np
 from cscience.framework import Collection
 import coremetadata as mData
+from columnar import ColumnStore
 
 def conv_bool(x):
     if not x:
@@ -191,6 +195,7 @@ class Attributes(Collection):
         instance = super(Attributes, self).__new__(self, *args, **kwargs)
         instance.sorted_keys = base_atts[:]
         instance.base_atts = base_atts
+        instance._virtual_names = None
         return instance
     def __init__(self, *args, **kwargs):
         super(Attributes, self).__init__(*args, **kwargs)
@@ -203,6 +208,7 @@ class Attributes(Collection):
         if index not in self.sorted_keys:
             #Keys (currently cplan, depth) stay out of sorting.
             bisect.insort(self.sorted_keys, index, len(base_atts))
+        self._virtual_names = None
         return super(Attributes, self).__setitem__(index, item)
 
     def byindex(self, index):
@@ -234,7 +240,18 @@ class Attributes(Collection):
         self[name] = VirtualAttribute(name, type_, [agg.name for agg in aggregate])
 
     def virtual_atts(self):
-        return sorted([att.name for att in self if att.is_virtual])
+        return sorted(self.virtual_names)
+
+    @property
+    def virtual_names(self):
+        """
+        Set of the names of all virtual attributes; cached until the set of
+        attributes changes.
+        """
+        if self._virtual_names is None:
+            self._virtual_names = frozenset([att.name for att in self
+                                             if att.is_virtual])
+        return self._virtual_names
 
     def format_value(self, att, value):
         """
@@ -258,6 +275,11 @@ class Attributes(Collection):
         return instance
 
 
+#held while sample data is changed, and while anything cached from it (a
+#VirtualSample's flattened dict, a core's ColumnStore) is rebuilt, so
+#workflow branches running on separate threads can share a core.
+data_lock = threading.RLock()
+
 class Sample(dict):
     """
     A Sample is a set of data associated with a specific physical entity
@@ -266,9 +288,30 @@ class Sample(dict):
     via a particular CScience 'computation plan').
     """
 
+    #bumped whenever this sample's data is changed through a VirtualSample;
+    #lets anything cached from it (or from its core) know it is stale.
+    generation = 0
+    _core = None
+    #set once the core this sample was loaded from has been unloaded; the
+    #sample is no longer part of the core, so changes to it can't be saved
+    _evicted = False
+    #computation plan -> (generations, core-wide sample, flattened data); see
+    #VirtualSample.resolved
+    _resolved = None
+
     def __init__(self, experiment='input', exp_data={}):
         self[experiment] = exp_data.copy()
 
+    def touch(self):
+        if self._evicted:
+            raise RuntimeError('Core "%s" was unloaded from memory; changes '
+                               'to its old samples can\'t be saved' %
+                               self._core.name)
+        with data_lock:
+            self.generation += 1
+            if self._core is not None:
+                self._core.generation += 1
+
     @property
     def name(self):
         return '%s:%d' % (self['input']['core'], self['input']['depth'])
@@ -477,9 +520,12 @@ class VirtualSample(object):
     A VirtualSample is a view of a sample with only one computation plan. This allows
     viewing of sample data generated by multiple cplans (e.g. 'age') as
     distinct entities. Input data is available under all cplans.
+
+    Lookups go through a flattened dict (cplan data over input data over
+    core-wide cplan data over core-wide input data) that is cached on the
+    underlying Sample and rebuilt only when the sample or the core-wide data
+    has been changed.
     """
-    #PERF: this is not a terribly efficient class/abstraction; if it turns out
-    #to be a memory or performance bottleneck various elements can be made faster
 
     def __init__(self, sample, cplan, core_wide={}):
         if len(sample) > 1 and cplan == 'input':
@@ -491,33 +537,53 @@ class VirtualSample(object):
         self.sample.setdefault(self.computation_plan, {})
         self.dst = cscience.datastore.Datastore()
 
-    def __getitem__(self, key):
-        if key == 'computation plan':
-            return self.computation_plan
+    def resolved(self):
+        """
+        Returns a dict of every attribute visible from this view, with the
+        same precedence __getitem__ has always used.
+        """
+        #the core-wide sample itself is part of the stamp, as it may be
+        #replaced by a new one whose generation count matches the old one's
+        stamp = (self.sample.generation,
+                 getattr(self.core_wide, 'generation', 0))
+        cache = self.sample._resolved
+        if cache is None:
+            cache = self.sample._resolved = {}
         try:
-            att = self.dst.sample_attributes[key]
+            cached_stamp, core_wide, flat = cache[self.computation_plan]
         except KeyError:
             pass
         else:
-            if att.is_virtual:
-                return att.compose_value(self)
-        try:
-            return self.sample[self.computation_plan][key]
-        except KeyError:
-            try:
-                return self.sample['input'][key]
-            except KeyError:
-                try:
-                    return self.core_wide[self.computation_plan][key]
-                except KeyError:
-                    try:
-                        return self.core_wide['input'][key]
-                    except KeyError:
-                        return None
+            if cached_stamp == stamp and core_wide is self.core_wide:
+                return flat
+
+        with data_lock:
+            stamp = (self.sample.generation,
+                     getattr(self.core_wide, 'generation', 0))
+            flat = {}
+            for source in (self.core_wide.get('input'),
+                           self.core_wide.get(self.computation_plan),
+                           self.sample.get('input'),
+                           self.sample.get(self.computation_plan)):
+                if source:
+                    flat.update(source)
+            cache[self.computation_plan] = (stamp, self.core_wide, flat)
+        return flat
+
+    def __getitem__(self, key):
+        if key == 'computation plan':
+            return self.computation_plan
+        if key in self.dst.sample_attributes.virtual_names:
+            return self.dst.sample_attributes[key].compose_value(self)
+        return self.resolved().get(key)
     def __setitem__(self, key, item):
-        self.sample[self.computation_plan][key] = item
+        with data_lock:
+            self.sample[self.computation_plan][key] = item
+            self.sample.touch()
     def __delitem__(self, key):
-        del self.sample[self.computation_plan][key]
+        with data_lock:
+            del self.sample[self.computation_plan][key]
+            self.sample.touch()
 
     def __contains__(self, key):
         return key in self.keys()
@@ -539,14 +605,14 @@ class VirtualSample(object):
         return keys
 
     def keys(self):
-        keys = self.sample_keys()
-        #now add the things that are core-wide....
-        keys.update(self.core_wide[self.computation_plan].keys())
-        keys.update(self.core_wide['input'].keys())
-        return keys
+        #includes the things that are core-wide
+        return set(self.resolved())
 
     def setdefault(self, key, value):
-        self.sample[self.computation_plan].setdefault(key, value)
+        with data_lock:
+            if key not in self.sample[self.computation_plan]:
+                self.sample[self.computation_plan][key] = value
+                self.sample.touch()
 
     def search(self, value, view=None, exact=False):
         if not view:
@@ -557,8 +623,33 @@ class VirtualSample(object):
                 return att
         return None
 
+class RecordingSample(VirtualSample):
+    """
+    A VirtualSample that adds the name of every attribute looked up through
+    it (including by setdefault or 'in') to the set used. FilteredCores hand
+    these out for core['all'], so the core-wide settings a component depends
+    on can be found out by running it.
+    """
+
+    def __init__(self, sample, cplan, core_wide={}, used=None):
+        super(RecordingSample, self).__init__(sample, cplan, core_wide)
+        self.used = used if used is not None else set()
+
+    def __getitem__(self, key):
+        self.used.add(key)
+        return super(RecordingSample, self).__getitem__(key)
+    def __contains__(self, key):
+        self.used.add(key)
+        return super(RecordingSample, self).__contains__(key)
+    def setdefault(self, key, value):
+        self.used.add(key)
+        return super(RecordingSample, self).setdefault(key, value)
+
 class Core(Collection):
     _tablename = 'cores'
+    #rough cost in bytes of one stored value (key, quantity and uncertainty),
+    #used when estimating how much memory a core is using
+    _value_bytes = 400
 
     @classmethod
     def connect(cls, backend):
@@ -573,8 +664,72 @@ class Core(Collection):
         self.mdata = mData.Core(name)
         self.cplans.add('input')
         self.loaded = False
+        #bumped on any change to the samples in this core
+        self.generation = 0
+        self._columns = {}
         super(Core, self).__init__([])
         self.add(Sample(exp_data={'depth':'all'}))
+        #a brand new core has never been saved; see Cores.loadkeys
+        self._saved_generation = None
+        self._size = (None, 0)
+
+    @property
+    def dirty(self):
+        """
+        Whether anything in this core has changed since it was last loaded
+        or saved.
+        """
+        return self.generation != self._saved_generation
+
+    def save(self, *args, **kwargs):
+        #cores are stored as a single file, so if anything has changed, the
+        #whole thing is written.
+        if not self.dirty:
+            return []
+        start = time.time()
+        self._table.savemany([self.saveitem(key, value) for key, value in
+                              self._data.iteritems() if value is not None],
+                             *args, **kwargs)
+        self._saved_generation = self.generation
+        self._updated.clear()
+        return [(self.tablename(), [self.name], time.time() - start)]
+
+    def unload(self):
+        """
+        Drops all of this core's samples from memory; they will be read back
+        from the database the next time the core is iterated over. Only safe
+        for cores with no unsaved changes. The dropped samples refuse any
+        further changes (see Sample.touch), rather than lose them quietly.
+        """
+        for sample in self._data.itervalues():
+            if isinstance(sample, Sample):
+                sample._evicted = True
+        self._data = {}
+        self._columns = {}
+        self.loaded = False
+        self.add(Sample(exp_data={'depth':'all'}))
+        self._saved_generation = self.generation
+
+    def memory_estimate(self):
+        """
+        Approximate number of bytes used by this core's loaded samples, and
+        by the columns of its ColumnStores.
+        """
+        if not self.loaded:
+            return 0
+        columns = sum([store.nbytes for store in self._columns.values()])
+        if self._size[0] != self.generation:
+            total = 0
+            for sample in self._data.itervalues():
+                for values in sample.itervalues():
+                    total += len(values) * self._value_bytes
+                    for value in values.itervalues():
+                        dist = getattr(getattr(value, 'uncertainty', None),
+                                       'distribution', None)
+                        if dist is not None:
+                            total += dist.y.nbytes
+            self._size = (self.generation, total)
+        return self._size[1] + columns
 
     def _dbkey(self, key):
         if key == 'all':
@@ -636,12 +791,16 @@ class Core(Collection):
             else:
                 raise
     def __setitem__(self, depth, sample):
-        super(Core, self).__setitem__(self._unitkey(depth), sample)
-        try:
-            self.cplans.update(sample.keys())
-        except AttributeError:
-            #not actually a computation plan, just some background
-            pass
+        with data_lock:
+            super(Core, self).__setitem__(self._unitkey(depth), sample)
+            self.generation += 1
+            try:
+                self.cplans.update(sample.keys())
+            except AttributeError:
+                #not actually a computation plan, just some background
+                pass
+            if isinstance(sample, Sample):
+                sample._core = self
 
     def add(self, sample):
         sample['input']['core'] = self.name
@@ -659,19 +818,39 @@ class Core(Collection):
         #if I'm getting all the keys, I'm going to want the values too, so
         #I might as well pull everything. Whee!
         if self.loaded:
-            for key in self._data:
+            #a copy of the keys, as samples may be added while we go
+            for key in self._data.keys():
                 if key != 'all':
                     yield key
         else:
             for key, value in self._table.iter_core_samples(self):
+                sample = self.makesample(value)
+                sample._core = self
                 if key != 'all':
                     numeric = UncertainQuantity(key, 'mm')
-                    self._data[self._unitkey(numeric)] = self.makesample(value)
+                    self._data[self._unitkey(numeric)] = sample
                     yield numeric
                 else:
-                    self._data['all'] = self.makesample(value)
+                    self._data['all'] = sample
             self.loaded = True
 
+    def columns(self, cplan):
+        """
+        Returns a ColumnStore (one array per attribute) for the given
+        computation plan of this core. The store is cached until any data in
+        this core changes; it is a copy of the data, so stores that have gone
+        out of date are dropped rather than kept around.
+        """
+        store = self._columns.get(cplan)
+        if store is None or store.generation != self.generation:
+            with data_lock:
+                self._columns = dict([(plan, other) for plan, other in
+                                      self._columns.items()
+                                      if other.generation == self.generation])
+                store = self._columns[cplan] = \
+                        ColumnStore(VirtualCore(self, cplan))
+        return store
+
 class VirtualCore(object):
     #has a Core and an experiment, returns VirtualSamples for items instead
     #of Samples. Hurrah!
@@ -687,6 +866,13 @@ class VirtualCore(object):
             return self.computation_plan
         return VirtualSample(self.core[key], self.computation_plan, self.core['all'])
 
+    def columns(self):
+        """
+        Column-oriented (one array per attribute) snapshot of this core's data
+        for this computation plan; see ColumnStore.
+        """
+        return self.core.columns(self.computation_plan)
+
     def keys(self):
         keys = self.core.keys()
         try:
@@ -696,13 +882,84 @@ class VirtualCore(object):
         return keys
 
     def createvalue(self, depth, key, value):
-        sample = self.core.forcesample(depth)
-        sample.setdefault(self.computation_plan, {})
-        sample[self.computation_plan][key] = value
+        with data_lock:
+            sample = self.core.forcesample(depth)
+            sample.setdefault(self.computation_plan, {})
+            sample[self.computation_plan][key] = value
+            sample.touch()
         return VirtualSample(sample, self.computation_plan, self.core['all'])
 
+class FilteredCore(VirtualCore):
+    """
+    A VirtualCore that only iterates over the samples that have a value for
+    every one of the required attributes. Which samples those are is worked
+    out once, when the view is created (using the core's columns), in depth
+    order; samples that gain or lose values afterward don't change the view.
+    Each view is its own object, so any number of them can be used at once.
+
+    If depths is given, the view is further limited to the samples at those
+    depths (in mm, as in Core keys). If on_sample is given, it is called as
+    on_sample(index, total) as each sample is handed out by iteration, which
+    lets long computations report progress (or be stopped, by raising).
+
+    The names of the core-wide values read through view['all'] are collected
+    in view.settings (which can be a set shared between views). A component
+    that asks the user for anything sets view.interactive.
+    """
+
+    def __init__(self, vcore, required=(), depths=None, on_sample=None,
+                 settings=None):
+        super(FilteredCore, self).__init__(vcore.core, vcore.computation_plan)
+        self.required = tuple(required)
+        self.on_sample = on_sample
+        self.settings = settings if settings is not None else set()
+        self.interactive = False
+        store = self.columns()
+        mask = store.notnull(self.required)
+        if depths is not None:
+            mask &= np.in1d(store.depths, list(depths))
+        #row numbers of these samples in the ColumnStore
+        self.rows = np.flatnonzero(mask)
+        self._keys = list(store.depths[mask])
+        self._samples = store.rows(mask)
+
+    def __getitem__(self, key):
+        if key == 'all':
+            return RecordingSample(self.core['all'], self.computation_plan,
+                                   self.core['all'], self.settings)
+        return super(FilteredCore, self).__getitem__(key)
+
+    def __iter__(self):
+        if not self.on_sample:
+            return iter(self._samples)
+        return self._report_iter()
+
+    def _report_iter(self):
+        total = len(self._samples)
+        for index, sample in enumerate(self._samples):
+            self.on_sample(index, total)
+            yield sample
+
+    def __len__(self):
+        return len(self._samples)
+
+    def keys(self):
+        return list(self._keys)
+
 class Cores(Collection):
     _tablename = 'cores_map'
+    #how many cores may be fully loaded at once, and roughly how much memory
+    #they may use; set from config by the Datastore.
+    cache_count = 8
+    cache_bytes = 512 * 2 ** 20
+
+    def __init__(self, keyset):
+        super(Cores, self).__init__(keyset)
+        #names of cores that have been asked for, least recently used first
+        self._lru = collections.OrderedDict()
+        #name -> number of holders of cores that mustn't be unloaded
+        self._pins = collections.Counter()
+        self._stats = {'hits':0, 'misses':0, 'evictions':0}
 
     @classmethod
     def connect(cls, backend):
@@ -718,8 +975,10 @@ class Cores(Collection):
             instance = cls([])
             Core.connect(backend)
             for key, value in data.iteritems():
-                instance[key] = Core(key, value.get('cplans', []))
-
+                core = instance[key] = Core(key, value.get('cplans', []))
+                core._saved_generation = core.generation
+            #everything here came straight from the database
+            instance._updated.clear()
             cls.instance = instance
       
     @classmethod      
@@ -728,11 +987,98 @@ class Cores(Collection):
         Core._table.delete_item(core.name)
         del self._data[core.name]
 
+    def __getitem__(self, name):
+        core = super(Cores, self).__getitem__(name)
+        if core.loaded:
+            self._stats['hits'] += 1
+        else:
+            self._stats['misses'] += 1
+        self._lru.pop(name, None)
+        self._lru[name] = None
+        self._evict(name)
+        return core
+
+    def pin(self, name):
+        """
+        Keeps the named core from being unloaded (as when it is on display,
+        or being computed on) until it is unpinned as many times as it was
+        pinned.
+        """
+        self._pins[name] += 1
+
+    def unpin(self, name):
+        if self._pins[name] > 1:
+            self._pins[name] -= 1
+        else:
+            del self._pins[name]
+
+    def _evict(self, keep):
+        """
+        Unloads the least recently used cores until the loaded cores fit in
+        the cache limits. Cores with unsaved changes, and pinned cores, are
+        never unloaded. The core being fetched (keep) is not counted towards
+        the memory budget, as it may not have been loaded yet.
+        """
+        loaded = [name for name in self._lru if name != keep and
+                  self._data.get(name) is not None and self._data[name].loaded]
+        count = len(loaded) + 1
+        total = sum([self._data[name].memory_estimate() for name in loaded])
+        for name in loaded:
+            if count <= self.cache_count and total <= self.cache_bytes:
+                break
+            core = self._data[name]
+            if core.dirty or self._pins[name]:
+                continue
+            total -= core.memory_estimate()
+            count -= 1
+            core.unload()
+            del self._lru[name]
+            self._stats['evictions'] += 1
+
+    def cache_stats(self):
+        """
+        Returns a dict of counters for the loaded-core cache: hits and misses
+        (whether a requested core was already in memory), evictions, how many
+        cores are loaded (and how many of those are kept loaded, by having
+        unsaved changes or being pinned), and their estimated memory use in
+        bytes.
+        """
+        loaded = [core for core in self._data.itervalues()
+                  if core is not None and core.loaded]
+        stats = dict(self._stats)
+        requests = stats['hits'] + stats['misses']
+        stats['hit_rate'] = float(stats['hits']) / requests if requests else 0
+        stats['loaded'] = len(loaded)
+        stats['pinned'] = len([core for core in loaded
+                               if core.dirty or self._pins[core.name]])
+        stats['bytes'] = sum([core.memory_estimate() for core in loaded])
+        stats['max_loaded'] = self.cache_count
+        stats['max_bytes'] = self.cache_bytes
+        return stats
+
     def saveitem(self, key, value):
         return (key, self._table.formatsavedict({'cplans':list(value.cplans)}))
+    def save_core(self, name, *args, **kwargs):
+        """
+        Saves only the named core (and its entry in the map of cores), if it
+        has changed, leaving everything else for a later save.
+        """
+        core = self._data.get(name)
+        if core is None or not core.loaded or not core.dirty:
+            return []
+        report = self._save_records([name], *args, **kwargs)
+        kwargs['name'] = name
+        report.extend(core.save(*args, **kwargs))
+        return report
     def save(self, *args, **kwargs):
-        super(Cores, self).save(*args, **kwargs)
-        for core in self._data.itervalues():
-            if core.loaded:
-                kwargs['name'] = core.name
-                core.save(*args, **kwargs)
+        changed = [core for core in self._data.itervalues()
+                   if core is not None and core.loaded and core.dirty]
+        #the map entry holds the set of computation plans, which may have
+        #changed along with the core
+        report = self._save_records(self._updated.union(
+                                    [core.name for core in changed]),
+                                    *args, **kwargs)
+        for core in changed:
+            kwargs['name'] = core.name
+            report.extend(core.save(*args, **kwargs))
+        return report
@@ -0,0 +1,168 @@
+"""
+columnar.py
+
+* Copyright (c) 2012-2015, University of Colorado.
+* All rights reserved.
+*
+* Redistribution and use in source and binary forms, with or without
+* modification, are permitted provided that the following conditions are met:
+*     * Redistributions of source code must retain the above copyright
+*       notice, this list of conditions and the following disclaimer.
+*     * Redistributions in binary form must reproduce the above copyright
+*       notice, this list of conditions and the following disclaimer in the
+*       documentation and/or other materials provided with the distribution.
+*     * Neither the name of the University of Colorado nor the
+*       names of its contributors may be used to endorse or promote products
+*       derived from this software without specific prior written permission.
+*
+* THIS SOFTWARE IS PROVIDED BY THE UNIVERSITY OF COLORADO ''AS IS'' AND ANY
+* EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+* WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+* DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF COLORADO BE LIABLE FOR ANY
+* DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+* (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+* LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+* ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+* (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+* SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+This module holds a column-oriented (one array per attribute) view of the
+data in a core, for code that wants to work on a whole core at once instead
+of a sample at a time. It is a read-side snapshot: the Samples are still
+where the data lives, so a snapshot's columns take memory on top of them.
+"""
+
+import numpy as np
+import quantities as pq
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float, np.number, pq.Quantity)) and \
+           not isinstance(value, bool)
+
+class Column(object):
+    """
+    All the values of one attribute across a core, as arrays in depth order.
+
+    present is a boolean mask of which samples have a value at all. For
+    numeric attributes, values is a float array (NaN where missing) in the
+    column's units, and error is an (n, 2) array of the error magnitudes as
+    given by Uncertainty.get_mag_tuple (0 where there is no error).
+    distributions holds any Distribution objects the uncertainties carry, or
+    is None if there are none. Non-numeric attributes just get an object array
+    of the raw values as values, and None for the rest.
+    """
+
+    numeric = False
+
+    def __init__(self, name, raw):
+        self.name = name
+        self.present = np.array([val is not None for val in raw], dtype=bool)
+        self.units = None
+        self.error = None
+        self.distributions = None
+
+        known = [val for val in raw if val is not None]
+        if not known or not all(is_number(val) for val in known):
+            self.values = np.empty(len(raw), dtype=object)
+            self.values[:] = raw
+            return
+
+        self.numeric = True
+        self.values = np.empty(len(raw))
+        self.values.fill(np.nan)
+        self.error = np.zeros((len(raw), 2))
+        for val in known:
+            if hasattr(val, 'dimensionality'):
+                self.units = val.dimensionality.string
+                break
+
+        distributions = [None] * len(raw)
+        for row, val in enumerate(raw):
+            if val is None:
+                continue
+            if hasattr(val, 'dimensionality'):
+                if self.units and val.dimensionality.string != self.units:
+                    try:
+                        val = val.rescale(self.units)
+                    except ValueError:
+                        pass
+                self.values[row] = float(val.magnitude)
+            else:
+                self.values[row] = float(val)
+            uncert = getattr(val, 'uncertainty', None)
+            if uncert is not None:
+                self.error[row] = uncert.get_mag_tuple()
+                distributions[row] = uncert.distribution
+        if any(dist is not None for dist in distributions):
+            self.distributions = np.empty(len(raw), dtype=object)
+            self.distributions[:] = distributions
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        #object arrays only hold references to values the core already has
+        return sum([array.nbytes for array in (self.values, self.present,
+                                               self.error, self.distributions)
+                    if array is not None])
+
+    def notnull(self):
+        return self.present
+
+
+class ColumnStore(object):
+    """
+    Columnar snapshot of one computation plan of a core. Rows are the
+    core's samples in depth order (depths holds the depth keys, in mm);
+    samples[row] is the VirtualSample for that row, so the store can always
+    be mapped back to the dict-based data.
+
+    Columns are built the first time they are asked for. The store is a
+    read-only snapshot, kept in addition to the core's Samples; writes still
+    go through VirtualSample, and a new store is built (see Core.columns)
+    once the core has been changed.
+    """
+
+    def __init__(self, vcore):
+        self.computation_plan = vcore.computation_plan
+        self.generation = vcore.core.generation
+        self.depths = np.array(sorted(float(key) for key in vcore.core))
+        self.samples = [vcore[depth] for depth in self.depths]
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.samples)
+
+    @property
+    def nbytes(self):
+        """Bytes held by the arrays of the columns built so far"""
+        return sum([column.nbytes for column in self._columns.values()])
+
+    def __contains__(self, att):
+        return att in self._columns or \
+               any(att in sample for sample in self.samples)
+
+    def __getitem__(self, att):
+        try:
+            return self._columns[att]
+        except KeyError:
+            column = self._columns[att] = Column(att,
+                            [sample[att] for sample in self.samples])
+            return column
+
+    def notnull(self, atts):
+        """
+        Boolean mask of the rows that have a value for every one of atts
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for att in atts:
+            mask &= self[att].present
+        return mask
+
+    def rows(self, mask):
+        """
+        The VirtualSamples for the rows selected by a boolean mask
+        """
+        return [self.samples[row] for row in np.flatnonzero(mask)]
@@ -0,0 +1,140 @@
+"""
+run.py
+
+* Copyright (c) 2012-2015, University of Colorado.
+* All rights reserved.
+*
+* Redistribution and use in source and binary forms, with or without
+* modification, are permitted provided that the following conditions are met:
+*     * Redistributions of source code must retain the above copyright
+*       notice, this list of conditions and the following disclaimer.
+*     * Redistributions in binary form must reproduce the above copyright
+*       notice, this list of conditions and the following disclaimer in the
+*       documentation and/or other materials provided with the distribution.
+*     * Neither the name of the University of Colorado nor the
+*       names of its contributors may be used to endorse or promote products
+*       derived from this software without specific prior written permission.
+*
+* THIS SOFTWARE IS PROVIDED BY THE UNIVERSITY OF COLORADO ''AS IS'' AND ANY
+* EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+* WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+* DISCLAIMED. IN NO EVENT SHALL THE UNIVERSITY OF COLORADO BE LIABLE FOR ANY
+* DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+* (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+* LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+* ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+* (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+* SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+Command-line entry point for running computation plans without the GUI:
+
+    python -m cscience.run --plan "My Plan" --cores "Core A,Core B"
+    python -m cscience.run --plan "My Plan" --all --params answers.json -j 4
+    python -m cscience.run --plan "My Plan" --all --profile --trace traces/
+    python -m cscience.run --plan "My Plan" --cores "Core A" --force
+    python -m cscience.run --plan "My Plan" --cores "Core A" --threads 4
+
+The repository is loaded as set in config.py. Anything a component would
+normally ask the user for is answered from the parameter file or from values
+already stored with each core (see cscience.components.HeadlessInteraction);
+a core with an unanswered question fails without affecting the others.
+Nothing on this path imports wx.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import cscience.components
+from cscience import batch, datastore
+from cscience.framework import format_report
+from cscience.framework.profiling import Profile
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m cscience.run',
+                description='Run a computation plan on cores without the GUI')
+    parser.add_argument('--plan', required=True,
+                        help='name of the computation plan to run')
+    cores = parser.add_mutually_exclusive_group(required=True)
+    cores.add_argument('--cores', type=lambda names: names.split(','),
+                       help='comma-separated names of the cores to run on')
+    cores.add_argument('--all', action='store_true',
+                       help='run on every core in the repository')
+    parser.add_argument('--params',
+                        help='JSON file of answers to component questions')
+    parser.add_argument('-j', '--processes', type=int, default=0,
+                        help='number of worker processes; 0 (the default) '
+                             'runs everything in this process')
+    parser.add_argument('--threads', type=int, default=0,
+                        help='number of threads to run independent branches '
+                             'of the plan on, within each core; 0 (the '
+                             'default) runs one component at a time')
+    parser.add_argument('--force', action='store_true',
+                        help='run every component again, rather than reusing '
+                             'results whose inputs haven\'t changed')
+    parser.add_argument('--profile', action='store_true',
+                        help='print how long each component took on each core')
+    parser.add_argument('--trace',
+                        help='directory to write a JSON profile and a Chrome '
+                             'trace (flame chart) of each core\'s run to')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = {}
+    if args.params:
+        with open(args.params) as paramfile:
+            params = json.load(paramfile)
+    interaction = cscience.components.HeadlessInteraction(params)
+    cscience.components.set_interaction(interaction)
+
+    store = datastore.Datastore()
+    store.load_from_config()
+    if args.plan not in store.computation_plans:
+        print >>sys.stderr, 'No computation plan named "%s"' % args.plan
+        return 2
+    if args.all:
+        corenames = sorted(store.cores.keys())
+    else:
+        corenames = args.cores
+        missing = [name for name in corenames if name not in store.cores]
+        if missing:
+            print >>sys.stderr, 'No such core(s): %s' % ', '.join(missing)
+            return 2
+
+    profiling = args.profile or args.trace
+    if args.trace and not os.path.isdir(args.trace):
+        os.makedirs(args.trace)
+
+    def progress(done, total, result):
+        print '[%d/%d] %s' % (done, total, result)
+        if result.report:
+            for line in format_report(result.report):
+                print '    ' + line
+        if result.profile:
+            profile = Profile.from_dict(result.profile)
+            if args.profile:
+                print profile.format()
+            if args.trace:
+                write_profile(args.trace, result.core, profile)
+        sys.stdout.flush()
+
+    summary = batch.run_batch(args.plan, corenames, args.processes, progress,
+                              interaction, profiling, args.force,
+                              args.threads)
+    print summary.report()
+    return 1 if summary.failures else 0
+
+def write_profile(directory, corename, profile):
+    base = os.path.join(directory, ''.join([char if char.isalnum() or
+                                            char in '-_.' else '_'
+                                            for char in corename]))
+    with open(base + '.profile.json', 'w') as output:
+        output.write(profile.to_json())
+    with open(base + '.trace.json', 'w') as output:
+        output.write(profile.to_trace(corename))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+"""
+Times decoding and re-encoding the cores (and milieus) in a repository with
+the SON transformations in cscience.backends.mongodb, so changes to the codec
+can be measured against real data. Nothing is written back to the database.
+
+usage: dbbenchmark.py [host] [port] [repeats]
+"""
+
+import json
+import sys
+import time
+
+import pymongo
+import gridfs
+
+from cscience.backends.mongodb import CustomTransformations
+
+
+def load_records(fs, name):
+    myfile = fs.get_last_version(name=name)
+    try:
+        if getattr(myfile, 'format', None) == 'records':
+            return [json.loads(line) for line in myfile.read().splitlines()
+                    if line.strip()]
+        return json.load(myfile)
+    finally:
+        myfile.close()
+
+def time_file(fs, name, repeats):
+    raw = load_records(fs, name)
+    transforms = CustomTransformations()
+    decode = encode = 0
+    for i in range(repeats):
+        #decoding works in place, so start from a fresh copy each time
+        records = json.loads(json.dumps(raw))
+        start = time.time()
+        records = [transforms.transform_outgoing(rec, None) for rec in records]
+        decode += time.time() - start
+        start = time.time()
+        [transforms.transform_incoming(rec, None) for rec in records]
+        encode += time.time() - start
+    return len(raw), decode / repeats, encode / repeats
+
+def run(repo, repeats):
+    totals = [0, 0, 0]
+    for filetype in ('core_files', 'milieu_files'):
+        fs = gridfs.GridFS(repo, collection=filetype)
+        for name in sorted(repo[filetype + '.files'].distinct('name')):
+            count, decode, encode = time_file(fs, name, repeats)
+            print '%-14s %-30s %7d records  decode %8.4fs  encode %8.4fs' % (
+                        filetype, name, count, decode, encode)
+            totals[0] += count
+            totals[1] += decode
+            totals[2] += encode
+    print 'total: %d records, decode %.4fs, encode %.4fs' % tuple(totals)
+
+
+if __name__ == '__main__':
+    host = sys.argv[1] if len(sys.argv) > 1 else 'localhost'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 27017
+    repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+    conn = pymongo.MongoClient(host, port)
+    run(conn['repository'], repeats)